@@ -6,6 +6,19 @@ if [[ -z "$DISPLAY" ]]; then
     export DISPLAY=":98"
 fi
 
+# In batch mode every line of the standard input contains the HTML
+# and PDF paths of an invoice, which are converted by a single process
+if [ "$1" == "--batch" ]; then
+    WKHTMLTOPDF=/usr/local/bin/wkhtmltopdf
+
+    if [ ! -x "$WKHTMLTOPDF" ]; then
+        WKHTMLTOPDF=/usr/bin/wkhtmltopdf
+    fi
+
+    "$WKHTMLTOPDF" --read-args-from-stdin
+    exit $?
+fi
+
 /usr/local/bin/wkhtmltopdf "$1" "$2"
 
 if [ $? -ne 0 ]; then
@@ -58,6 +58,14 @@ MEDIA_ROOT = path.join(BASEDIR, 'media')
 
 BILL_ROOT = path.join(MEDIA_ROOT, 'bills')
 
+# Whether the invoice PDFs are generated by a background worker
+ASYNC_INVOICE_GENERATION = True
+
+# Workers per process that generate the invoice PDFs and maximum
+# number of invoices compiled by a single converter process
+INVOICE_WORKERS = 2
+INVOICE_BATCH_SIZE = 20
+
 # URL that handles the media served from MEDIA_ROOT.
 MEDIA_URL = '/media/'
 
@@ -206,11 +214,52 @@ SOCIAL_AUTH_ENABLED_BACKENDS = ('fiware',)
 
 TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
 
-# Daily job that checks pending pay-per-use charges
+# Daily job that checks pending pay-per-use charges and jobs that
+# handle the expired payments and queued CDRs not processed by the
+# running instances
 CRONJOBS = [
     ('0 5 * * *', 'django.core.management.call_command', ['resolve_use_charging']),
+    ('*/5 * * * *', 'django.core.management.call_command', ['expire_payments']),
+    ('*/5 * * * *', 'django.core.management.call_command', ['send_cdrs']),
+    ('0 * * * *', 'django.core.management.call_command', ['renew_subscriptions']),
+    ('*/10 * * * *', 'django.core.management.call_command', ['generate_invoices']),
+    ('*/5 * * * *', 'django.core.management.call_command', ['sync_balances']),
 ]
 
+# Threads per process that send the queued CDRs to the RSS and
+# maximum number of CDRs included in a single request
+CDR_SENDERS = 2
+CDR_BATCH_SIZE = 100
+
+# Correlation numbers of the API v1 RSS reserved at once by every
+# process. Values greater than 1 reduce the writes to the RSS document,
+# but the numbers are not consecutive between processes
+CDR_CORRELATION_RESERVE = 1
+
+# Seconds that the configuration cached by every process, such as
+# the RSS, units and currencies, is used before being loaded again
+CONFIG_CACHE_TTL = 60
+
+# Seconds that the info of an offering cached by every process for
+# the listings is used, if the offering is not modified, before
+# being built again
+OFFERING_INFO_CACHE_TTL = 60
+
+# Seconds that the charges of an actor can be accumulated locally before
+# sending them to the RSS, and fraction of the expenditure limits under
+# which the charges are accepted without checking the RSS balance
+EXPENDITURE_CACHE_TTL = 300
+EXPENDITURE_CACHE_MARGIN = 0.9
+
+# Changes of the search index buffered by every process before writing
+# them, and maximum seconds that a change is buffered
+SEARCH_COMMIT_LIMIT = 100
+SEARCH_COMMIT_PERIOD = 1
+
+# Seconds between the checks of the consistency of the search index
+# made by every process, which are disabled if None
+SEARCH_CHECK_PERIOD = None
+
 # Hack to ignore `site` instance creation
 # This will prevent site creation on syncdb
 from django.db.models import signals
@@ -227,6 +276,11 @@ CLIENTS = {
 
 PAYMENT_CLIENT = CLIENTS[PAYMENT_METHOD]
 
+# Connections kept alive with the payment gateway and timeouts
+# (connect, read) in seconds of its requests
+PAYMENT_POOL_SIZE = 10
+PAYMENT_TIMEOUT = (5, 30)
+
 RESOURCE_INDEX_DIR = path.join(BASEDIR, path.join('wstore', path.join('admin', 'indexes')))
 
 NOTIF_CERT_FILE = None
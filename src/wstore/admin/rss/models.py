@@ -76,5 +76,7 @@ class RSS(models.Model):
         userprofile.refresh_token = credentials['refresh_token']
         userprofile.save()
 
+        # Only the token is updated in order not to override other
+        # fields modified atomically, such as the correlation number
         self.access_token = credentials['access_token']
-        self.save()
+        RSS.objects.filter(pk=self.pk).update(access_token=self.access_token)
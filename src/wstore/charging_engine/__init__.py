@@ -0,0 +1,46 @@
+
+from pymongo import ASCENDING
+
+from wstore.store_commons.database import get_database_connection
+
+db = get_database_connection()
+
+# Create indexes for the SDRs of the contracts if not created
+db.charging_engine_servicerecord.ensure_index([
+    ('contract_id', ASCENDING),
+    ('correlation_number', ASCENDING)
+], unique=True)
+
+db.charging_engine_servicerecord.ensure_index([
+    ('contract_id', ASCENDING),
+    ('state', ASCENDING),
+    ('correlation_number', ASCENDING)
+])
+
+db.charging_engine_servicerecord.ensure_index([
+    ('contract_id', ASCENDING),
+    ('time_stamp', ASCENDING),
+    ('correlation_number', ASCENDING)
+])
+
+# Used to find the contracts with pending SDRs to be charged
+db.charging_engine_servicerecord.ensure_index([
+    ('state', ASCENDING),
+    ('time_stamp', ASCENDING)
+])
+
+# Used to find the expired timeouts of the pending payments
+db.charging_engine_paymenttimeout.ensure_index([('due', ASCENDING)])
+
+# Only one charging run of pay per use contracts can be active
+db.charging_engine_chargingrun.ensure_index([('active', ASCENDING)], unique=True, sparse=True)
+
+# Used to sum the daily charges of the accounts of the balance cache
+db.charging_engine_balancebucket.ensure_index([
+    ('account', ASCENDING),
+    ('currency', ASCENDING),
+    ('day', ASCENDING)
+], unique=True)
+
+# Used to find the contracts whose subscriptions have to be renovated
+db.charging_engine_contract.ensure_index([('next_renovation', ASCENDING)])
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import absolute_import
+
+from datetime import datetime, timedelta
+from urllib2 import HTTPError
+from pymongo.errors import DuplicateKeyError
+
+from django.conf import settings
+
+from wstore.models import Organization
+from wstore.rss_adaptor.rss_manager_factory import RSSManagerFactory
+from wstore.store_commons.database import get_database_connection
+
+
+# Account used to track the charges of all the actors, which
+# are limited by the expenditure limits of WStore as a provider
+PROVIDER_ACCOUNT = 'provider'
+
+# Time covered by every periodic limit. The periods are longer than the
+# calendar ones used by the RSS so the local balances are never lower
+LIMIT_PERIODS = {
+    'daily': timedelta(days=1),
+    'weekly': timedelta(days=7),
+    'monthly': timedelta(days=31)
+}
+
+HISTORY_PERIOD = max(LIMIT_PERIODS.values())
+
+
+def _get_collection():
+    return get_database_connection().charging_engine_balance
+
+
+def _get_buckets():
+    return get_database_connection().charging_engine_balancebucket
+
+
+def _get_day(date):
+    return datetime.combine(date.date(), datetime.min.time())
+
+
+def _load_account(account_id, now):
+    """
+    Returns the balance of an account, which is created the first time
+    it is used. Charges made before that are not known locally
+    """
+    return _get_collection().find_and_modify(
+        {'_id': account_id},
+        {'$setOnInsert': {'since': now, 'pending': {}, 'synced': None}},
+        upsert=True,
+        new=True
+    )
+
+
+def _get_spent(account_id, currency, start):
+    """
+    Returns the amount charged to an account since the day of the
+    given date. Charges are aggregated in daily buckets, so the whole
+    first day is included and the amount is never lower than the real one
+    """
+    buckets = _get_buckets().find({
+        'account': account_id,
+        'currency': currency,
+        'day': {'$gte': _get_day(start)}
+    }, {'amount': True, '_id': False})
+
+    return sum([bucket['amount'] for bucket in buckets])
+
+
+def _within_limits(account, limits, charge, now):
+    """
+    Checks if a charge keeps the balance of an account away from its limits,
+    which can only be ensured if the history of the account covers their
+    periods and the currency of the charge is the one of the limits
+    """
+    if limits.get('currency') != charge['currency']:
+        return False
+
+    margin = settings.EXPENDITURE_CACHE_MARGIN
+
+    for limit, max_amount in limits.iteritems():
+        if limit == 'currency':
+            continue
+
+        spent = 0
+        if limit in LIMIT_PERIODS:
+            start = now - LIMIT_PERIODS[limit]
+
+            if account['since'] > start:
+                return False
+
+            spent = _get_spent(account['_id'], charge['currency'], start)
+
+        if spent + charge['amount'] > max_amount * margin:
+            return False
+
+    return True
+
+
+def is_stale(account, now=None):
+    """
+    Checks if the balance of an account has not been synchronized recently
+    """
+    if now is None:
+        now = datetime.now()
+
+    return account['synced'] is None or \
+        account['synced'] < now - timedelta(seconds=settings.EXPENDITURE_CACHE_TTL)
+
+
+def can_charge_locally(actor, charge, provider_limits=None, now=None):
+    """
+    Determines if a charge can be accepted without checking the balance
+    of the actor in the RSS, since it is far from the expenditure limits
+    of the actor and the provider
+    """
+    if now is None:
+        now = datetime.now()
+
+    account = _load_account(actor.pk, now)
+    if is_stale(account, now) or not _within_limits(account, actor.expenditure_limits, charge, now):
+        return False
+
+    if provider_limits:
+        provider_account = _load_account(PROVIDER_ACCOUNT, now)
+
+        if not _within_limits(provider_account, provider_limits, charge, now):
+            return False
+
+    return True
+
+
+def record_charge(actor, charge, now=None):
+    """
+    Includes a charge in the local balances. The charge is sent to the
+    RSS when the balance of the actor is synchronized
+    """
+    if now is None:
+        now = datetime.now()
+
+    amount = float(charge['amount'])
+
+    # Ensure the accounts exist
+    account = _load_account(actor.pk, now)
+    _load_account(PROVIDER_ACCOUNT, now)
+
+    _get_collection().update({'_id': actor.pk}, {
+        '$inc': {'pending.' + charge['currency']: amount}
+    })
+
+    # The charges are aggregated per day, so the buckets of the
+    # accounts do not grow with the number of charges
+    day = _get_day(now)
+    buckets = _get_buckets()
+    for account_id in (actor.pk, PROVIDER_ACCOUNT):
+        query = {'account': account_id, 'currency': charge['currency'], 'day': day}
+
+        try:
+            buckets.update(query, {'$inc': {'amount': amount}}, upsert=True)
+        except DuplicateKeyError:
+            # The bucket has been created by a concurrent charge
+            buckets.update(query, {'$inc': {'amount': amount}})
+
+    return account
+
+
+def mark_synced(actor, now=None):
+    """
+    Saves that the RSS has been used to check the balance of an actor,
+    removing the charges that are out of the limit periods
+    """
+    if now is None:
+        now = datetime.now()
+
+    collection = _get_collection()
+    collection.update({'_id': actor.pk}, {'$set': {'synced': now}})
+
+    # Charges were saved in the accounts by previous versions
+    collection.update({'_id': {'$in': [actor.pk, PROVIDER_ACCOUNT]}}, {'$unset': {'charges': ''}}, multi=True)
+
+    _get_buckets().remove({
+        'account': {'$in': [actor.pk, PROVIDER_ACCOUNT]},
+        'day': {'$lt': _get_day(now - HISTORY_PERIOD)}
+    })
+
+
+def _update_balance(rss, charge, actor):
+    try:
+        rss_factory = RSSManagerFactory(rss)
+        exp_manager = rss_factory.get_expenditure_manager(rss.access_token)
+        exp_manager.update_balance(charge, actor)
+    except HTTPError as e:
+        # Check if it is needed to refresh the access token
+        if e.code == 401:
+            rss._refresh_token()
+            exp_manager.set_credentials(rss.access_token)
+            exp_manager.update_balance(charge, actor)
+        else:
+            raise e
+
+
+def sync_balance(rss, actor, now=None):
+    """
+    Sends to the RSS the charges of an actor not included in its balance.
+    The pending amounts are taken atomically, so they are sent only once
+    """
+    if now is None:
+        now = datetime.now()
+
+    collection = _get_collection()
+    account = collection.find_and_modify({'_id': actor.pk}, {'$set': {'pending': {}}})
+
+    if account is None:
+        return
+
+    pending = [(currency, amount) for currency, amount in account['pending'].iteritems() if amount > 0]
+
+    for currency, amount in pending:
+        try:
+            _update_balance(rss, {'currency': currency, 'amount': amount}, actor)
+        except:
+            # Restore the amounts not sent so they are sent again later
+            collection.update({'_id': actor.pk}, {'$inc': dict([
+                ('pending.' + c, a) for c, a in pending[pending.index((currency, amount)):]
+            ])})
+            raise
+
+    mark_synced(actor, now)
+
+
+def sync_pending_balances(rss, now=None):
+    """
+    Sends to the RSS the charges of the actors whose balance has not
+    been synchronized recently, returning the number of actors synchronized
+    """
+    if now is None:
+        now = datetime.now()
+
+    accounts = _get_collection().find({
+        '_id': {'$ne': PROVIDER_ACCOUNT},
+        'pending': {'$ne': {}},
+        '$or': [
+            {'synced': None},
+            {'synced': {'$lt': now - timedelta(seconds=settings.EXPENDITURE_CACHE_TTL)}}
+        ]
+    }, {'_id': True})
+
+    synchronized = 0
+    for account in accounts:
+        try:
+            actor = Organization.objects.get(pk=account['_id'])
+        except Organization.DoesNotExist:
+            continue
+
+        sync_balance(rss, actor, now)
+        synchronized += 1
+
+    return synchronized
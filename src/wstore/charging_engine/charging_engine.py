@@ -24,8 +24,6 @@ import os
 import json
 import time
 import codecs
-import subprocess
-import threading
 from bson import ObjectId
 from urllib2 import HTTPError
 
@@ -33,22 +31,30 @@ from datetime import datetime
 from paypalpy import paypal
 
 from django.conf import settings
-from django.template import loader, Context
+from django.template import Context
 from django.contrib.auth.models import User
 
 from wstore.models import Resource, Organization
-from wstore.models import UserProfile, Context as WStore_context
+from wstore.models import UserProfile
 from wstore.models import Purchase
 from wstore.models import Offering
-from wstore.models import RSS
 from wstore.charging_engine.models import Contract
-from wstore.charging_engine.models import Unit
 from wstore.charging_engine.price_resolver import PriceResolver
+from wstore.charging_engine.invoice_queue import submit_invoice_job
+from wstore.charging_engine.invoice_renderer import get_bill_template
+from wstore.charging_engine.payment_client.client_registry import get_payment_client
+from wstore.charging_engine.timeout_scheduler import schedule_timeout
+from wstore.charging_engine.renovation_scheduler import get_next_renovation
+from wstore.charging_engine.balance_cache import can_charge_locally, record_charge, mark_synced, \
+    sync_balance, is_stale
+from wstore.charging_engine.correlation_allocator import allocate_correlation_numbers
 from wstore.contracting.purchase_rollback import rollback
-from wstore.rss_adaptor.rss_adaptor import RSSAdaptorThread
+from wstore.rss_adaptor.cdr_queue import enqueue_cdrs
 from wstore.rss_adaptor.utils.rss_codes import get_country_code, get_curency_code
 from wstore.rss_adaptor.rss_manager_factory import RSSManagerFactory
+from wstore.charging_engine.sdr_manager import SDRManager, SDR_FIELDS
 from wstore.store_commons.database import get_database_connection
+from wstore.store_commons.config_cache import get_rss, get_unit, get_default_currency
 
 
 class ChargingEngine:
@@ -131,15 +137,8 @@ class ChargingEngine:
 
     def _charge_client(self, price, concept, currency):
 
-        # Load payment client
-        cln_str = settings.PAYMENT_CLIENT
-        client_class = cln_str.split('.')[-1]
-        client_package = cln_str.partition('.' + client_class)[0]
-
-        payment_client = getattr(__import__(client_package, globals(), locals(), [client_class], -1), client_class)
-
-        # build the payment client
-        client = payment_client(self._purchase)
+        # Build the payment client
+        client = get_payment_client(self._purchase)
         price = self._fix_price(price)
 
         if self._payment_method == 'credit_card':
@@ -153,8 +152,7 @@ class ChargingEngine:
 
             if checkout_url:
                 # Set timeout for PayPal transaction to 5 minutes
-                t = threading.Timer(300, self._timeout_handler)
-                t.start()
+                schedule_timeout(self._purchase)
 
                 return checkout_url
             else:
@@ -163,30 +161,14 @@ class ChargingEngine:
             raise Exception('Invalid payment method')
 
     def _generate_cdr_part(self, part, model, cdr_info):
-        # Create connection for raw database access
-        db = get_database_connection()
-
-        # Take and increment the correlation number using
-        # the mongoDB atomic access in order to avoid race
-        # problems
+        # Take the next correlation number of the block
+        # allocated for the charge
+        corr_number = next(cdr_info['correlation_numbers'])
         currency = self._price_model['general_currency']
 
         if cdr_info['rss'].api_version == 1:
-            # Version 1 uses a global correlation number
-            corr_number = db.wstore_rss.find_and_modify(
-                query={'_id': ObjectId(cdr_info['rss'].pk)},
-                update={'$inc': {'correlation_number': 1}}
-            )['correlation_number']
-
             currency = get_curency_code(self._price_model['general_currency'])
 
-        else:
-            # Version 2 uses a correlation number per provider
-            corr_number = db.wstore_organization.find_and_modify(
-                query={'_id': ObjectId(self._purchase.owner_organization.pk)},
-                update={'$inc': {'correlation_number': 1}}
-            )['correlation_number']
-
         return {
             'provider': cdr_info['provider'],
             'service': cdr_info['service_name'],
@@ -213,10 +195,9 @@ class ChargingEngine:
         cdrs = []
 
         # Take the first RSS registered
-        rss_collection = RSS.objects.all()
+        rss = get_rss()
 
-        if len(rss_collection) > 0:
-            rss = RSS.objects.all()[0]
+        if rss is not None:
 
             # Get the provider (Organization)
             if rss.api_version == 1:
@@ -244,8 +225,18 @@ class ChargingEngine:
                 off_model = self._purchase.offering
                 product_class = off_model.owner_organization.name + '/' + off_model.name + '/' + off_model.version
 
+            # Allocate the correlation numbers of all the CDRs in a
+            # single atomic operation
+            if price:
+                cdrs_number = 1
+            else:
+                cdrs_number = sum([len(applied_parts.get(parts, [])) for parts in ('single_payment', 'subscription', 'charges')])
+
+            correlation_numbers = allocate_correlation_numbers(rss, self._purchase.owner_organization, cdrs_number)
+
             cdr_info = {
                 'rss': rss,
+                'correlation_numbers': iter(correlation_numbers),
                 'provider': provider,
                 'service_name': offering,
                 'offering': offering,
@@ -306,9 +297,8 @@ class ChargingEngine:
 
                         cdrs.append(self._generate_cdr_part(use_part, 'Pay per use event', cdr_info))
 
-            # Send the created CDRs to the Revenue Sharing System
-            r = RSSAdaptorThread(rss, cdrs)
-            r.start()
+            # Queue the created CDRs to be sent to the Revenue Sharing System
+            enqueue_cdrs(rss, cdrs)
 
     def _generate_invoice(self, price, applied_parts, type_):
 
@@ -329,7 +319,7 @@ class ChargingEngine:
                     parts['subs_parts'].append((part['label'], part['value'], currency, part['unit'], str(part['renovation_date'])))
 
             # Get the bill template
-            bill_template = loader.get_template('contracting/bill_template_initial.html')
+            bill_template = get_bill_template('initial')
 
         elif type_ == 'renovation':
             parts = {
@@ -390,7 +380,7 @@ class ChargingEngine:
                     parts['deduct_subtotal'] += part['price']
 
             # Get the bill template
-            bill_template = loader.get_template('contracting/bill_template_renovation.html')
+            bill_template = get_bill_template('renovation')
 
         elif type_ == 'use':
             # If use, can only contain pay per use parts or deductions
@@ -441,7 +431,7 @@ class ChargingEngine:
                     parts['deduct_subtotal'] += part['price']
 
             # Get the bill template
-            bill_template = loader.get_template('contracting/bill_template_use.html')
+            bill_template = get_bill_template('use')
 
         tax = self._purchase.tax_address
 
@@ -534,10 +524,22 @@ class ChargingEngine:
             else:
                 context['deduction'] = False
 
+        start = time.time()
         bill_code = bill_template.render(Context(context))
+        render_time = time.time() - start
 
-        # Create the bill code file
+        # Get the name of the bill, which could be in use by a pending
+        # bill or by a failed one whose HTML code is kept
         invoice_name = self._purchase.ref + '_' + date
+        bill_url = os.path.join(settings.MEDIA_URL, 'bills/' + invoice_name + '.pdf')
+
+        if os.path.exists(os.path.join(settings.BILL_ROOT, invoice_name + '.pdf')) or \
+                os.path.exists(os.path.join(settings.BILL_ROOT, invoice_name + '.html')) or \
+                bill_url in self._purchase.pending_bills:
+            invoice_name += '_1'
+            bill_url = os.path.join(settings.MEDIA_URL, 'bills/' + invoice_name + '.pdf')
+
+        # Create the bill code file
         bill_path = os.path.join(settings.BILL_ROOT, invoice_name + '.html')
         f = codecs.open(bill_path, 'wb', 'utf-8')
         f.write(bill_code)
@@ -545,27 +547,14 @@ class ChargingEngine:
 
         in_name = bill_path[:-4] + 'pdf'
 
-        if os.path.exists(in_name):
-            in_name = bill_path[:-5] + '_1.pdf'
-            invoice_name += '_1'
-
-        # Compile the bill file
-        try:
-            subprocess.call([settings.BASEDIR + '/create_invoice.sh', bill_path, in_name])
-        except:
-            raise Exception('Invoice generation problem')
-
-        # Remove temporal files
-        for file_ in os.listdir(settings.BILL_ROOT):
-
-            if not file_.endswith('.pdf'):
-                os.remove(os.path.join(settings.BILL_ROOT, file_))
-
-        # Load bill path into the purchase
-        self._purchase.bill.append(os.path.join(settings.MEDIA_URL, 'bills/' + invoice_name + '.pdf'))
-
+        # The bill is pending until its PDF has been compiled. The purchase
+        # is saved before queuing the job in order not to override the bill
+        # included when the job finishes
+        self._purchase.pending_bills.append(bill_url)
         self._purchase.save()
 
+        submit_invoice_job(self._purchase, bill_path, in_name, bill_url, render_time)
+
     def _create_purchase_contract(self):
         # Generate the pricing model structure
         offering = self._purchase.offering
@@ -614,7 +603,7 @@ class ChargingEngine:
 
                 # Check price component unit
                 try:
-                    unit = Unit.objects.get(name=comp['unit'])
+                    unit = get_unit(comp['unit'])
                 except:
                     raise(Exception, 'Unsupported unit in price plan model')
 
@@ -647,7 +636,7 @@ class ChargingEngine:
                     price_model['deductions'] = []
 
                 if 'price_function' not in deduct:
-                    unit = Unit.objects.get(name=deduct['unit'])
+                    unit = get_unit(deduct['unit'])
 
                     # Deductions only can define use based discounts
                     if unit.defined_model != 'pay per use':
@@ -658,8 +647,7 @@ class ChargingEngine:
         # If not price components or all price components define a
         # function without currency, load default currency
         if 'general_currency' not in price_model:
-            cnt = WStore_context.objects.all()[0]
-            price_model['general_currency'] = cnt.allowed_currencies['default']
+            price_model['general_currency'] = get_default_currency()
 
         # Calculate the revenue sharing class
         revenue_class = None
@@ -674,15 +662,15 @@ class ChargingEngine:
         Contract.objects.create(
             pricing_model=price_model,
             charges=[],
-            applied_sdrs=[],
             purchase=self._purchase,
-            revenue_class=revenue_class
+            revenue_class=revenue_class,
+            sdr_routing=self._build_sdr_routing(price_model)
         )
         self._price_model = price_model
 
     def _calculate_renovation_date(self, unit):
 
-        unit_model = Unit.objects.get(name=unit)
+        unit_model = get_unit(unit)
 
         now = datetime.now()
         # Transform now date into seconds
@@ -693,8 +681,11 @@ class ChargingEngine:
         renovation_date = datetime.fromtimestamp(renovation_date)
         return renovation_date
 
-    def include_sdr(self, sdr):
-        # Check the offering and customer
+    def _check_sdr_actors(self, sdr):
+        """
+        Checks that the offering and the customer of an SDR
+        are the ones of the purchase
+        """
         off_data = sdr['offering']
         org = Organization.objects.get(name=off_data['organization'])
         offering = Offering.objects.get(name=off_data['name'], owner_organization=org, version=off_data['version'])
@@ -721,33 +712,108 @@ class ChargingEngine:
             if customer != self._purchase.customer:
                 raise Exception('The user has not purchased the offering')
 
-        # Extract the pricing model from the purchase
-        self._price_model = self._purchase.contract.pricing_model
+    def _get_last_sdr_info(self):
+        """
+        Returns the correlation number and the time stamp (in seconds)
+        of the last SDR included in the contract
+        """
+        last_corr = 0
+        last_time = 0
 
-        if 'pay_per_use' not in self._price_model:
-            raise Exception('No pay per use parts in the pricing model of the offering')
+        last_sdr = SDRManager(self._purchase.contract).get_last_sdr()
 
-        # Check the correlation number and timestamp
-        applied_sdrs = self._purchase.contract.applied_sdrs
-        pending_sdrs = self._purchase.contract.pending_sdrs
+        if last_sdr is not None:
+            last_corr = int(last_sdr['correlation_number'])
+            last_time = time.mktime(last_sdr['time_stamp'].timetuple())
+
+        return last_corr, last_time
+
+    def _get_last_correlation(self, accounting):
+        """
+        Returns the greatest correlation number of the SDRs
+        included in the applied accounting info
+        """
         last_corr = 0
-        last_time = 0
+        for part in accounting['charges'] + accounting['deductions']:
+            for sdr in part['accounting']:
+                last_corr = max(last_corr, int(sdr['correlation_number']))
 
-        if len(pending_sdrs) > 0:
-            last_corr = int(pending_sdrs[-1]['correlation_number'])
-            last_time = pending_sdrs[-1]['time_stamp']
-            last_time = time.mktime(last_time.timetuple())
-        else:
-            if len(applied_sdrs) > 0:
-                last_corr = int(applied_sdrs[-1]['correlation_number'])
-                last_time = applied_sdrs[-1]['time_stamp']
-                last_time = time.mktime(last_time.timetuple())
+        return last_corr
 
+    def _parse_sdr_time_stamp(self, sdr):
         try:
             time_stamp = datetime.strptime(sdr['time_stamp'], '%Y-%m-%dT%H:%M:%S.%f')
         except:
             time_stamp = datetime.strptime(sdr['time_stamp'], '%Y-%m-%d %H:%M:%S.%f')
 
+        return time_stamp
+
+    def _build_sdr_routing(self, price_model):
+        """
+        Builds the lists of units and usage labels consumed by the pay
+        per use components and deductions of a pricing model. Units and
+        labels are provider defined, so they are saved as list values
+        instead of keys of the contract document
+        """
+        units = set()
+        labels = set()
+
+        for part in ('pay_per_use', 'deductions'):
+            for comp in price_model.get(part, []):
+                if 'price_function' not in comp:
+                    units.add(comp['unit'])
+                else:
+                    labels.update([var['label'] for var in comp['price_function']['variables'].itervalues()
+                                   if var['type'] == 'usage'])
+
+        return {
+            'units': sorted(units),
+            'labels': sorted(labels)
+        }
+
+    def _get_sdr_routing(self, contract):
+        """
+        Returns the SDR routing saved in a contract when it was created.
+        Contracts created before it was introduced get it built and
+        saved the first time an SDR is received
+        """
+        if not contract.sdr_routing:
+            contract.sdr_routing = self._build_sdr_routing(contract.pricing_model)
+
+            db = get_database_connection()
+            db.charging_engine_contract.update(
+                {'_id': ObjectId(contract.pk)},
+                {'$set': {'sdr_routing': contract.sdr_routing}}
+            )
+
+        return contract.sdr_routing
+
+    def _check_sdr_model(self, sdr):
+        """
+        Checks that the unit or the component label of an SDR is
+        used by any pay per use component or deduction
+        """
+        if sdr['unit'] not in self._sdr_routing['units'] and \
+                sdr['component_label'] not in self._sdr_routing['labels']:
+            raise Exception('The specified unit or component label is not included in the pricing model')
+
+    def include_sdr(self, sdr):
+        # Check the offering and customer
+        self._check_sdr_actors(sdr)
+
+        # Extract the pricing model from the purchase
+        contract = self._purchase.contract
+        self._price_model = contract.pricing_model
+
+        if 'pay_per_use' not in self._price_model:
+            raise Exception('No pay per use parts in the pricing model of the offering')
+
+        self._sdr_routing = self._get_sdr_routing(contract)
+
+        # Check the correlation number and timestamp
+        last_corr, last_time = self._get_last_sdr_info()
+
+        time_stamp = self._parse_sdr_time_stamp(sdr)
         time_stamp_sec = time.mktime(time_stamp.timetuple())
 
         if (int(sdr['correlation_number']) != last_corr + 1):
@@ -756,42 +822,92 @@ class ChargingEngine:
         if last_time > time_stamp_sec:
             raise Exception('Invalid time stamp')
 
-        # Check unit or component_label depending if the model defines components or
-        # price functions
-        found_model = False
-        for comp in self._price_model['pay_per_use']:
-            if 'price_function' not in comp:
-                if sdr['unit'] == comp['unit']:
-                    found_model = True
-                    break
-            else:
-                for k, var in comp['price_function']['variables'].iteritems():
-                    if var['type'] == 'usage' and var['label'] == sdr['component_label']:
-                        found_model = True
-                        break
+        self._check_sdr_model(sdr)
 
-        # Check if any deduction depends on the sdr variable
-        found_deduction = False
-        if 'deductions' in self._price_model:
-            for comp in self._price_model['deductions']:
-                if 'price_function' not in comp:
-                    if sdr['unit'] == comp['unit']:
-                        found_deduction = True
-                        break
-                else:
-                    for k, var in comp['price_function']['variables'].iteritems():
-                        if var['type'] == 'usage' and var['label'] == sdr['component_label']:
-                            found_deduction = True
-                            break
+        # Store the SDR
+        sdr['time_stamp'] = time_stamp
+        SDRManager(self._purchase.contract).include_sdrs([sdr])
+
+    def include_sdrs(self, sdrs):
+        """
+        Includes a batch of SDRs in the contract using a single
+        insert. SDRs are validated in order, so once an SDR is rejected
+        the following ones are rejected by its correlation number.
+        Returns a list with the result of every SDR.
+        """
+        contract = self._purchase.contract
+
+        # Extract the pricing model from the purchase
+        self._price_model = contract.pricing_model
+
+        if 'pay_per_use' not in self._price_model:
+            raise Exception('No pay per use parts in the pricing model of the offering')
+
+        self._sdr_routing = self._get_sdr_routing(contract)
+        last_corr, last_time = self._get_last_sdr_info()
+
+        # Offering and customer checks are made once per different pair
+        checked_actors = {}
+        accepted = []
+        results = []
+
+        for sdr in sdrs:
+            corr_number = None
+            try:
+                if not isinstance(sdr, dict):
+                    raise Exception('Invalid JSON content')
+
+                for field in SDR_FIELDS:
+                    if field not in sdr:
+                        raise Exception('Invalid JSON content')
+
+                corr_number = sdr['correlation_number']
+
+                off_data = sdr['offering']
+                actors_key = (off_data['organization'], off_data['name'], off_data['version'], sdr['customer'])
+
+                if actors_key not in checked_actors:
+                    try:
+                        self._check_sdr_actors(sdr)
+                        checked_actors[actors_key] = None
+                    except Exception as e:
+                        checked_actors[actors_key] = unicode(e)
+
+                if checked_actors[actors_key] is not None:
+                    raise Exception(checked_actors[actors_key])
+
+                time_stamp = self._parse_sdr_time_stamp(sdr)
+                time_stamp_sec = time.mktime(time_stamp.timetuple())
+
+                if (int(corr_number) != last_corr + 1):
+                    raise Exception('Invalid correlation number, expected: ' + str(last_corr + 1))
+
+                if last_time > time_stamp_sec:
+                    raise Exception('Invalid time stamp')
+
+                self._check_sdr_model(sdr)
+            except Exception as e:
+                results.append({
+                    'correlation_number': corr_number,
+                    'result': 'error',
+                    'message': unicode(e)
+                })
+                continue
 
-        if found_model or found_deduction:
-            # Store the SDR
             sdr['time_stamp'] = time_stamp
-            self._purchase.contract.pending_sdrs.append(sdr)
-        else:
-            raise Exception('The specified unit or component label is not included in the pricing model')
+            accepted.append(sdr)
+
+            last_corr = int(corr_number)
+            last_time = time_stamp_sec
+
+            results.append({
+                'correlation_number': corr_number,
+                'result': 'correct'
+            })
+
+        SDRManager(contract).include_sdrs(accepted)
 
-        self._purchase.contract.save()
+        return results
 
     def _check_expenditure_limits(self, price):
         """
@@ -799,10 +915,9 @@ class ChargingEngine:
         expenditure limits and ir accumulated balance thought the RSS
         """
         # Check is an RSS instance is registered
-        if not RSS.objects.all():
+        rss = get_rss()
+        if rss is None:
             return
-        else:
-            rss = RSS.objects.all()[0]
 
         actor = None
         # Check who is the charging actor (user or organization)
@@ -817,6 +932,14 @@ class ChargingEngine:
             'amount': price
         }
 
+        # Charges far from the limits are accepted using the local balances
+        if can_charge_locally(actor, charge, rss.expenditure_limits):
+            self._expenditure_used = True
+            return
+
+        # The RSS must know all the charges of the actor
+        sync_balance(rss, actor)
+
         # Check balance
         request_failure = None
         try:
@@ -849,10 +972,11 @@ class ChargingEngine:
             else:
                 raise request_failure
 
+        mark_synced(actor)
         self._expenditure_used = True
 
     def _update_actor_balance(self, price):
-        rss = RSS.objects.all()[0]
+        rss = get_rss()
 
         actor = None
         # Check who is the charging actor (user or organization)
@@ -867,20 +991,12 @@ class ChargingEngine:
             'amount': price
         }
 
-        # Check balance
-        try:
-            rss_factory = RSSManagerFactory(rss)
-            exp_manager = rss_factory.get_expenditure_manager(rss.access_token)
-            exp_manager.update_balance(charge, actor)
-        except HTTPError as e:
-            # Check if it is needed to refresh the access token
-            if e.code == 401:
-                rss._refresh_token()
-                exp_manager.set_credentials(rss.access_token)
-                exp_manager.update_balance(charge, actor)
-            # Check if the error is due to an insufficient balance
-            else:
-                raise e
+        # The charge is sent to the RSS when the actor balance is synchronized,
+        # which is done at this point if it has not been done recently
+        account = record_charge(actor, charge)
+
+        if is_stale(account):
+            sync_balance(rss, actor)
 
     def end_charging(self, price, concept, related_model, accounting=None):
 
@@ -924,6 +1040,7 @@ class ChargingEngine:
                 # Update price model in contract
                 contract.pricing_model = self._price_model
                 related_model['subscription'] = updated_subscriptions
+                contract.next_renovation = get_next_renovation(self._price_model)
 
             # Generate the invoice
             self._generate_invoice(price, related_model, 'initial')
@@ -940,19 +1057,23 @@ class ChargingEngine:
             self._price_model['subscription'] = updated_subscriptions
             contract.pricing_model = self._price_model
             related_model['subscription'] = updated_subscriptions
+            contract.next_renovation = get_next_renovation(self._price_model)
+
+            # The failed attempts of the scheduled renovation are restarted
+            contract.renovation_attempts = 0
+            contract.renovation_state = None
+            contract.renovation_claim = {}
 
             if accounting:
                 related_model['charges'] = accounting['charges']
                 related_model['deductions'] = accounting['deductions']
-                contract.applied_sdrs.extend(contract.pending_sdrs)
-                contract.pending_sdrs = []
+                SDRManager(contract).apply_sdrs(self._get_last_correlation(accounting))
 
             self._generate_invoice(price, related_model, 'renovation')
 
         elif concept == 'pay per use':
             # Move SDR from pending to applied
-            contract.applied_sdrs.extend(contract.pending_sdrs)
-            contract.pending_sdrs = []
+            SDRManager(contract).apply_sdrs(self._get_last_correlation(accounting))
             # Generate the invoice
             self._generate_invoice(price, accounting, 'use')
             related_model['charges'] = accounting['charges']
@@ -1042,10 +1163,10 @@ class ChargingEngine:
 
                 accounting_info = None
                 # If pending SDR documents resolve the use charging
-                if len(self._purchase.contract.pending_sdrs) > 0:
+                pending_sdrs = SDRManager(self._purchase.contract).get_pending_sdrs()
+                if len(pending_sdrs) > 0:
                     related_model['pay_per_use'] = self._price_model['pay_per_use']
-                    accounting_info = []
-                    accounting_info.extend(self._purchase.contract.pending_sdrs)
+                    accounting_info = pending_sdrs
 
                 # If deductions have been included resolve the discount
                 if 'deductions' in self._price_model and len(self._price_model['deductions']) > 0:
@@ -1092,8 +1213,7 @@ class ChargingEngine:
             # made of a service.
             else:
                 # Aggregate the calculated charges
-                pending_sdrs = []
-                pending_sdrs.extend(self._purchase.contract.pending_sdrs)
+                pending_sdrs = SDRManager(self._purchase.contract).get_pending_sdrs()
 
                 if len(pending_sdrs) == 0:
                     raise Exception('No SDRs to charge')
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+
+from __future__ import absolute_import
+
+import threading
+from bson import ObjectId
+
+from django.conf import settings
+
+from wstore.store_commons.database import get_database_connection
+
+
+def _reserve_block(collection, pk, size):
+    """
+    Reserves a contiguous block of correlation numbers using a single
+    atomic increment, returning the first number of the block
+    """
+    return collection.find_and_modify(
+        query={'_id': ObjectId(pk)},
+        update={'$inc': {'correlation_number': size}}
+    )['correlation_number']
+
+
+class RSSCorrelationReserve():
+    """
+    Block of correlation numbers of the API v1 RSS reserved by this
+    process, used to reduce the writes to the RSS document. The numbers
+    remaining in the block when the process ends are not used
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blocks = {}
+
+    def allocate(self, rss, size):
+        with self._lock:
+            next_number, end = self._blocks.get(rss.pk, (0, 0))
+
+            if end - next_number < size:
+                block_size = max(size, settings.CDR_CORRELATION_RESERVE)
+                next_number = _reserve_block(get_database_connection().wstore_rss, rss.pk, block_size)
+                end = next_number + block_size
+
+            self._blocks[rss.pk] = (next_number + size, end)
+
+        return next_number
+
+
+_rss_reserve = RSSCorrelationReserve()
+
+
+def allocate_correlation_numbers(rss, organization, size):
+    """
+    Returns a list with size consecutive correlation numbers. API v1 uses
+    a global correlation number saved in the RSS while API v2 uses a
+    correlation number per organization
+    """
+    if size == 0:
+        return []
+
+    db = get_database_connection()
+
+    if rss.api_version == 1:
+        if settings.CDR_CORRELATION_RESERVE > 1:
+            start = _rss_reserve.allocate(rss, size)
+        else:
+            start = _reserve_block(db.wstore_rss, rss.pk, size)
+    else:
+        start = _reserve_block(db.wstore_organization, organization.pk, size)
+
+    return range(start, start + size)
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import absolute_import
+
+import os
+import Queue
+import logging
+import threading
+from bson import ObjectId
+from datetime import datetime, timedelta
+
+from django.conf import settings
+
+from wstore.charging_engine.invoice_renderer import convert_invoices
+from wstore.store_commons.database import get_database_connection
+
+
+# Time given to a worker to process a job before it can be claimed again
+JOB_TIMEOUT = timedelta(minutes=10)
+MAX_JOB_ATTEMPTS = 3
+
+logger = logging.getLogger(__name__)
+
+_jobs = Queue.Queue()
+_workers = []
+_workers_lock = threading.Lock()
+
+
+def _get_collection():
+    return get_database_connection().charging_engine_invoicejob
+
+
+def _claimable_query(now):
+    """
+    Returns the query of the jobs that can be claimed: the pending
+    ones, the running ones whose worker has not finished them in time
+    and the failed ones that have not run out of attempts
+    """
+    return {'$or': [
+        {'state': 'pending'},
+        {'state': 'running', 'claimed': {'$lt': now - JOB_TIMEOUT}},
+        {'state': 'running', 'claimed': None},
+        {'state': 'failed', 'attempts': {'$lt': MAX_JOB_ATTEMPTS}}
+    ]}
+
+
+def _claim_job(job_id=None):
+    """
+    Reserves a claimable job, the given one or any of them if not
+    provided. The job is claimed atomically so it is processed only once
+    """
+    now = datetime.now()
+    query = _claimable_query(now)
+    if job_id is not None:
+        query['_id'] = job_id
+
+    return _get_collection().find_and_modify(query, {
+        '$set': {'state': 'running', 'claimed': now},
+        '$inc': {'attempts': 1}
+    }, sort={'_id': 1}, new=True)
+
+
+def process_invoice_jobs(job_ids=None, batch_size=None):
+    """
+    Compiles the PDF of a batch of invoices using a single converter
+    process and moves their URLs from the pending bills of the purchases
+    to their bills. If no jobs are provided, a batch of pending jobs is
+    loaded. Failed jobs are retried until they run out of attempts.
+    Returns the generated jobs, including the time taken rendering the
+    HTML and compiling the PDF of every invoice, and the failed ones
+    """
+    if job_ids is not None:
+        claimed = [_claim_job(job_id) for job_id in job_ids]
+        jobs = [job for job in claimed if job is not None]
+    else:
+        jobs = []
+        while len(jobs) < (batch_size or settings.INVOICE_BATCH_SIZE):
+            job = _claim_job()
+
+            if job is None:
+                break
+
+            jobs.append(job)
+
+    if len(jobs) == 0:
+        return [], []
+
+    try:
+        elapsed, generated = convert_invoices([(job['bill_path'], job['pdf_path']) for job in jobs])
+    except:
+        elapsed, generated = 0, [False] * len(jobs)
+
+    collection = _get_collection()
+    purchases = get_database_connection().wstore_purchase
+    processed = []
+    failed = []
+
+    for job, pdf_generated in zip(jobs, generated):
+        if not pdf_generated:
+            _fail_job(job)
+            failed.append(job)
+            continue
+
+        # The job could have been claimed again if this worker has
+        # taken too long, in that case the bill is included by the new one
+        result = collection.remove({'_id': job['_id'], 'claimed': job['claimed']})
+        if result['n'] == 0:
+            continue
+
+        purchases.update({'_id': job['purchase_id']}, {
+            '$pull': {'pending_bills': job['url']},
+            '$push': {'bill': job['url']}
+        })
+
+        # The compilation time is shared by the invoices of the batch
+        job['pdf_time'] = elapsed / len(jobs)
+        processed.append(job)
+
+    _remove_bill_files(processed)
+    return processed, failed
+
+
+def _fail_job(job):
+    _get_collection().update({'_id': job['_id'], 'claimed': job['claimed']}, {'$set': {'state': 'failed'}})
+
+    if job['attempts'] >= MAX_JOB_ATTEMPTS:
+        # The bill is not pending anymore, the HTML code is kept so the
+        # invoice can be generated again with retry_failed_jobs
+        get_database_connection().wstore_purchase.update({'_id': job['purchase_id']}, {
+            '$pull': {'pending_bills': job['url']}
+        })
+        logger.error('Invoice job %s (%s) has failed %d times, use generate_invoices --retry-failed to generate it again',
+                     job['_id'], job['url'], job['attempts'])
+
+
+def retry_failed_jobs():
+    """
+    Restarts the attempts of the jobs that have failed permanently so
+    they are generated again, returning the number of restarted jobs
+    """
+    result = _get_collection().update(
+        {'state': 'failed', 'attempts': {'$gte': MAX_JOB_ATTEMPTS}},
+        {'$set': {'attempts': 0}},
+        multi=True
+    )
+    return result['n']
+
+
+def _remove_bill_files(jobs):
+    # Remove the temporal files created for these invoices
+    for job in jobs:
+        if os.path.exists(job['bill_path']):
+            os.remove(job['bill_path'])
+
+
+def process_invoice_job(job_id):
+    processed, failed = process_invoice_jobs([job_id])
+
+    if len(failed) > 0:
+        raise Exception('Invoice generation problem')
+
+
+class InvoiceWorker(threading.Thread):
+    """
+    Worker of the pool that generates the PDF of the invoices queued
+    by the charging engine. The jobs queued at the same time are
+    compiled in batches
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def run(self):
+        while True:
+            job_ids = [_jobs.get()]
+
+            try:
+                while len(job_ids) < settings.INVOICE_BATCH_SIZE:
+                    job_ids.append(_jobs.get_nowait())
+            except Queue.Empty:
+                pass
+
+            try:
+                process_invoice_jobs(job_ids)
+            except:
+                pass
+            finally:
+                for job_id in job_ids:
+                    _jobs.task_done()
+
+
+def _start_workers():
+    with _workers_lock:
+        # Queue the jobs not processed by previous workers
+        if len(_workers) == 0:
+            for job in _get_collection().find(_claimable_query(datetime.now()), {'_id': True}):
+                _jobs.put(job['_id'])
+
+        # Keep a fixed number of workers alive
+        _workers[:] = [worker for worker in _workers if worker.is_alive()]
+
+        while len(_workers) < settings.INVOICE_WORKERS:
+            worker = InvoiceWorker()
+            worker.start()
+            _workers.append(worker)
+
+
+def submit_invoice_job(purchase, bill_path, pdf_path, url, render_time=None):
+    """
+    Queues the generation of the PDF of an invoice whose HTML code
+    has been saved in bill_path. The URL of the invoice must have been
+    included in the pending bills of the purchase
+    """
+    job_id = _get_collection().insert({
+        'purchase_id': ObjectId(purchase.pk),
+        'bill_path': bill_path,
+        'pdf_path': pdf_path,
+        'url': url,
+        'state': 'pending',
+        'created': datetime.now(),
+        'render_time': render_time
+    })
+
+    if settings.ASYNC_INVOICE_GENERATION:
+        _start_workers()
+        _jobs.put(job_id)
+    else:
+        process_invoice_job(job_id)
+
+    return job_id
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import absolute_import
+
+import os
+import time
+import subprocess
+
+from django.conf import settings
+from django.template import loader
+
+
+_templates = {}
+
+
+def get_bill_template(type_):
+    """
+    Returns the template of the bills of the given type (initial,
+    renovation or use). Templates are compiled only once per process
+    """
+    if type_ not in _templates:
+        _templates[type_] = loader.get_template('contracting/bill_template_' + type_ + '.html')
+
+    return _templates[type_]
+
+
+def _quote_path(path):
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+
+    return '"' + path.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def convert_invoices(invoices):
+    """
+    Compiles the PDF of a list of (html_path, pdf_path) invoices using
+    a single converter process. Returns the time it has taken and, for
+    every invoice, whether its PDF file has been generated
+    """
+    args = ''.join([_quote_path(html_path) + ' ' + _quote_path(pdf_path) + '\n' for html_path, pdf_path in invoices])
+
+    start = time.time()
+    converter = subprocess.Popen([settings.BASEDIR + '/create_invoice.sh', '--batch'], stdin=subprocess.PIPE)
+    converter.communicate(args)
+    elapsed = time.time() - start
+
+    # The converter can fail with some of the invoices of the batch,
+    # so the result of every invoice is checked
+    return elapsed, [os.path.exists(pdf_path) for html_path, pdf_path in invoices]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+
+from django.core.management.base import BaseCommand
+
+from wstore.charging_engine.timeout_scheduler import process_expired_timeouts
+
+
+class Command(BaseCommand):
+
+    help = 'Rolls back the purchases whose redirection payment has expired'
+
+    def handle(self, *args, **options):
+        """
+            This method is used to handle the expired timeouts of the
+            pending payments, including the ones scheduled by processes
+            that are not running anymore
+        """
+        expired = 0
+        processed = process_expired_timeouts()
+
+        while processed > 0:
+            expired += processed
+            processed = process_expired_timeouts()
+
+        self.stdout.write(str(expired) + ' expired payments have been processed\n')
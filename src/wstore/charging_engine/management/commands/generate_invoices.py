@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from wstore.charging_engine.invoice_queue import process_invoice_jobs, retry_failed_jobs
+
+
+class Command(BaseCommand):
+
+    help = 'Generates the PDF of the pending invoices'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+                action='store',
+                type='int',
+                dest='batch_size',
+                default=None,
+                help='Number of invoices compiled by every converter process'),
+        make_option('--retry-failed',
+                action='store_true',
+                dest='retry_failed',
+                default=False,
+                help='Generate again the invoices that have run out of attempts'),
+    )
+
+    def _write_timing(self, job):
+        timing = 'compiled in %.3f s' % job['pdf_time']
+
+        if job.get('render_time') is not None:
+            timing = 'rendered in %.3f s, ' % job['render_time'] + timing
+
+        self.stdout.write(job['url'] + ': ' + timing + '\n')
+
+    def handle(self, *args, **options):
+        """
+            This method is used to generate the invoices queued by
+            processes that are not running anymore, reporting the
+            time taken by every invoice
+        """
+        batch_size = options.get('batch_size') or settings.INVOICE_BATCH_SIZE
+
+        if batch_size < 1:
+            raise Exception('The batch size must be greater than 0')
+
+        if options.get('retry_failed'):
+            self.stdout.write(str(retry_failed_jobs()) + ' failed invoices will be generated again\n')
+
+        generated = 0
+        failed = 0
+        processed, failed_jobs = process_invoice_jobs(batch_size=batch_size)
+
+        # A failed invoice does not stop the generation of the others
+        while len(processed) > 0 or len(failed_jobs) > 0:
+            for job in processed:
+                self._write_timing(job)
+
+            for job in failed_jobs:
+                self.stdout.write(job['url'] + ': failed (attempt ' + str(job['attempts']) + ')\n')
+
+            generated += len(processed)
+            failed += len(failed_jobs)
+            processed, failed_jobs = process_invoice_jobs(batch_size=batch_size)
+
+        self.stdout.write(str(generated) + ' invoices have been generated\n')
+
+        if failed > 0:
+            self.stdout.write(str(failed) + ' invoice generation attempts have failed\n')
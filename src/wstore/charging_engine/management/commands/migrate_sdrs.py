@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+
+from wstore.charging_engine.models import Contract
+from wstore.charging_engine.sdr_manager import SDRManager
+from wstore.store_commons.database import get_database_connection
+
+
+def _parse_time_stamps(sdrs):
+    for sdr in sdrs:
+        if isinstance(sdr['time_stamp'], basestring):
+            try:
+                sdr['time_stamp'] = datetime.strptime(sdr['time_stamp'], '%Y-%m-%d %H:%M:%S.%f')
+            except:
+                sdr['time_stamp'] = datetime.strptime(sdr['time_stamp'], '%Y-%m-%d %H:%M:%S')
+
+    return sdrs
+
+
+class Command(BaseCommand):
+
+    help = 'Moves the SDRs stored in the contract documents to the service record collection'
+
+    def handle(self, *args, **options):
+        """
+            This method is used to migrate the SDRs saved in the
+            applied_sdrs and pending_sdrs lists of the contracts. It
+            should be executed while no accounting info is being received
+        """
+        db = get_database_connection()
+
+        # Only the contracts with any SDR are loaded
+        contracts = db.charging_engine_contract.find({
+            '$or': [
+                {'applied_sdrs.0': {'$exists': True}},
+                {'pending_sdrs.0': {'$exists': True}}
+            ]
+        }, {'applied_sdrs': True, 'pending_sdrs': True})
+
+        migrated = 0
+        for contract in contracts:
+            sdr_manager = SDRManager(Contract(pk=contract['_id']))
+            sdr_manager.import_sdrs(
+                _parse_time_stamps(contract.get('applied_sdrs', [])),
+                _parse_time_stamps(contract.get('pending_sdrs', []))
+            )
+
+            # Remove the SDRs from the contract document
+            db.charging_engine_contract.update(
+                {'_id': contract['_id']},
+                {'$set': {'applied_sdrs': [], 'pending_sdrs': []}}
+            )
+            migrated += 1
+
+        self.stdout.write('The SDRs of ' + str(migrated) + ' contracts have been migrated\n')
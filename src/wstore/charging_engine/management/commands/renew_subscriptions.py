@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from wstore.charging_engine.renovation_scheduler import process_due_renovations, \
+    get_renovation_forecast, update_next_renovations
+from wstore.rss_adaptor.cdr_queue import send_pending_cdrs
+
+
+class Command(BaseCommand):
+
+    help = 'Renovates the subscriptions whose renovation date has been reached'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+                action='store',
+                type='int',
+                dest='batch_size',
+                default=100,
+                help='Number of contracts renovated in every batch'),
+        make_option('--dry-run',
+                action='store_true',
+                dest='dry_run',
+                default=False,
+                help='Report the renovations due every day without charging them'),
+        make_option('--days',
+                action='store',
+                type='int',
+                dest='days',
+                default=7,
+                help='Number of days included in the dry run report'),
+        make_option('--update',
+                action='store_true',
+                dest='update',
+                default=False,
+                help='Calculate the next renovation of the contracts created by previous versions'),
+    )
+
+    def _write_forecast(self, days):
+        for day, renovations in get_renovation_forecast(days):
+            self.stdout.write(day.isoformat() + ': ' + str(renovations) + ' renovations\n')
+
+    def handle(self, *args, **options):
+        """
+            This method is used to charge the due subscriptions in order
+            of renovation date, processing the contracts in batches
+        """
+        if options.get('update', False):
+            updated = update_next_renovations()
+            self.stdout.write('The next renovation of ' + str(updated) + ' contracts has been calculated\n')
+
+        if options.get('dry_run', False):
+            self._write_forecast(options.get('days', 7))
+            return
+
+        batch_size = options.get('batch_size', 100)
+        if batch_size < 1:
+            raise Exception('The batch size must be greater than 0')
+
+        renovated = 0
+        failed = []
+        results = process_due_renovations(batch_size)
+
+        while len(results) > 0:
+            renovated += len([result for contract_id, result in results if result == 'renovated'])
+            failed.extend([(contract_id, result) for contract_id, result in results if result != 'renovated'])
+            results = process_due_renovations(batch_size)
+
+        # Send the CDRs of the charges before the process ends
+        send_pending_cdrs()
+
+        self.stdout.write('Renovated contracts: ' + str(renovated) + '\n')
+        self.stdout.write('Failed contracts: ' + str(len(failed)) + '\n')
+
+        for contract_id, result in failed:
+            self.stdout.write('Contract ' + str(contract_id) + ' ' + result + '\n')
@@ -19,49 +19,238 @@
 # If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
 
 import time
-
-from datetime import datetime
+from bson import ObjectId
+from datetime import datetime, timedelta
+from itertools import imap
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+from pymongo.errors import DuplicateKeyError
 
 from django.core.management.base import BaseCommand
 
 from wstore.charging_engine.charging_engine import ChargingEngine
 from wstore.charging_engine.models import Contract
-from wstore.models import Organization
+from wstore.charging_engine.sdr_manager import SDRManager, get_contracts_with_pending_sdrs
 from wstore.contracting.models import Purchase
+from wstore.rss_adaptor.cdr_queue import send_pending_cdrs
+from wstore.store_commons.database import get_database_connection
+
+
+# Time that the SDRs of a contract can remain pending
+CHARGING_CYCLE = timedelta(days=30)
+
+# Time that a run is owned by the process executing it without
+# updating its progress, after that the run can be resumed
+RUN_LEASE = timedelta(minutes=15)
+
+
+class ChargingCheckpoint():
+    """
+    Saves the progress of a charging run, so if the run is interrupted
+    the next execution resumes it without charging again the contracts
+    already processed. The run is owned by a single process while its
+    lease is alive, so concurrent executions do not charge twice
+    """
+
+    _collection = None
+    _run = None
+    _owner = None
+    _done = None
+
+    def __init__(self):
+        self._collection = get_database_connection().charging_engine_chargingrun
+
+    @property
+    def cycle_end(self):
+        return self._run['cycle_end']
+
+    def start(self, now):
+        """
+        Claims the unfinished run if its lease has expired or creates a
+        new one, returning whether an interrupted run is resumed
+        """
+        self._owner = ObjectId()
+
+        self._run = self._collection.find_and_modify(
+            query={'state': 'running', '$or': [{'lease': {'$lt': now}}, {'lease': {'$exists': False}}]},
+            update={'$set': {'owner': self._owner, 'lease': now + RUN_LEASE, 'active': True}},
+            new=True
+        )
+        resumed = self._run is not None
+
+        if not resumed:
+            # The running run has a live lease, so it is being processed
+            if self._collection.find_one({'state': 'running'}) is not None:
+                raise Exception('Another charging run is in progress')
+
+            self._run = {
+                'cycle_end': now - CHARGING_CYCLE,
+                'state': 'running',
+                'owner': self._owner,
+                'lease': now + RUN_LEASE,
+                'active': True,
+                'processed': [],
+                'in_progress': [],
+                'failed': []
+            }
+
+            # Only one run can be active, which is ensured by a unique index
+            try:
+                self._run['_id'] = self._collection.insert(self._run)
+            except DuplicateKeyError:
+                raise Exception('Another charging run is in progress')
+
+        self._done = set(self._run['processed'] + self._run['in_progress'] + self._run['failed'])
+        return resumed
+
+    def get_interrupted(self):
+        """
+        Returns the contracts whose charging was in progress when the
+        previous run was interrupted. They cannot be charged again
+        automatically since the payment could have been done
+        """
+        return self._run['in_progress']
+
+    def is_done(self, contract_id):
+        return contract_id in self._done
+
+    def _update(self, update):
+        """
+        Updates the run renewing its lease, returning False if
+        the run has been claimed by another process
+        """
+        update.setdefault('$set', {})['lease'] = datetime.now() + RUN_LEASE
+        result = self._collection.update({'_id': self._run['_id'], 'owner': self._owner}, update)
+
+        return result['n'] > 0
+
+    def begin(self, contract_id):
+        return self._update({
+            '$addToSet': {'in_progress': contract_id}
+        })
+
+    def end(self, contract_id, failed=False):
+        self._update({
+            '$pull': {'in_progress': contract_id},
+            '$addToSet': {'failed' if failed else 'processed': contract_id}
+        })
+
+    def finish(self):
+        self._collection.update({'_id': self._run['_id'], 'owner': self._owner}, {
+            '$set': {'state': 'finished', 'finished': datetime.now()},
+            '$unset': {'active': True, 'lease': True}
+        })
+
+
+def _charge_purchase(purchase):
+    # Get the related payment info
+    if purchase.organization_owned:
+        payment_info = purchase.owner_organization.payment_info
+    else:
+        payment_info = purchase.customer.userprofile.payment_info
+
+    charging = ChargingEngine(purchase, payment_method='credit_card', credit_card=payment_info)
+    charging.resolve_charging(sdr=True)
 
 
 class Command(BaseCommand):
 
+    option_list = BaseCommand.option_list + (
+        make_option('--workers',
+                action='store',
+                type='int',
+                dest='workers',
+                default=1,
+                help='Number of contracts charged concurrently'),
+    )
+
+    _checkpoint = None
+
+    def _charge_contract(self, contract_id):
+        """
+        Charges the pending SDRs of a contract, returning the
+        result of the process and the time it has taken
+        """
+        start = time.time()
+
+        try:
+            contract = Contract.objects.get(pk=str(contract_id))
+
+            # If there are subscriptions the renovations are used as triggers
+            if 'subscription' in contract.pricing_model:
+                return 'skipped', time.time() - start
+
+            # The run can be lost if the lease has expired
+            if not self._checkpoint.begin(contract_id):
+                return 'skipped', time.time() - start
+
+            _charge_purchase(contract.purchase)
+        except Exception as e:
+            self._checkpoint.end(contract_id, failed=True)
+            return 'failed: ' + unicode(e), time.time() - start
+
+        self._checkpoint.end(contract_id)
+        return 'charged', time.time() - start
+
+    def _write_summary(self, results, elapsed):
+        charged = [latency for result, latency in results if result == 'charged']
+        failed = [result for result, latency in results if result.startswith('failed')]
+
+        self.stdout.write('Charged contracts: ' + str(len(charged)) + '\n')
+        self.stdout.write('Failed contracts: ' + str(len(failed)) + '\n')
+        self.stdout.write('Elapsed time: %.2f s\n' % elapsed)
+
+        if len(charged) > 0:
+            self.stdout.write('Throughput: %.2f contracts/s\n' % (len(charged) / max(elapsed, 0.001)))
+            self.stdout.write('Latency: %.3f s average, %.3f s max\n' % (sum(charged) / len(charged), max(charged)))
+
+        for result in failed:
+            self.stdout.write(result + '\n')
+
+    def _resolve_charging(self, workers):
+        self._checkpoint = ChargingCheckpoint()
+
+        if self._checkpoint.start(datetime.now()):
+            self.stdout.write('Resuming interrupted charging run\n')
+
+            for contract_id in self._checkpoint.get_interrupted():
+                self.stdout.write('The charging of contract ' + str(contract_id) + ' was interrupted, it must be reviewed\n')
+
+        # Only the contracts with SDRs pending for a whole cycle are loaded
+        contracts = [
+            contract_id for contract_id in get_contracts_with_pending_sdrs(self._checkpoint.cycle_end)
+            if not self._checkpoint.is_done(contract_id)
+        ]
+
+        start = time.time()
+        if workers > 1:
+            pool = ThreadPool(workers)
+            results = list(pool.imap_unordered(self._charge_contract, contracts))
+            pool.close()
+            pool.join()
+        else:
+            results = list(imap(self._charge_contract, contracts))
+
+        self._checkpoint.finish()
+
+        # Send the CDRs of the charges before the process ends
+        send_pending_cdrs()
+
+        self._write_summary(results, time.time() - start)
+
     def handle(self, *args, **options):
         """
             This method is used to perform the charging process
             of the offerings that have pending SDR for more than
             a month
         """
-        now = time.mktime(datetime.now().timetuple())
-
         if len(args) == 0:
-            # Get contracts
-            for contract in Contract.objects.all():
+            workers = options.get('workers', 1)
 
-                pending_sdrs = contract.pending_sdrs
+            if workers < 1:
+                raise Exception('The number of workers must be greater than 0')
 
-                # If there are subscriptions the renovations are used as triggers
-                if len(pending_sdrs) > 0 and (not 'subscription' in contract.pricing_model):
-                    time_stamp = time.mktime(pending_sdrs[0]['time_stamp'].timetuple())
-
-                    if (time_stamp + 2592000) <= now:  # A month
-                        # Get the related payment info
-                        purchase = contract.purchase
-
-                        if purchase.organization_owned:
-                            org = purchase.owner_organization
-                            payment_info = org.payment_info
-                        else:
-                            payment_info = purchase.customer.userprofile.payment_info
-
-                        charging = ChargingEngine(purchase, payment_method='credit_card', credit_card=payment_info)
-                        charging.resolve_charging(sdr=True)
+            self._resolve_charging(workers)
 
         elif len(args) == 1:
             # Get the purchase
@@ -70,22 +259,9 @@ class Command(BaseCommand):
             except:
                 raise Exception('The provided purchase does not exists')
 
-            # Get the contract
-            contract = purchase.contract
-
             # Check if there are pending SDRs
-            if (len(contract.pending_sdrs) > 0):
-
-                # Get payment info
-                if purchase.organization_owned:
-                    org = purchase.owner_organization
-                    payment_info = org.payment_info
-                else:
-                    payment_info = purchase.customer.userprofile.payment_info
-
-                charging = ChargingEngine(purchase, payment_method='credit_card', credit_card=payment_info)
-                charging.resolve_charging(sdr=True)
-
+            if SDRManager(purchase.contract).has_pending_sdrs():
+                _charge_purchase(purchase)
             else:
                 raise Exception('No accounting info in the provided purchase')
         else:
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+
+from django.core.management.base import BaseCommand
+
+from wstore.rss_adaptor.cdr_queue import send_pending_cdrs
+
+
+class Command(BaseCommand):
+
+    help = 'Sends the queued CDRs to the Revenue Sharing System'
+
+    def handle(self, *args, **options):
+        """
+            This method is used to send the queued CDRs whose sending
+            is due, including the ones queued by processes that are not
+            running anymore, such as the charging daemon
+        """
+        processed = send_pending_cdrs()
+        self.stdout.write(str(processed) + ' CDRs have been processed\n')
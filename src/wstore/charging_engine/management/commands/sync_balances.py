@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from django.core.management.base import BaseCommand
+
+from wstore.charging_engine.balance_cache import sync_pending_balances
+from wstore.store_commons.config_cache import get_rss
+
+
+class Command(BaseCommand):
+
+    help = 'Sends to the RSS the charges not included in the balance of the actors'
+
+    def handle(self, *args, **options):
+        """
+            This method is used to synchronize the balances of the
+            actors that have not made any charge recently, so the RSS
+            includes all their charges
+        """
+        rss = get_rss()
+        if rss is None:
+            raise Exception('No RSS instance registered')
+
+        synchronized = sync_pending_balances(rss)
+        self.stdout.write('The balance of ' + str(synchronized) + ' actors has been synchronized\n')
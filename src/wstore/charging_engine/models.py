@@ -19,9 +19,11 @@
 # If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from djangotoolbox.fields import ListField, DictField
 
 from wstore.models import Purchase
+from wstore.store_commons.config_cache import invalidate_units
 
 
 class Contract(models.Model):
@@ -31,9 +33,9 @@ class Contract(models.Model):
     last_charge = models.DateTimeField(blank=True, null=True)
     # List with the made charges
     charges = ListField()
-    # List with the charged SDRs for that offering
+    # Legacy lists of charged and pending SDRs, SDRs are now stored
+    # as ServiceRecord documents (see migrate_sdrs command)
     applied_sdrs = ListField()
-    # List the pending SDRs for that offering
     pending_sdrs = ListField()
     # Related purchase
     purchase = models.OneToOneField(Purchase)
@@ -41,6 +43,38 @@ class Contract(models.Model):
     pending_payment = DictField()
     # Revenue sharing product class
     revenue_class = models.CharField(max_length=15, blank=True, null=True)
+    # Date of the first subscription to be renovated
+    next_renovation = models.DateTimeField(blank=True, null=True)
+    # Units and usage labels of the SDRs consumed by the pay per
+    # use components and deductions of the pricing model
+    sdr_routing = DictField()
+    # Failed attempts of the scheduled renovation, after the last one
+    # the state is renewal_failed and the customer has to renew
+    renovation_attempts = models.IntegerField(default=0)
+    renovation_state = models.CharField(max_length=20, blank=True, null=True)
+    # Renovation reserved by the customer, it contains the previous
+    # date of renovation, which is restored if the payment fails
+    renovation_claim = DictField()
+
+
+class ServiceRecord(models.Model):
+    """
+    This model is used to store the SDR documents (accounting info)
+    received for a contract. SDRs are inserted and updated using the
+    SDRManager in order to avoid rewriting the whole contract
+    """
+    # Contract the SDR belongs to
+    contract = models.ForeignKey(Contract)
+    # State of the SDR: pending or applied (charged)
+    state = models.CharField(max_length=10)
+    correlation_number = models.IntegerField()
+    time_stamp = models.DateTimeField()
+    offering = DictField()
+    customer = models.CharField(max_length=50)
+    record_type = models.CharField(max_length=20)
+    unit = models.CharField(max_length=50)
+    value = models.CharField(max_length=50)
+    component_label = models.CharField(max_length=100)
 
 
 # This model is used as a unit dictionary in order to determine
@@ -52,3 +86,8 @@ class Unit(models.Model):
     defined_model = models.CharField(max_length=50)
     # Period of time defined by the unit for subscription models
     renovation_period = models.IntegerField(null=True, blank=True)
+
+
+# Keeps updated the units cached by the charging engine
+post_save.connect(invalidate_units, sender=Unit)
+post_delete.connect(invalidate_units, sender=Unit)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import absolute_import
+
+import threading
+from importlib import import_module
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+
+
+_client_classes = {}
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_payment_client_class():
+    """
+    Returns the payment client class configured in the PAYMENT_CLIENT
+    setting. Each class is imported only the first time it is used
+    """
+    client_path = settings.PAYMENT_CLIENT
+
+    if client_path not in _client_classes:
+        client_package, _, client_class = client_path.rpartition('.')
+        _client_classes[client_path] = getattr(import_module(client_package), client_class)
+
+    return _client_classes[client_path]
+
+
+def get_payment_client(purchase):
+    return get_payment_client_class()(purchase)
+
+
+def get_http_session():
+    """
+    Returns the HTTP session shared by the payment clients, which keeps
+    alive the connections with the payment gateway
+    """
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            adapter = HTTPAdapter(
+                pool_connections=settings.PAYMENT_POOL_SIZE,
+                pool_maxsize=settings.PAYMENT_POOL_SIZE
+            )
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+
+    return _session
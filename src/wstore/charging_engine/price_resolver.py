@@ -18,127 +18,187 @@
 # along with WStore.
 # If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
 
+import json
+import operator
 
-class PriceResolver():
 
-    _applied_sdrs = None
+OPERATIONS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.div
+}
 
-    def __init__(self):
-        self._applied_sdrs = {
-            'charges': [],
-            'deductions': []
-        }
+# Maximum number of compiled price functions kept in memory
+PRICE_FUNCTION_CACHE_SIZE = 512
+
+_compiled_functions = {}
+
+
+def _compile_argument(argument, error):
+    if isinstance(argument, basestring):
+        return operator.itemgetter(argument)
+    elif isinstance(argument, dict):
+        return _compile_function(argument)
+    else:
+        raise Exception(error)
+
+
+def _compile_function(function):
+    """
+        Translates a function tree into a callable that receives
+        the values of the variables
+    """
+    arg1 = _compile_argument(function['arg1'], 'Invalid argument 1')
+    arg2 = _compile_argument(function['arg2'], 'Invalid argument 2')
+
+    if function['operation'] not in OPERATIONS:
+        raise Exception('Unsupported operation')
+
+    operation = OPERATIONS[function['operation']]
+
+    return lambda variables: operation(arg1(variables), arg2(variables))
+
+
+class CompiledPriceFunction():
+    """
+        Reusable version of a price function that is evaluated with
+        the usage totals aggregated by AccountingAggregation
+    """
+
+    _usage_variables = None
+    _constants = None
+    _evaluator = None
+
+    def __init__(self, price_function):
+        # Map lowercased SDR labels with the ids of its variables
+        self._usage_variables = {}
+        self._constants = {}
+
+        for k, v in price_function['variables'].iteritems():
+            if v['type'] == 'usage':
+                self._usage_variables.setdefault(v['label'].lower(), []).append(k)
+            else:
+                self._constants[k] = float(v['value'])
+
+        self._evaluator = _compile_function(price_function['function'])
+
+    @property
+    def usage_labels(self):
+        return self._usage_variables.keys()
+
+    def _get_values(self, totals):
+        values = dict(self._constants)
+        for label, variables in self._usage_variables.iteritems():
+            for k in variables:
+                values[k] = totals.get(label, 0)
+
+        return values
 
-    def _price_function_calculation(self, function, variables):
+    def evaluate_totals(self, totals):
         """
-            It calculates the value of a price function
-            using the provided function value extracted
-            from the different SDR documents
-       """
-       
-        # Get arguments
-        if type(function['arg1']) == str or type(function['arg1']) == unicode:
-            arg1 = variables[function['arg1']]
-        elif type(function['arg1']) == dict:
-            arg1 = self._price_function_calculation(function['arg1'], variables)
-        else:
-            raise Exception('Invalid argument 1')
-
-        if type(function['arg2']) == str or type(function['arg2']) == unicode:
-            arg2 = variables[function['arg2']]
-        elif type(function['arg2']) == dict:
-            arg2 = self._price_function_calculation(function['arg2'], variables)
-        else:
-            raise Exception('Invalid argument 2')
-
-        result = 0
-        # Make operation
-        if function['operation'] == '+':
-            result = arg1 + arg2
-        elif function['operation'] == '-':
-            result = arg1 - arg2
-        elif function['operation'] == '*':
-            result = arg1 * arg2
-        elif function['operation'] == '/':
-            result = arg1 / arg2
-        else:
-            raise Exception('Unsupported operation')
-
-        return result
-
-    def _resolve_price_function(self, function, accounting):
+            Evaluates the function using the values already
+            aggregated by lowercased component label
         """
-           Aggregates the accounting information in the 
-           different variables present in a price function
-           in order to calculate the related charging
-       """
+        return self._evaluator(self._get_values(totals))
 
-        function = function['price_function']
-        # Map price variables id with SDR documents
-        aggregated_accounting_val = {}
-        for k, v in function['variables'].iteritems():
 
-            if v['type'] == 'usage':
-                aggregated_accounting_val[k] = []
+class AccountingAggregation():
+    """
+        Groups the SDRs of a charging by lowercased unit and component
+        label in a single pass, so the price of every pay-per-use component
+        is calculated from the precomputed totals
+    """
 
-                for sdr in accounting:
-                    if sdr['component_label'].lower() == v['label'].lower():
-                        aggregated_accounting_val[k].append(sdr)
-            else:
-                aggregated_accounting_val[k] = float(v['value'])
+    unit_totals = None
+    label_totals = None
+    _units = None
+    _labels = None
+    _accounting = None
+
+    def __init__(self, accounting):
+        self.unit_totals = {}
+        self.label_totals = {}
+        # Lowercased unit or label with the positions of its SDRs
+        self._units = {}
+        self._labels = {}
+        self._accounting = accounting
+
+        for position, sdr in enumerate(accounting):
+            value = float(sdr['value'])
+            unit = sdr['unit'].lower()
+            label = sdr['component_label'].lower()
+
+            self._units.setdefault(unit, []).append(position)
+            self.unit_totals[unit] = self.unit_totals.get(unit, 0) + value
 
-        # Reduce accounting info to a single value per price variable
-        for k in aggregated_accounting_val:
-            usage = 0
-            # Avoid iterations over constants
-            if type(aggregated_accounting_val[k]) == list:
-                for value in aggregated_accounting_val[k]:
-                    usage += float(value['value'])
+            self._labels.setdefault(label, []).append(position)
+            self.label_totals[label] = self.label_totals.get(label, 0) + value
 
-                aggregated_accounting_val[k] = usage
+    def get_unit_total(self, unit):
+        return self.unit_totals.get(unit, 0)
 
-        return self._price_function_calculation(function['function'], aggregated_accounting_val)
+    def get_unit_sdrs(self, unit):
+        return [self._accounting[position] for position in self._units.get(unit, [])]
 
-    def _resolve_pay_per_use_agregation(self, component, accounting):
+    def get_label_sdrs(self, labels):
         """
-           Resolves the charging of pay per use component based
-           on a fixed use value
-       """
+            Returns the SDRs of any of the given labels keeping
+            the order in which they were received
+        """
+        positions = []
+        for label in set(labels):
+            positions.extend(self._labels.get(label, []))
+
+        return [self._accounting[position] for position in sorted(positions)]
+
+
+def get_compiled_function(price_function):
+    """
+        Returns the compiled version of a price function, which is
+        shared by all the pricing models defining the same function
+    """
+    key = json.dumps(price_function, sort_keys=True)
+
+    if key not in _compiled_functions:
+        if len(_compiled_functions) >= PRICE_FUNCTION_CACHE_SIZE:
+            _compiled_functions.clear()
 
-        result = 0
-        for sdr in accounting:
-            # Calculate and aggregate price based on value per consumption
-            result += (float(sdr['value']) * float(component['value']))
+        _compiled_functions[key] = CompiledPriceFunction(price_function)
 
-        return result
+    return _compiled_functions[key]
 
-    def _pay_per_use_preprocesing(self, use_models, accounting_info, discount=False):
+
+class PriceResolver():
+
+    _applied_sdrs = None
+
+    def __init__(self):
+        self._applied_sdrs = {
+            'charges': [],
+            'deductions': []
+        }
+
+    def _pay_per_use_preprocesing(self, use_models, aggregation, discount=False):
         """
-           Process pay-per-use payments and call the corresponding
-           price calculator
+           Process pay-per-use payments calculating its price
+           using the accounting info grouped by unit and label
        """
 
         price = 0
         for payment in use_models: # TODO check if the payment can be applied
-            related_accounting = []
             # Check price function
             if 'price_function' in payment:
-                for sdr in accounting_info:
-                    # Iterate over price variables
-                    for k, var in payment['price_function']['variables'].iteritems():
-                        if var['label'].lower() == sdr['component_label'].lower():
-                            related_accounting.append(sdr)
-                agregator = self._resolve_price_function
+                function = get_compiled_function(payment['price_function'])
+                related_accounting = aggregation.get_label_sdrs(function.usage_labels)
+                price += function.evaluate_totals(aggregation.label_totals)
             else:
                 # Get the related accounting info
-                for sdr in accounting_info:
-                    if sdr['unit'].lower() == payment['unit'].lower():
-                        related_accounting.append(sdr)
-
-                agregator = self._resolve_pay_per_use_agregation
+                unit = payment['unit'].lower()
+                related_accounting = aggregation.get_unit_sdrs(unit)
+                price += aggregation.get_unit_total(unit) * float(payment['value'])
 
             # Include the applied SDRs
-            price += agregator(payment, related_accounting)
             applied_accounting = {
                 'model': payment,
                 'accounting': related_accounting,
@@ -165,6 +225,10 @@ class PriceResolver():
        """
 
         price = 0
+        aggregation = None
+        if 'pay_per_use' in pricing_model or 'deductions' in pricing_model:
+            aggregation = AccountingAggregation(accounting_info or [])
+
         # Check the pricing model
         if 'single_payment' in pricing_model:
             for payment in pricing_model['single_payment']:
@@ -176,11 +240,11 @@ class PriceResolver():
 
         if 'pay_per_use' in pricing_model:
             # Calculate the payment associated with the price component
-            price = price + self._pay_per_use_preprocesing(pricing_model['pay_per_use'], accounting_info)
+            price = price + self._pay_per_use_preprocesing(pricing_model['pay_per_use'], aggregation)
 
         if 'deductions' in pricing_model:
             # Calculate deductions
-            price = price - self._pay_per_use_preprocesing(pricing_model['deductions'], accounting_info, discount=True)
+            price = price - self._pay_per_use_preprocesing(pricing_model['deductions'], aggregation, discount=True)
 
         # If the price is negative i.e too much deductions
         # the value is set to 0
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import absolute_import
+
+from bson import ObjectId
+from datetime import datetime, timedelta
+
+from wstore.contracting.purchase_rollback import rollback
+from wstore.store_commons.database import get_database_connection
+
+
+# Time that a due renovation is reserved by a charging process, after
+# that it is processed again in case the process has failed
+RENOVATION_LEASE = 3600
+
+# Failed renovations are retried with a delay which is doubled in
+# every attempt, after the last attempt the customer is notified
+RETRY_DELAY = 3600
+MAX_RETRY_DELAY = 86400
+MAX_RENOVATION_ATTEMPTS = 5
+
+
+def _get_collection():
+    return get_database_connection().charging_engine_contract
+
+
+def _parse_renovation_date(renovation_date):
+    # Renovation dates loaded from fixtures are saved as strings
+    if isinstance(renovation_date, basestring):
+        try:
+            renovation_date = datetime.strptime(renovation_date, '%Y-%m-%d %H:%M:%S.%f')
+        except:
+            renovation_date = datetime.strptime(renovation_date, '%Y-%m-%d %H:%M:%S')
+
+    return renovation_date
+
+
+def get_next_renovation(price_model):
+    """
+    Returns the date of the first subscription of a pricing model
+    to be renovated, or None if it does not define subscriptions
+    """
+    dates = [
+        _parse_renovation_date(subs['renovation_date'])
+        for subs in price_model.get('subscription', []) if subs.get('renovation_date')
+    ]
+
+    if len(dates) == 0:
+        return None
+
+    return min(dates)
+
+
+def update_next_renovations():
+    """
+    Calculates the next renovation of the contracts with subscriptions
+    that have been created by previous versions, returning the number
+    of contracts updated
+    """
+    collection = _get_collection()
+    contracts = collection.find({
+        'pricing_model.subscription.0': {'$exists': True},
+        'next_renovation': None
+    }, {'pricing_model': True})
+
+    updated = 0
+    for contract in contracts:
+        next_renovation = get_next_renovation(contract['pricing_model'])
+
+        if next_renovation is not None:
+            collection.update({'_id': contract['_id']}, {'$set': {'next_renovation': next_renovation}})
+            updated += 1
+
+    return updated
+
+
+def get_renovation_forecast(days, now=None):
+    """
+    Returns the number of renovations due every day from now to the
+    given number of days as a list of (date, renovations) tuples. The
+    overdue renovations are included in the current day
+    """
+    if now is None:
+        now = datetime.now()
+
+    today = now.date()
+    forecast = dict([(today + timedelta(days=day), 0) for day in range(days)])
+
+    # Only the indexed field is read
+    contracts = _get_collection().find({
+        'next_renovation': {'$lt': datetime.combine(today + timedelta(days=days), datetime.min.time())}
+    }, {'next_renovation': True, '_id': False})
+
+    for contract in contracts:
+        forecast[max(contract['next_renovation'].date(), today)] += 1
+
+    return sorted(forecast.items())
+
+
+def _get_retry_delay(attempts):
+    return min(RETRY_DELAY * (2 ** (attempts - 1)), MAX_RETRY_DELAY)
+
+
+def _claim_renovation(now):
+    """
+    Reserves the contract whose renovation is due earlier, returning its
+    id and the number of attempts made or None if there are not due
+    renovations. The renovation is reserved atomically so it can be
+    processed by several charging processes at the same time
+    """
+    contract = _get_collection().find_and_modify(
+        query={'next_renovation': {'$lte': now}},
+        update={
+            '$set': {'next_renovation': now + timedelta(seconds=RENOVATION_LEASE)},
+            '$inc': {'renovation_attempts': 1}
+        },
+        sort={'next_renovation': 1},
+        fields={'_id': True, 'renovation_attempts': True},
+        new=True
+    )
+
+    if contract is None:
+        return None
+
+    return contract['_id'], contract['renovation_attempts']
+
+
+def claim_customer_renovation(contract_id, now=None):
+    """
+    Reserves the renovation of a contract requested by the customer, so
+    it is not charged at the same time by the scheduled renovations. The
+    renovation can be requested when it is due or when the scheduled
+    renovation has failed. Returns the previous date of renovation,
+    which is restored with release_renovation if the payment fails
+    """
+    if now is None:
+        now = datetime.now()
+
+    collection = _get_collection()
+    contract = collection.find_one({'_id': ObjectId(contract_id)}, {'next_renovation': True})
+
+    if contract is None:
+        raise ValueError('The renovation is not due or is being processed')
+
+    previous = contract.get('next_renovation')
+    if previous is not None and previous > now:
+        raise ValueError('The renovation is not due or is being processed')
+
+    # The date is only replaced if it has not been modified since it was
+    # read, the previous one is kept in order to restore it
+    claimed = collection.find_and_modify(
+        query={'_id': ObjectId(contract_id), 'next_renovation': previous},
+        update={'$set': {
+            'next_renovation': now + timedelta(seconds=RENOVATION_LEASE),
+            'renovation_claim': {'previous': previous}
+        }},
+        fields={'_id': True}
+    )
+
+    if claimed is None:
+        raise ValueError('The renovation is not due or is being processed')
+
+    return previous
+
+
+def release_renovation(contract_id):
+    """
+    Restores the date of renovation of a contract whose renovation
+    has been reserved by the customer, used when the payment fails,
+    is cancelled or times out
+    """
+    collection = _get_collection()
+    contract = collection.find_one({'_id': ObjectId(contract_id)}, {'renovation_claim': True})
+
+    if contract is None or not contract.get('renovation_claim'):
+        return
+
+    claim = contract['renovation_claim']
+    collection.update({'_id': ObjectId(contract_id), 'renovation_claim': claim}, {
+        '$set': {'next_renovation': claim['previous'], 'renovation_claim': {}}
+    })
+
+
+def renovate_contract(contract_id):
+    """
+    Charges the due subscriptions of a contract, the charging engine
+    saves the date of the next renovation when the payment ends
+    """
+    from wstore.charging_engine.charging_engine import ChargingEngine
+    from wstore.charging_engine.models import Contract
+
+    purchase = Contract.objects.get(pk=str(contract_id)).purchase
+
+    # Get the related payment info
+    if purchase.organization_owned:
+        payment_info = purchase.owner_organization.payment_info
+    else:
+        payment_info = purchase.customer.userprofile.payment_info
+
+    try:
+        charging = ChargingEngine(purchase, payment_method='credit_card', credit_card=payment_info)
+        charging.resolve_charging()
+    except:
+        # The purchase is restored, the renovation is retried later
+        rollback(purchase)
+        raise
+
+
+def _notify_renovation_failed(contract_id):
+    """
+    Notifies the customer that the subscriptions of a contract could
+    not be renewed, so the renovation has to be made manually
+    """
+    from django.template.loader import render_to_string
+    from wstore.charging_engine.models import Contract
+    from wstore.registration.models import send_mail_from_gmail
+
+    purchase = Contract.objects.get(pk=str(contract_id)).purchase
+    context = {
+        'offering': purchase.offering,
+        'purchase': purchase,
+        'user': purchase.customer
+    }
+
+    subject = render_to_string('contracting/renewal_failed_subject.txt', context)
+    message = render_to_string('contracting/renewal_failed_message.txt', context)
+    send_mail_from_gmail(purchase.customer.email, subject, message)
+
+
+def _fail_renovation(contract_id, attempts, now):
+    """
+    Schedules the next attempt of a failed renovation. After the last
+    attempt the renovation is not scheduled again and the customer is
+    notified, returning the final state of the renovation
+    """
+    collection = _get_collection()
+
+    if attempts < MAX_RENOVATION_ATTEMPTS:
+        collection.update({'_id': contract_id}, {
+            '$set': {'next_renovation': now + timedelta(seconds=_get_retry_delay(attempts))}
+        })
+        return 'failed'
+
+    collection.update({'_id': contract_id}, {
+        '$set': {'next_renovation': None, 'renovation_state': 'renewal_failed'}
+    })
+
+    try:
+        _notify_renovation_failed(contract_id)
+    except:
+        pass
+
+    return 'renewal_failed'
+
+
+def process_due_renovations(batch_size=100, now=None):
+    """
+    Renovates a batch of contracts in order of renovation date, returning
+    a list of (contract_id, result) tuples
+    """
+    if now is None:
+        now = datetime.now()
+
+    results = []
+    while len(results) < batch_size:
+        claimed = _claim_renovation(now)
+
+        if claimed is None:
+            break
+
+        contract_id, attempts = claimed
+        try:
+            renovate_contract(contract_id)
+        except Exception as e:
+            state = _fail_renovation(contract_id, attempts, now)
+            results.append((contract_id, state + ': ' + unicode(e)))
+        else:
+            results.append((contract_id, 'renovated'))
+
+    return results
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+import re
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError
+
+from wstore.store_commons.database import get_database_connection
+
+
+# Fields that must be included in every SDR document
+SDR_FIELDS = ('offering', 'customer', 'time_stamp', 'correlation_number', 'record_type', 'unit', 'value', 'component_label')
+
+# Internal fields of the stored SDRs not returned to the callers
+SDR_PROJECTION = {'_id': False, 'contract_id': False, 'state': False}
+
+
+class SDRManager():
+    """
+    Manages the SDR documents of a contract, which are stored in the
+    service record collection instead of in the contract document so
+    the cost of the operations depends on the number of SDRs involved
+    """
+
+    _contract = None
+    _collection = None
+
+    def __init__(self, contract):
+        self._contract = contract
+        self._collection = get_database_connection().charging_engine_servicerecord
+
+    def _get_query(self, state=None):
+        query = {
+            'contract_id': ObjectId(self._contract.pk)
+        }
+        if state is not None:
+            query['state'] = state
+
+        return query
+
+    def _build_document(self, sdr, state):
+        document = {field: sdr[field] for field in SDR_FIELDS}
+        document['correlation_number'] = int(sdr['correlation_number'])
+        document['contract_id'] = ObjectId(self._contract.pk)
+        document['state'] = state
+
+        return document
+
+    def include_sdrs(self, sdrs):
+        """
+        Stores a list of already validated SDRs as pending using a single
+        insert. The unique index on the correlation number prevents SDRs
+        validated concurrently from being stored twice
+        """
+        documents = [self._build_document(sdr, 'pending') for sdr in sdrs]
+
+        if len(documents) > 0:
+            try:
+                self._collection.insert(documents)
+            except DuplicateKeyError:
+                raise Exception('The accounting info of the purchase has been modified, try again')
+
+    def import_sdrs(self, applied_sdrs, pending_sdrs):
+        """
+        Stores SDRs previously saved in the contract document. SDRs
+        already stored are skipped so the import can be repeated
+        """
+        documents = [self._build_document(sdr, 'applied') for sdr in applied_sdrs]
+        documents.extend([self._build_document(sdr, 'pending') for sdr in pending_sdrs])
+
+        if len(documents) > 0:
+            try:
+                self._collection.insert(documents, continue_on_error=True)
+            except DuplicateKeyError:
+                pass
+
+    def get_last_sdr(self):
+        """
+        Returns the last SDR received for the contract, either
+        pending or applied, or None if there is not any SDR
+        """
+        return self._collection.find_one(
+            self._get_query(),
+            SDR_PROJECTION,
+            sort=[('correlation_number', DESCENDING)]
+        )
+
+    def get_first_pending_sdr(self):
+        """
+        Returns the oldest pending SDR of the contract
+        """
+        return self._collection.find_one(
+            self._get_query('pending'),
+            SDR_PROJECTION,
+            sort=[('correlation_number', ASCENDING)]
+        )
+
+    def has_pending_sdrs(self):
+        return self.get_first_pending_sdr() is not None
+
+    def get_pending_sdrs(self):
+        """
+        Returns the pending SDRs of the contract ordered by
+        correlation number
+        """
+        return list(self._collection.find(
+            self._get_query('pending'),
+            SDR_PROJECTION
+        ).sort('correlation_number', ASCENDING))
+
+    def get_sdrs(self, from_=None, to=None, label=None, after=None, limit=None):
+        """
+        Returns a cursor with the SDRs of the contract, both applied and
+        pending, ordered by correlation number (and so by time stamp).
+        SDRs can be filtered by time range and component label (ignoring
+        case) and paginated using the correlation number of the last SDR
+        previously returned
+        """
+        query = self._get_query()
+
+        if from_ is not None or to is not None:
+            query['time_stamp'] = {}
+
+            if from_ is not None:
+                query['time_stamp']['$gte'] = from_
+
+            if to is not None:
+                query['time_stamp']['$lte'] = to
+
+        if label is not None:
+            query['component_label'] = {
+                '$regex': '^' + re.escape(label) + '$',
+                '$options': 'i'
+            }
+
+        if after is not None:
+            query['correlation_number'] = {'$gt': int(after)}
+
+        cursor = self._collection.find(query, SDR_PROJECTION).sort('correlation_number', ASCENDING)
+
+        if limit is not None:
+            cursor = cursor.limit(limit)
+
+        return cursor
+
+    def apply_sdrs(self, last_correlation):
+        """
+        Marks as applied the pending SDRs of the contract up to the given
+        correlation number, so SDRs received while charging remain pending
+        """
+        query = self._get_query('pending')
+        query['correlation_number'] = {'$lte': int(last_correlation)}
+
+        self._collection.update(query, {'$set': {'state': 'applied'}}, multi=True)
+
+
+def get_contracts_with_pending_sdrs(before):
+    """
+    Returns the ids of the contracts that have pending SDRs
+    received before the given date
+    """
+    collection = get_database_connection().charging_engine_servicerecord
+
+    return collection.find({
+        'state': 'pending',
+        'time_stamp': {'$lte': before}
+    }).distinct('contract_id')
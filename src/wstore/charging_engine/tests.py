@@ -22,9 +22,11 @@ from __future__ import absolute_import
 
 import os
 import json
+import shlex
 import rdflib
 from copy import deepcopy
-from datetime import datetime
+from StringIO import StringIO
+from datetime import datetime, timedelta
 from bson import ObjectId
 from mock import MagicMock
 from nose_parameterized import parameterized
@@ -33,14 +35,26 @@ from django.test import TestCase
 from django.test.client import RequestFactory
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.management import call_command
 from django.test.utils import override_settings
 
 from wstore.charging_engine import charging_engine
 from wstore.charging_engine import views
+from wstore.charging_engine import invoice_queue
+from wstore.charging_engine import invoice_renderer
+from wstore.charging_engine import timeout_scheduler
+from wstore.charging_engine import renovation_scheduler
+from wstore.charging_engine import balance_cache
+from wstore.charging_engine import correlation_allocator
+from wstore.charging_engine.payment_client import client_registry
 from wstore.models import Purchase
 from wstore.models import UserProfile
 from wstore.models import Organization
+from wstore.models import RSS
+from wstore.charging_engine.models import Contract
 from wstore.charging_engine.management.commands import resolve_use_charging
+from wstore.contracting import purchase_rollback
+from wstore.charging_engine.sdr_manager import SDRManager
 from wstore.store_commons.database import get_database_connection
 
 
@@ -73,17 +87,6 @@ class FakeClient():
         return 'https://www.sandbox.paypal.com/webscr?cmd=_express-checkout&token=11111111'
 
 
-class FakeThreading():
-
-    class Timer():
-
-        def __init__(self, time, handler):
-            pass
-
-        def start(self):
-            pass
-
-
 class FakeChargingEngine():
 
     _purchase = None
@@ -98,10 +101,27 @@ class FakeChargingEngine():
     def resolve_charging(self, sdr=False):
 
         if sdr and self._payment_method == 'credit_card':
-            sdrs = self._purchase.contract.pending_sdrs
-            self._purchase.contract.pending_sdrs = []
-            self._purchase.contract.applied_sdrs.extend(sdrs)
-            self._purchase.contract.save()
+            sdr_manager = SDRManager(self._purchase.contract)
+            sdrs = sdr_manager.get_pending_sdrs()
+            sdr_manager.apply_sdrs(sdrs[-1]['correlation_number'])
+
+
+def get_sdrs(contract, state):
+    db = get_database_connection()
+    return list(db.charging_engine_servicerecord.find({
+        'contract_id': ObjectId(contract.pk),
+        'state': state
+    }).sort('correlation_number', 1))
+
+
+def fill_pending_sdrs(contract, time_stamps):
+    db = get_database_connection()
+    db.charging_engine_servicerecord.insert([{
+        'contract_id': ObjectId(contract.pk),
+        'state': 'pending',
+        'correlation_number': i + 1,
+        'time_stamp': time_stamp
+    } for i, time_stamp in enumerate(time_stamps)])
 
 
 def fake_cdr_generation(parts, time):
@@ -110,11 +130,43 @@ def fake_cdr_generation(parts, time):
 
 class FakeSubprocess():
 
-    def __init__(self):
-        pass
+    PIPE = None
 
-    def call(self, prams):
-        pass
+    def __init__(self, returncode=0, missing=()):
+        self.batches = []
+        self.files = []
+        self._returncode = returncode
+        self._missing = missing
+
+    def _convert(self, args):
+        self.batches.append(args)
+
+        if self._returncode != 0:
+            return
+
+        # Create the PDF files as the converter script does
+        for line in args.splitlines():
+            pdf_path = shlex.split(line)[1]
+            if pdf_path in self._missing:
+                continue
+
+            with open(pdf_path, 'w') as f:
+                f.write('%PDF')
+
+            self.files.append(pdf_path)
+
+    def Popen(self, prams, stdin=None):
+        converter = MagicMock()
+        converter.communicate.side_effect = self._convert
+        converter.returncode = self._returncode
+        return converter
+
+    def remove_files(self):
+        for path in self.files:
+            if os.path.exists(path):
+                os.remove(path)
+
+        self.files = []
 
 BASIC_PRCING = {
     "pricing": {
@@ -171,7 +223,8 @@ class SinglePaymentChargingTestCase(TestCase):
     def setUpClass(cls):
         reload(charging_engine)
         cls._auth = settings.OILAUTH
-        charging_engine.subprocess = FakeSubprocess()
+        invoice_renderer.subprocess = FakeSubprocess()
+        settings.ASYNC_INVOICE_GENERATION = False
         settings.OILAUTH = False
         settings.PAYMENT_CLIENT = 'wstore.charging_engine.tests.FakeClient'
         super(SinglePaymentChargingTestCase, cls).setUpClass()
@@ -179,6 +232,7 @@ class SinglePaymentChargingTestCase(TestCase):
     @classmethod
     def tearDownClass(cls):
         settings.OILAUTH = cls._auth
+        invoice_renderer.subprocess.remove_files()
         super(SinglePaymentChargingTestCase, cls).tearDownClass()
 
     @parameterized.expand([
@@ -263,9 +317,15 @@ class SubscriptionChargingTestCase(TestCase):
     @classmethod
     def setUpClass(cls):
         settings.PAYMENT_CLIENT = 'wstore.charging_engine.tests.FakeClient'
-        charging_engine.subprocess = FakeSubprocess()
+        invoice_renderer.subprocess = FakeSubprocess()
+        settings.ASYNC_INVOICE_GENERATION = False
         super(SubscriptionChargingTestCase, cls).setUpClass()
 
+    @classmethod
+    def tearDownClass(cls):
+        invoice_renderer.subprocess.remove_files()
+        super(SubscriptionChargingTestCase, cls).tearDownClass()
+
     def test_basic_subscription_charging(self):
 
         user = User.objects.get(pk='51070aba8e05cc2115f022f9')
@@ -513,13 +573,15 @@ class PayPerUseChargingTestCase(TestCase):
     def setUpClass(cls):
         cls._auth = settings.OILAUTH
         settings.PAYMENT_CLIENT = 'wstore.charging_engine.tests.FakeClient'
-        charging_engine.subprocess = FakeSubprocess()
+        invoice_renderer.subprocess = FakeSubprocess()
+        settings.ASYNC_INVOICE_GENERATION = False
         settings.OILAUTH = False
         super(PayPerUseChargingTestCase, cls).setUpClass()
 
     @classmethod
     def tearDownClass(cls):
         settings.OILAUTH = cls._auth
+        invoice_renderer.subprocess.remove_files()
         super(PayPerUseChargingTestCase, cls).tearDownClass()
 
     def test_basic_sdr_feeding(self):
@@ -547,12 +609,12 @@ class PayPerUseChargingTestCase(TestCase):
         purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
         contract = purchase.contract
 
-        self.assertEqual(len(contract.pending_sdrs), 1)
+        self.assertEqual(len(get_sdrs(contract, 'pending')), 1)
 
-        loaded_sdr = contract.pending_sdrs[0]
+        loaded_sdr = get_sdrs(contract, 'pending')[0]
 
         self.assertEqual(loaded_sdr['customer'], 'test_user')
-        self.assertEqual(loaded_sdr['correlation_number'], '1')
+        self.assertEqual(loaded_sdr['correlation_number'], 1)
         self.assertEqual(loaded_sdr['record_type'], 'event')
         self.assertEqual(loaded_sdr['value'], '10')
         self.assertEqual(loaded_sdr['unit'], 'invocation')
@@ -579,10 +641,6 @@ class PayPerUseChargingTestCase(TestCase):
         }
 
         purchase = Purchase.objects.get(pk='61074ab65e05acc415f322f2')
-        applied_date = purchase.contract.applied_sdrs[0]['time_stamp']
-        applied_date = datetime.strptime(applied_date, '%Y-%m-%d %H:%M:%S')
-        purchase.contract.applied_sdrs[0]['time_stamp'] = applied_date
-        purchase.contract.save()
 
         charging = charging_engine.ChargingEngine(purchase)
         charging.include_sdr(sdr)
@@ -591,14 +649,14 @@ class PayPerUseChargingTestCase(TestCase):
         purchase = Purchase.objects.get(pk='61074ab65e05acc415f322f2')
         contract = purchase.contract
 
-        self.assertEqual(len(contract.pending_sdrs), 1)
-        self.assertEqual(len(contract.applied_sdrs), 1)
+        self.assertEqual(len(get_sdrs(contract, 'pending')), 1)
+        self.assertEqual(len(get_sdrs(contract, 'applied')), 1)
         self.assertEqual(len(contract.charges), 1)
 
-        loaded_sdr = contract.pending_sdrs[0]
+        loaded_sdr = get_sdrs(contract, 'pending')[0]
 
         self.assertEqual(loaded_sdr['customer'], 'test_user')
-        self.assertEqual(loaded_sdr['correlation_number'], '2')
+        self.assertEqual(loaded_sdr['correlation_number'], 2)
         self.assertEqual(loaded_sdr['record_type'], 'event')
         self.assertEqual(loaded_sdr['value'], '10')
         self.assertEqual(loaded_sdr['unit'], 'invocation')
@@ -623,10 +681,6 @@ class PayPerUseChargingTestCase(TestCase):
         }
 
         purchase = Purchase.objects.get(pk='61077ab75e07a7c415f372f2')
-        applied_date = purchase.contract.pending_sdrs[0]['time_stamp']
-        applied_date = datetime.strptime(applied_date, '%Y-%m-%d %H:%M:%S')
-        purchase.contract.pending_sdrs[0]['time_stamp'] = applied_date
-        purchase.contract.save()
 
         charging = charging_engine.ChargingEngine(purchase)
         charging.include_sdr(sdr)
@@ -635,12 +689,12 @@ class PayPerUseChargingTestCase(TestCase):
         purchase = Purchase.objects.get(pk='61077ab75e07a7c415f372f2')
         contract = purchase.contract
 
-        self.assertEqual(len(contract.pending_sdrs), 2)
+        self.assertEqual(len(get_sdrs(contract, 'pending')), 2)
 
-        loaded_sdr = contract.pending_sdrs[1]
+        loaded_sdr = get_sdrs(contract, 'pending')[1]
 
         self.assertEqual(loaded_sdr['customer'], 'test_user')
-        self.assertEqual(loaded_sdr['correlation_number'], '2')
+        self.assertEqual(loaded_sdr['correlation_number'], 2)
         self.assertEqual(loaded_sdr['record_type'], 'event')
         self.assertEqual(loaded_sdr['value'], '10')
         self.assertEqual(loaded_sdr['unit'], 'invocation')
@@ -682,12 +736,12 @@ class PayPerUseChargingTestCase(TestCase):
         purchase = Purchase.objects.get(pk='61004a9a5e95ac9115902290')
         contract = purchase.contract
 
-        self.assertEqual(len(contract.pending_sdrs), 1)
+        self.assertEqual(len(get_sdrs(contract, 'pending')), 1)
 
-        loaded_sdr = contract.pending_sdrs[0]
+        loaded_sdr = get_sdrs(contract, 'pending')[0]
 
         self.assertEqual(loaded_sdr['customer'], 'test_user2')
-        self.assertEqual(loaded_sdr['correlation_number'], '1')
+        self.assertEqual(loaded_sdr['correlation_number'], 1)
         self.assertEqual(loaded_sdr['record_type'], 'event')
         self.assertEqual(loaded_sdr['value'], '10')
         self.assertEqual(loaded_sdr['unit'], 'invocation')
@@ -758,6 +812,100 @@ class PayPerUseChargingTestCase(TestCase):
 
     test_sdr_feeding_invalid_correlation.tags = ('fiware-ut-14',)
 
+    def test_sdr_batch_feeding(self):
+
+        sdrs = []
+        for corr, unit in (('1', 'invocation'), ('2', 'invocation'), ('3', 'invalid'), ('4', 'invocation')):
+            sdrs.append({
+                'offering': {
+                    'name': 'test_offering',
+                    'organization': 'test_organization',
+                    'version': '1.0'
+                },
+                'component_label': 'invocations',
+                'customer': 'test_user',
+                'correlation_number': corr,
+                'time_stamp': str(datetime.now()),
+                'record_type': 'event',
+                'value': '10',
+                'unit': unit
+            })
+
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        charging = charging_engine.ChargingEngine(purchase)
+        results = charging.include_sdrs(sdrs)
+
+        self.assertEquals(results, [{
+            'correlation_number': '1',
+            'result': 'correct'
+        }, {
+            'correlation_number': '2',
+            'result': 'correct'
+        }, {
+            'correlation_number': '3',
+            'result': 'error',
+            'message': 'The specified unit or component label is not included in the pricing model'
+        }, {
+            'correlation_number': '4',
+            'result': 'error',
+            'message': 'Invalid correlation number, expected: 3'
+        }])
+
+        # Refresh the purchase
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        contract = purchase.contract
+
+        pending_sdrs = get_sdrs(contract, 'pending')
+        self.assertEqual(len(pending_sdrs), 2)
+        self.assertEqual(pending_sdrs[0]['correlation_number'], 1)
+        self.assertEqual(pending_sdrs[1]['correlation_number'], 2)
+
+    def test_sdr_migration(self):
+
+        sdr = {
+            'offering': {
+                'name': 'test_offering',
+                'organization': 'test_organization',
+                'version': '1.0'
+            },
+            'component_label': 'invocations',
+            'customer': 'test_user',
+            'correlation_number': '1',
+            'time_stamp': datetime(2015, 9, 14, 10, 0),
+            'record_type': 'event',
+            'value': '10',
+            'unit': 'invocation'
+        }
+        pending_sdr = deepcopy(sdr)
+        pending_sdr['correlation_number'] = '2'
+
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        db = get_database_connection()
+        db.charging_engine_contract.update({'_id': ObjectId(purchase.contract.pk)}, {
+            '$set': {
+                'applied_sdrs': [sdr],
+                'pending_sdrs': [pending_sdr]
+            }
+        })
+
+        call_command('migrate_sdrs', stdout=StringIO())
+
+        # Refresh the purchase
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        contract = purchase.contract
+
+        self.assertEqual(contract.applied_sdrs, [])
+        self.assertEqual(contract.pending_sdrs, [])
+
+        applied_sdrs = get_sdrs(contract, 'applied')
+        self.assertEqual(len(applied_sdrs), 1)
+        self.assertEqual(applied_sdrs[0]['correlation_number'], 1)
+
+        pending_sdrs = get_sdrs(contract, 'pending')
+        self.assertEqual(len(pending_sdrs), 1)
+        self.assertEqual(pending_sdrs[0]['correlation_number'], 2)
+        self.assertEqual(pending_sdrs[0]['time_stamp'], datetime(2015, 9, 14, 10, 0))
+
     def test_sdr_feeding_invalid_timestamp(self):
 
         settings.OILAUTH = False
@@ -776,10 +924,6 @@ class PayPerUseChargingTestCase(TestCase):
         }
 
         purchase = Purchase.objects.get(pk='61074ab65e05acc415f322f2')
-        applied_date = purchase.contract.applied_sdrs[0]['time_stamp']
-        applied_date = datetime.strptime(applied_date, '%Y-%m-%d %H:%M:%S')
-        purchase.contract.applied_sdrs[0]['time_stamp'] = applied_date
-        purchase.contract.save()
 
         charging = charging_engine.ChargingEngine(purchase)
 
@@ -860,6 +1004,60 @@ class PayPerUseChargingTestCase(TestCase):
 
     test_sdr_feeding_invalid_purchase.tags = ('fiware-ut-14',)
 
+    def test_sdr_routing(self):
+
+        price_model = {
+            'pay_per_use': [{
+                'unit': 'req./h',
+                'value': '1.0'
+            }, {
+                'price_function': {
+                    'variables': {
+                        'x': {'type': 'usage', 'label': '$calls'},
+                        'y': {'type': 'constant', 'label': 'fee'}
+                    }
+                }
+            }],
+            'deductions': [{
+                'unit': 'invocation',
+                'value': '0.5'
+            }]
+        }
+
+        charging = charging_engine.ChargingEngine(None)
+        routing = charging._build_sdr_routing(price_model)
+
+        # Provider defined units and labels are allowed
+        self.assertEquals(routing, {
+            'units': ['invocation', 'req./h'],
+            'labels': ['$calls']
+        })
+
+        sdr = {
+            'offering': {
+                'name': 'test_offering',
+                'organization': 'test_organization',
+                'version': '1.0'
+            },
+            'component_label': 'invocations',
+            'customer': 'test_user',
+            'correlation_number': '1',
+            'time_stamp': str(datetime.now()),
+            'record_type': 'event',
+            'value': '10',
+            'unit': 'invocation'
+        }
+
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        charging = charging_engine.ChargingEngine(purchase)
+        charging.include_sdr(sdr)
+
+        self.assertTrue('invocation' in charging._sdr_routing['units'])
+
+        # The routing of contracts created before it was introduced is saved
+        contract = Contract.objects.get(purchase=purchase)
+        self.assertEquals(contract.sdr_routing, {'units': ['invocation'], 'labels': []})
+
     def test_new_purchase_use(self):
 
         user = User.objects.get(pk='51070aba8e05cc2115f022f9')
@@ -955,8 +1153,8 @@ class PayPerUseChargingTestCase(TestCase):
         self.assertEqual(contract.charges[0]['cost'], 10.00)
         self.assertEqual(contract.charges[0]['concept'], 'pay per use')
 
-        self.assertEqual(len(contract.pending_sdrs), 0)
-        self.assertEqual(len(contract.applied_sdrs), 1)
+        self.assertEqual(len(get_sdrs(contract, 'pending')), 0)
+        self.assertEqual(len(get_sdrs(contract, 'applied')), 1)
 
     test_basic_resolve_use_charging.tags = ('fiware-ut-15',)
 
@@ -989,10 +1187,16 @@ class AsynchronousPaymentTestCase(TestCase):
     @classmethod
     def setUpClass(cls):
         settings.PAYMENT_CLIENT = 'wstore.charging_engine.tests.FakeClient'
-        charging_engine.subprocess = FakeSubprocess()
-        charging_engine.threading = FakeThreading()
+        invoice_renderer.subprocess = FakeSubprocess()
+        settings.ASYNC_INVOICE_GENERATION = False
+        charging_engine.schedule_timeout = MagicMock()
         super(AsynchronousPaymentTestCase, cls).setUpClass()
 
+    @classmethod
+    def tearDownClass(cls):
+        invoice_renderer.subprocess.remove_files()
+        super(AsynchronousPaymentTestCase, cls).tearDownClass()
+
     def test_basic_asynchronous_payment(self):
 
         user = User.objects.get(pk='51070aba8e05cc2115f022f9')
@@ -1112,6 +1316,298 @@ class AsynchronousPaymentTestCase(TestCase):
         purchase = Purchase.objects.get(pk='61004aba5e05acc115f02222')
         self.assertEqual(purchase.state, 'paid')
 
+    def test_expired_timeouts(self):
+        db = get_database_connection()
+        db.charging_engine_paymenttimeout.insert([{
+            '_id': ObjectId('61004aba5e05acc115f022f0'),
+            'due': datetime(2015, 01, 01)
+        }, {
+            '_id': ObjectId('61004aba5e05acc115f02111'),
+            'due': datetime.now() + timedelta(seconds=300)
+        }])
+
+        def fakeroll(purch):
+            purch.state = 'rollback'
+            purch.save()
+
+        charging_engine.rollback = fakeroll
+        self.assertEqual(timeout_scheduler.process_expired_timeouts(), 1)
+
+        # Only the expired purchase has been rolled back
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        self.assertEqual(purchase.state, 'rollback')
+
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f02111')
+        self.assertEqual(purchase.state, 'pending')
+
+        timeouts = list(db.charging_engine_paymenttimeout.find())
+        self.assertEqual(len(timeouts), 1)
+        self.assertEqual(timeouts[0]['_id'], ObjectId('61004aba5e05acc115f02111'))
+
+        db.charging_engine_paymenttimeout.drop()
+
+
+class InvoiceQueueTestCase(TestCase):
+
+    tags = ('invoices',)
+    fixtures = ['async.json']
+
+    def setUp(self):
+        self._subprocess = FakeSubprocess()
+        invoice_renderer.subprocess = self._subprocess
+
+    def tearDown(self):
+        settings.ASYNC_INVOICE_GENERATION = False
+        self._subprocess.remove_files()
+        super(InvoiceQueueTestCase, self).tearDown()
+
+    def _create_file(self, name):
+        path = os.path.join(settings.BILL_ROOT, name)
+        with open(path, 'w') as f:
+            f.write('<html></html>')
+
+        return path
+
+    def test_async_invoice_generation(self):
+        settings.ASYNC_INVOICE_GENERATION = True
+
+        url = '/media/bills/61004aba5e05acc115f022f0_2015-01-01.pdf'
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        purchase.pending_bills.append(url)
+        purchase.save()
+
+        bill_path = self._create_file('61004aba5e05acc115f022f0_2015-01-01.html')
+        other_path = self._create_file('61004aba5e05acc115f033333_2015-01-01.html')
+
+        job_id = invoice_queue.submit_invoice_job(purchase, bill_path, bill_path[:-4] + 'pdf', url)
+
+        # Wait for the worker
+        invoice_queue._jobs.join()
+
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        self.assertEquals(purchase.bill, [url])
+        self.assertEquals(purchase.pending_bills, [])
+
+        # Only the files of the job have been removed
+        self.assertFalse(os.path.exists(bill_path))
+        self.assertTrue(os.path.exists(other_path))
+        os.remove(other_path)
+
+        db = get_database_connection()
+        self.assertEquals(db.charging_engine_invoicejob.find_one({'_id': job_id}), None)
+
+    def test_invoice_batch(self):
+        db = get_database_connection()
+        purchase_id = ObjectId('61004aba5e05acc115f022f0')
+        urls = ['/media/bills/61004aba5e05acc115f022f0_2015-01-01.pdf', '/media/bills/61004aba5e05acc115f022f0_2015-02-01.pdf']
+        db.wstore_purchase.update({'_id': purchase_id}, {'$set': {'pending_bills': urls}})
+
+        paths = []
+        for url, render_time in zip(urls, (0.5, None)):
+            bill_path = self._create_file(url.split('/')[-1][:-3] + 'html')
+            paths.append(bill_path)
+
+            db.charging_engine_invoicejob.insert({
+                'purchase_id': purchase_id,
+                'bill_path': bill_path,
+                'pdf_path': bill_path[:-4] + 'pdf',
+                'url': url,
+                'state': 'pending',
+                'render_time': render_time
+            })
+
+        out = StringIO()
+        call_command('generate_invoices', stdout=out)
+
+        # The invoices have been compiled by a single converter process
+        self.assertEquals(self._subprocess.batches, [
+            '"' + paths[0] + '" "' + paths[0][:-4] + 'pdf"\n"' + paths[1] + '" "' + paths[1][:-4] + 'pdf"\n'
+        ])
+
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        self.assertEquals(purchase.bill, urls)
+        self.assertEquals(purchase.pending_bills, [])
+
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith(urls[0] + ': rendered in 0.500 s, compiled in'))
+        self.assertTrue(lines[1].startswith(urls[1] + ': compiled in'))
+        self.assertEquals(lines[2], '2 invoices have been generated')
+
+    def _insert_job(self, name, **fields):
+        bill_path = self._create_file(name + '.html')
+        job = {
+            'purchase_id': ObjectId('61004aba5e05acc115f022f0'),
+            'bill_path': bill_path,
+            'pdf_path': bill_path[:-4] + 'pdf',
+            'url': '/media/bills/' + name + '.pdf',
+            'render_time': None
+        }
+        job.update(fields)
+
+        return get_database_connection().charging_engine_invoicejob.insert(job)
+
+    def test_invoice_jobs_reclaimed(self):
+        now = datetime.now()
+        stale_id = self._insert_job('61004aba5e05acc115f022f0_2015-01-01', state='running', claimed=now - timedelta(hours=1), attempts=1)
+        live_id = self._insert_job('61004aba5e05acc115f022f0_2015-02-01', state='running', claimed=now, attempts=1)
+        failed_id = self._insert_job('61004aba5e05acc115f022f0_2015-03-01', state='failed', claimed=now, attempts=1)
+        exhausted_id = self._insert_job('61004aba5e05acc115f022f0_2015-04-01', state='failed', claimed=now, attempts=invoice_queue.MAX_JOB_ATTEMPTS)
+
+        jobs, failed = invoice_queue.process_invoice_jobs(batch_size=10)
+
+        # Only the stale and the retryable failed jobs are processed
+        self.assertEquals([job['_id'] for job in jobs], [stale_id, failed_id])
+        self.assertEquals([job['attempts'] for job in jobs], [2, 2])
+        self.assertEquals(failed, [])
+
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        self.assertEquals(purchase.bill, [
+            '/media/bills/61004aba5e05acc115f022f0_2015-01-01.pdf',
+            '/media/bills/61004aba5e05acc115f022f0_2015-03-01.pdf'
+        ])
+
+        db = get_database_connection()
+        self.assertEquals(db.charging_engine_invoicejob.find_one({'_id': live_id})['state'], 'running')
+        self.assertEquals(db.charging_engine_invoicejob.find_one({'_id': exhausted_id})['state'], 'failed')
+
+        for job in db.charging_engine_invoicejob.find():
+            os.remove(job['bill_path'])
+
+        db.charging_engine_invoicejob.drop()
+
+    def test_invoice_batch_partially_failed(self):
+        ok_id = self._insert_job('61004aba5e05acc115f022f0_2015-01-01', state='pending')
+        failed_id = self._insert_job('61004aba5e05acc115f022f0_2015-02-01', state='pending')
+
+        db = get_database_connection()
+        db.wstore_purchase.update({'_id': ObjectId('61004aba5e05acc115f022f0')}, {'$set': {'pending_bills': [
+            '/media/bills/61004aba5e05acc115f022f0_2015-01-01.pdf',
+            '/media/bills/61004aba5e05acc115f022f0_2015-02-01.pdf'
+        ]}})
+        failed_job = db.charging_engine_invoicejob.find_one({'_id': failed_id})
+        self._subprocess = FakeSubprocess(missing=(failed_job['pdf_path'],))
+        invoice_renderer.subprocess = self._subprocess
+
+        out = StringIO()
+        call_command('generate_invoices', stdout=out)
+
+        # The invoice whose PDF has been generated is not failed with the other
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        self.assertEquals(purchase.bill, ['/media/bills/61004aba5e05acc115f022f0_2015-01-01.pdf'])
+        self.assertEquals(db.charging_engine_invoicejob.find_one({'_id': ok_id}), None)
+
+        # The failed invoice is retried until it runs out of attempts
+        job = db.charging_engine_invoicejob.find_one({'_id': failed_id})
+        self.assertEquals(job['state'], 'failed')
+        self.assertEquals(job['attempts'], invoice_queue.MAX_JOB_ATTEMPTS)
+
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('/media/bills/61004aba5e05acc115f022f0_2015-01-01.pdf: compiled in'))
+        self.assertEquals(lines[1], '/media/bills/61004aba5e05acc115f022f0_2015-02-01.pdf: failed (attempt 1)')
+        self.assertEquals(lines[-2], '1 invoices have been generated')
+        self.assertEquals(lines[-1], str(invoice_queue.MAX_JOB_ATTEMPTS) + ' invoice generation attempts have failed')
+
+        # The failed bill is not pending anymore but its HTML code is kept
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        self.assertEquals(purchase.pending_bills, [])
+        self.assertTrue(os.path.exists(failed_job['bill_path']))
+
+        # The operator can generate it again
+        self._subprocess.remove_files()
+        self._subprocess = FakeSubprocess()
+        invoice_renderer.subprocess = self._subprocess
+
+        out = StringIO()
+        call_command('generate_invoices', retry_failed=True, stdout=out)
+
+        lines = out.getvalue().splitlines()
+        self.assertEquals(lines[0], '1 failed invoices will be generated again')
+        self.assertEquals(lines[-1], '1 invoices have been generated')
+
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        self.assertEquals(purchase.bill, [
+            '/media/bills/61004aba5e05acc115f022f0_2015-01-01.pdf',
+            '/media/bills/61004aba5e05acc115f022f0_2015-02-01.pdf'
+        ])
+        self.assertFalse(os.path.exists(failed_job['bill_path']))
+        self.assertEquals(db.charging_engine_invoicejob.find_one({'_id': failed_id}), None)
+
+    def _test_invoice_not_generated(self):
+        url = '/media/bills/61004aba5e05acc115f022f0_2015-01-01.pdf'
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        purchase.pending_bills.append(url)
+        purchase.save()
+
+        bill_path = self._create_file('61004aba5e05acc115f022f0_2015-01-01.html')
+
+        error = None
+        try:
+            invoice_queue.submit_invoice_job(purchase, bill_path, bill_path[:-4] + 'pdf', url)
+        except Exception, e:
+            error = e
+
+        self.assertEquals(unicode(error), 'Invoice generation problem')
+
+        # The job is kept as failed and the bill is still pending
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        self.assertEquals(purchase.bill, [])
+        self.assertEquals(purchase.pending_bills, [url])
+
+        db = get_database_connection()
+        self.assertEquals(db.charging_engine_invoicejob.find_one({'url': url})['state'], 'failed')
+
+        # The HTML code is kept in order to retry the job
+        self.assertTrue(os.path.exists(bill_path))
+        os.remove(bill_path)
+
+        db.charging_engine_invoicejob.drop()
+
+    def test_invoice_converter_failed(self):
+        self._subprocess = FakeSubprocess(returncode=1)
+        invoice_renderer.subprocess = self._subprocess
+        self._test_invoice_not_generated()
+
+    def test_invoice_pdf_missing(self):
+        # The converter finishes without creating the PDF file
+        converter = MagicMock()
+        converter.returncode = 0
+        invoice_renderer.subprocess.Popen = MagicMock(return_value=converter)
+        self._test_invoice_not_generated()
+
+    def test_bill_template_compiled_once(self):
+        template = invoice_renderer.get_bill_template('use')
+        self.assertTrue(invoice_renderer.get_bill_template('use') is template)
+
+
+class PaymentClientRegistryTestCase(TestCase):
+
+    tags = ('payment-client',)
+
+    def setUp(self):
+        self._client = settings.PAYMENT_CLIENT
+        self._import_module = client_registry.import_module
+
+    def tearDown(self):
+        settings.PAYMENT_CLIENT = self._client
+        client_registry.import_module = self._import_module
+
+    def test_payment_client_loaded_once(self):
+        module = MagicMock()
+        module.RegistryClient = FakeClient
+        client_registry.import_module = MagicMock(return_value=module)
+
+        settings.PAYMENT_CLIENT = 'wstore.charging_engine.test.RegistryClient'
+        purchase = MagicMock()
+
+        client = client_registry.get_payment_client(purchase)
+        client_registry.get_payment_client(purchase)
+
+        self.assertTrue(isinstance(client, FakeClient))
+        client_registry.import_module.assert_called_once_with('wstore.charging_engine.test')
+
+    def test_http_session_shared(self):
+        self.assertTrue(client_registry.get_http_session() is client_registry.get_http_session())
+
 
 class ChargingDaemonTestCase(TestCase):
 
@@ -1124,8 +1620,23 @@ class ChargingDaemonTestCase(TestCase):
 
         resolve_use_charging.ChargingEngine = FakeChargingEngine
         cls._command = resolve_use_charging.Command()
+        cls._command.stdout = StringIO()
         super(ChargingDaemonTestCase, cls).setUpClass()
 
+    def tearDown(self):
+        get_database_connection().charging_engine_chargingrun.drop()
+        super(ChargingDaemonTestCase, self).tearDown()
+
+    def _fill_payment_info(self):
+        user = User.objects.get(pk='51000aba8e05ac2115f022f9')
+        org = Organization.objects.get(pk='91000aba8e06ac2115f022f0')
+
+        user.userprofile.organization = org
+        user.userprofile.payment_info = {
+        }
+
+        user.userprofile.save()
+
     def test_basic_charging_daemon(self):
 
         # Fill userprofile model
@@ -1141,14 +1652,7 @@ class ChargingDaemonTestCase(TestCase):
         purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
 
         # Add dateinfo to sdr
-        pending_sdrs = []
-        pending_sdrs.append({
-            'time_stamp': datetime(2013, 04, 01, 00, 00, 00, 00)
-        })
-
-        purchase.contract.pending_sdrs = pending_sdrs
-
-        purchase.contract.save()
+        fill_pending_sdrs(purchase.contract, [datetime(2013, 04, 01, 00, 00, 00, 00)])
 
         # Run the method
         self._command.handle()
@@ -1158,8 +1662,8 @@ class ChargingDaemonTestCase(TestCase):
 
         contract = purchase.contract
 
-        self.assertEqual(len(contract.pending_sdrs), 0)
-        self.assertEqual(len(contract.applied_sdrs), 1)
+        self.assertEqual(len(get_sdrs(contract, 'pending')), 0)
+        self.assertEqual(len(get_sdrs(contract, 'applied')), 1)
 
     def test_charging_daemon_multiple_sdrs(self):
 
@@ -1176,20 +1680,11 @@ class ChargingDaemonTestCase(TestCase):
         purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
 
         # Add dateinfo to sdr
-        pending_sdrs = []
-        pending_sdrs.append({
-            'time_stamp': datetime(2013, 04, 01, 00, 00, 00, 00)
-        })
-        pending_sdrs.append({
-            'time_stamp': datetime(2013, 04, 02, 00, 00, 00, 00)
-        })
-        pending_sdrs.append({
-            'time_stamp': datetime(2013, 04, 03, 00, 00, 00, 00)
-        })
-
-        purchase.contract.pending_sdrs = pending_sdrs
-
-        purchase.contract.save()
+        fill_pending_sdrs(purchase.contract, [
+            datetime(2013, 04, 01, 00, 00, 00, 00),
+            datetime(2013, 04, 02, 00, 00, 00, 00),
+            datetime(2013, 04, 03, 00, 00, 00, 00)
+        ])
 
         # Run the method
         self._command.handle()
@@ -1199,8 +1694,8 @@ class ChargingDaemonTestCase(TestCase):
 
         contract = purchase.contract
 
-        self.assertEqual(len(contract.pending_sdrs), 0)
-        self.assertEqual(len(contract.applied_sdrs), 3)
+        self.assertEqual(len(get_sdrs(contract, 'pending')), 0)
+        self.assertEqual(len(get_sdrs(contract, 'applied')), 3)
 
     def test_charging_daemon_multiple_contracts(self):
 
@@ -1218,27 +1713,12 @@ class ChargingDaemonTestCase(TestCase):
         purchase_2 = Purchase.objects.get(pk='61004aba5e05acc115f03333')
 
         # Add dateinfo to sdr
-        pending_sdrs_1 = []
-        pending_sdrs_1.append({
-            'time_stamp': datetime(2013, 04, 01, 00, 00, 00, 00)
-        })
-
-        pending_sdrs_2 = []
-        pending_sdrs_2.append({
-            'time_stamp': datetime(2013, 04, 01, 00, 00, 00, 00)
-        })
-        pending_sdrs_2.append({
-            'time_stamp': datetime(2013, 04, 02, 00, 00, 00, 00)
-        })
-        pending_sdrs_2.append({
-            'time_stamp': datetime(2013, 04, 03, 00, 00, 00, 00)
-        })
-
-        purchase_1.contract.pending_sdrs = pending_sdrs_1
-        purchase_1.contract.save()
-
-        purchase_2.contract.pending_sdrs = pending_sdrs_2
-        purchase_2.contract.save()
+        fill_pending_sdrs(purchase_1.contract, [datetime(2013, 04, 01, 00, 00, 00, 00)])
+        fill_pending_sdrs(purchase_2.contract, [
+            datetime(2013, 04, 01, 00, 00, 00, 00),
+            datetime(2013, 04, 02, 00, 00, 00, 00),
+            datetime(2013, 04, 03, 00, 00, 00, 00)
+        ])
 
         # Run the method
         self._command.handle()
@@ -1248,16 +1728,16 @@ class ChargingDaemonTestCase(TestCase):
 
         contract = purchase_1.contract
 
-        self.assertEqual(len(contract.pending_sdrs), 0)
-        self.assertEqual(len(contract.applied_sdrs), 1)
+        self.assertEqual(len(get_sdrs(contract, 'pending')), 0)
+        self.assertEqual(len(get_sdrs(contract, 'applied')), 1)
 
         # Check the first contract
         purchase_2 = Purchase.objects.get(pk='61004aba5e05acc115f03333')
 
         contract = purchase_2.contract
 
-        self.assertEqual(len(contract.pending_sdrs), 0)
-        self.assertEqual(len(contract.applied_sdrs), 3)
+        self.assertEqual(len(get_sdrs(contract, 'pending')), 0)
+        self.assertEqual(len(get_sdrs(contract, 'applied')), 3)
 
     def test_charging_daemon_organization_purchased(self):
 
@@ -1275,14 +1755,7 @@ class ChargingDaemonTestCase(TestCase):
         purchase = Purchase.objects.get(pk='61004aba5e05acc115f08888')
 
         # Add dateinfo to sdr
-        pending_sdrs = []
-        pending_sdrs.append({
-            'time_stamp': datetime(2013, 04, 01, 00, 00, 00, 00)
-        })
-
-        purchase.contract.pending_sdrs = pending_sdrs
-
-        purchase.contract.save()
+        fill_pending_sdrs(purchase.contract, [datetime(2013, 04, 01, 00, 00, 00, 00)])
 
         # Run the method
         self._command.handle()
@@ -1292,8 +1765,8 @@ class ChargingDaemonTestCase(TestCase):
 
         contract = purchase.contract
 
-        self.assertEqual(len(contract.pending_sdrs), 0)
-        self.assertEqual(len(contract.applied_sdrs), 1)
+        self.assertEqual(len(get_sdrs(contract, 'pending')), 0)
+        self.assertEqual(len(get_sdrs(contract, 'applied')), 1)
 
     def test_charging_daemon_now_time(self):
 
@@ -1310,14 +1783,7 @@ class ChargingDaemonTestCase(TestCase):
         purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
 
         # Add dateinfo to sdr
-        pending_sdrs = []
-        pending_sdrs.append({
-            'time_stamp': datetime.now()
-        })
-
-        purchase.contract.pending_sdrs = pending_sdrs
-
-        purchase.contract.save()
+        fill_pending_sdrs(purchase.contract, [datetime.now()])
 
         # Run the method
         self._command.handle()
@@ -1327,29 +1793,399 @@ class ChargingDaemonTestCase(TestCase):
 
         contract = purchase.contract
 
-        self.assertEqual(len(contract.pending_sdrs), 1)
-        self.assertEqual(len(contract.applied_sdrs), 0)
+        self.assertEqual(len(get_sdrs(contract, 'pending')), 1)
+        self.assertEqual(len(get_sdrs(contract, 'applied')), 0)
 
+    def test_charging_daemon_workers(self):
 
-class AdaptorWrapperThread():
+        self._fill_payment_info()
+
+        purchase_1 = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        purchase_2 = Purchase.objects.get(pk='61004aba5e05acc115f03333')
+
+        fill_pending_sdrs(purchase_1.contract, [datetime(2013, 04, 01, 00, 00, 00, 00)])
+        fill_pending_sdrs(purchase_2.contract, [
+            datetime(2013, 04, 01, 00, 00, 00, 00),
+            datetime(2013, 04, 02, 00, 00, 00, 00)
+        ])
+
+        # Run the method using a pool of workers
+        self._command.handle(workers=2)
+
+        self.assertEqual(len(get_sdrs(purchase_1.contract, 'pending')), 0)
+        self.assertEqual(len(get_sdrs(purchase_2.contract, 'pending')), 0)
+        self.assertEqual(len(get_sdrs(purchase_2.contract, 'applied')), 2)
+
+        # The run is saved as finished
+        db = get_database_connection()
+        run = db.charging_engine_chargingrun.find_one()
+
+        self.assertEqual(run['state'], 'finished')
+        self.assertEqual(len(run['processed']), 2)
+        self.assertEqual(run['in_progress'], [])
+
+    def test_charging_daemon_resume(self):
+
+        self._fill_payment_info()
+
+        purchase_1 = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        purchase_2 = Purchase.objects.get(pk='61004aba5e05acc115f03333')
+        purchase_3 = Purchase.objects.get(pk='61004aba5e05acc115f08888')
+
+        for purchase in (purchase_1, purchase_2, purchase_3):
+            fill_pending_sdrs(purchase.contract, [datetime(2013, 04, 01, 00, 00, 00, 00)])
+
+        # Save an interrupted run where the first contract was charged
+        # and the charging of the second one was in progress
+        db = get_database_connection()
+        db.charging_engine_chargingrun.insert({
+            'cycle_end': datetime.now(),
+            'state': 'running',
+            'processed': [ObjectId(purchase_1.contract.pk)],
+            'in_progress': [ObjectId(purchase_2.contract.pk)],
+            'failed': []
+        })
+
+        stdout = StringIO()
+        self._command.stdout = stdout
+        self._command.handle()
+        self._command.stdout = StringIO()
+
+        # Only the last contract has been charged
+        self.assertEqual(len(get_sdrs(purchase_1.contract, 'pending')), 1)
+        self.assertEqual(len(get_sdrs(purchase_2.contract, 'pending')), 1)
+        self.assertEqual(len(get_sdrs(purchase_3.contract, 'pending')), 0)
+
+        self.assertTrue('The charging of contract ' + purchase_2.contract.pk + ' was interrupted' in stdout.getvalue())
+        self.assertTrue('Charged contracts: 1' in stdout.getvalue())
+
+        run = db.charging_engine_chargingrun.find_one()
+        self.assertEqual(run['state'], 'finished')
+
+    def _save_running(self, lease):
+        db = get_database_connection()
+        db.charging_engine_chargingrun.insert({
+            'cycle_end': datetime.now(),
+            'state': 'running',
+            'owner': ObjectId(),
+            'lease': lease,
+            'active': True,
+            'processed': [],
+            'in_progress': [],
+            'failed': []
+        })
+
+    def test_charging_daemon_live_run(self):
+
+        self._fill_payment_info()
+
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        fill_pending_sdrs(purchase.contract, [datetime(2013, 04, 01, 00, 00, 00, 00)])
+
+        # A run whose lease is alive is being executed by another process
+        self._save_running(datetime.now() + timedelta(minutes=5))
+
+        error = None
+        try:
+            self._command.handle()
+        except Exception as e:
+            error = e
+
+        self.assertEqual(unicode(error), 'Another charging run is in progress')
+        self.assertEqual(len(get_sdrs(purchase.contract, 'pending')), 1)
+
+    def test_charging_daemon_expired_run(self):
+
+        self._fill_payment_info()
+
+        purchase = Purchase.objects.get(pk='61004aba5e05acc115f022f0')
+        fill_pending_sdrs(purchase.contract, [datetime(2013, 04, 01, 00, 00, 00, 00)])
+
+        # The lease of a crashed run expires, so the run is resumed
+        self._save_running(datetime.now() - timedelta(minutes=5))
+        self._command.handle()
+
+        self.assertEqual(len(get_sdrs(purchase.contract, 'pending')), 0)
+
+        db = get_database_connection()
+        run = db.charging_engine_chargingrun.find_one()
+        self.assertEqual(run['state'], 'finished')
+        self.assertFalse('active' in run)
+
+
+class FakeCDRQueue():
 
     _context = None
-    _url = None
-    _cdr = None
 
     def __init__(self, context):
         self._context = context
 
-    def __call__(self, url, cdr):
-        self._url = url
-        self._cdr = cdr
-        return self
-
-    def start(self):
-        self._context._cdrs = self._cdr
+    def __call__(self, rss, cdrs):
+        self._context._cdrs = cdrs
 
 
 @override_settings(STORE_NAME='wstore')
+class RenovationSchedulerTestCase(TestCase):
+
+    tags = ('renovation-scheduler',)
+    fixtures = ['use_daemon.json']
+
+    _contracts = ('61000b3a8805ac21161020f9', '61000b3a8805ac2116105555', '61000b3a8805ac2116666666')
+
+    def setUp(self):
+        self._renovate_contract = renovation_scheduler.renovate_contract
+        renovation_scheduler.renovate_contract = MagicMock()
+        self._now = datetime(2015, 3, 10, 12, 0, 0)
+
+    def tearDown(self):
+        renovation_scheduler.renovate_contract = self._renovate_contract
+        super(RenovationSchedulerTestCase, self).tearDown()
+
+    def _set_next_renovations(self, dates):
+        db = get_database_connection()
+        for contract_id, date in zip(self._contracts, dates):
+            db.charging_engine_contract.update(
+                {'_id': ObjectId(contract_id)},
+                {'$set': {'next_renovation': date}}
+            )
+
+    def test_due_renovations(self):
+        self._set_next_renovations([
+            self._now - timedelta(hours=1),
+            self._now - timedelta(days=2),
+            self._now + timedelta(days=1)
+        ])
+
+        results = renovation_scheduler.process_due_renovations(batch_size=1, now=self._now)
+        self.assertEquals(results, [(ObjectId(self._contracts[1]), 'renovated')])
+
+        results = renovation_scheduler.process_due_renovations(now=self._now)
+        self.assertEquals(results, [(ObjectId(self._contracts[0]), 'renovated')])
+
+        # The processed renovations are reserved
+        self.assertEquals(renovation_scheduler.process_due_renovations(now=self._now), [])
+        contract = get_database_connection().charging_engine_contract.find_one({'_id': ObjectId(self._contracts[0])})
+        self.assertEquals(contract['next_renovation'], self._now + timedelta(seconds=renovation_scheduler.RENOVATION_LEASE))
+
+    def test_due_renovation_failed(self):
+        self._set_next_renovations([self._now - timedelta(hours=1)])
+        renovation_scheduler.renovate_contract.side_effect = Exception('Payment error')
+
+        results = renovation_scheduler.process_due_renovations(now=self._now)
+        self.assertEquals(results, [(ObjectId(self._contracts[0]), 'failed: Payment error')])
+
+        # The renovation is retried with backoff
+        contract = get_database_connection().charging_engine_contract.find_one({'_id': ObjectId(self._contracts[0])})
+        self.assertEquals(contract['next_renovation'], self._now + timedelta(seconds=renovation_scheduler.RETRY_DELAY))
+        self.assertEquals(contract['renovation_attempts'], 1)
+
+    def test_due_renovation_exhausted(self):
+        self._set_next_renovations([self._now - timedelta(hours=1)])
+        renovation_scheduler.renovate_contract.side_effect = Exception('Payment error')
+
+        notify = renovation_scheduler._notify_renovation_failed
+        renovation_scheduler._notify_renovation_failed = MagicMock()
+
+        try:
+            get_database_connection().charging_engine_contract.update(
+                {'_id': ObjectId(self._contracts[0])},
+                {'$set': {'renovation_attempts': renovation_scheduler.MAX_RENOVATION_ATTEMPTS - 1}}
+            )
+
+            results = renovation_scheduler.process_due_renovations(now=self._now)
+            self.assertEquals(results, [(ObjectId(self._contracts[0]), 'renewal_failed: Payment error')])
+            renovation_scheduler._notify_renovation_failed.assert_called_once_with(ObjectId(self._contracts[0]))
+        finally:
+            renovation_scheduler._notify_renovation_failed = notify
+
+        # The renovation is not scheduled again
+        contract = get_database_connection().charging_engine_contract.find_one({'_id': ObjectId(self._contracts[0])})
+        self.assertEquals(contract['next_renovation'], None)
+        self.assertEquals(contract['renovation_state'], 'renewal_failed')
+        self.assertEquals(renovation_scheduler.process_due_renovations(now=self._now + timedelta(days=30)), [])
+
+        # The customer can still renew the subscription
+        previous = renovation_scheduler.claim_customer_renovation(self._contracts[0], now=self._now)
+        self.assertEquals(previous, None)
+
+    def test_customer_renovation(self):
+        self._set_next_renovations([self._now + timedelta(days=1), self._now - timedelta(hours=1)])
+
+        # Renovations that are not due cannot be requested
+        self.assertRaises(ValueError, renovation_scheduler.claim_customer_renovation, self._contracts[0], self._now)
+
+        # Reserved renovations are not charged by the scheduler
+        previous = renovation_scheduler.claim_customer_renovation(self._contracts[1], now=self._now)
+        self.assertEquals(previous, self._now - timedelta(hours=1))
+        self.assertEquals(renovation_scheduler.process_due_renovations(now=self._now), [])
+        self.assertRaises(ValueError, renovation_scheduler.claim_customer_renovation, self._contracts[1], self._now)
+
+        # A failed charge restores the renovation date
+        renovation_scheduler.release_renovation(self._contracts[1])
+        results = renovation_scheduler.process_due_renovations(now=self._now)
+        self.assertEquals(results, [(ObjectId(self._contracts[1]), 'renovated')])
+
+        contract = get_database_connection().charging_engine_contract.find_one({'_id': ObjectId(self._contracts[1])})
+        self.assertEquals(contract['renovation_claim'], {})
+
+    def test_customer_renovation_rollback(self):
+        self._set_next_renovations([self._now - timedelta(hours=1)])
+        renovation_scheduler.claim_customer_renovation(self._contracts[0], now=self._now)
+
+        # The payment of the customer times out, the contract has
+        # previous charges so it is kept
+        contract = Contract.objects.get(pk=self._contracts[0])
+        contract.charges = [{'cost': 5}]
+        contract.save()
+
+        purchase = contract.purchase
+        purchase.state = 'pending'
+        purchase.save()
+
+        search_engine = purchase_rollback.SearchEngine
+        purchase_rollback.SearchEngine = MagicMock()
+        try:
+            purchase_rollback.rollback(purchase)
+        finally:
+            purchase_rollback.SearchEngine = search_engine
+
+        contract = get_database_connection().charging_engine_contract.find_one({'_id': ObjectId(self._contracts[0])})
+        self.assertEquals(contract['next_renovation'], self._now - timedelta(hours=1))
+        self.assertEquals(contract['renovation_claim'], {})
+
+    def test_renovation_forecast(self):
+        self._set_next_renovations([
+            self._now - timedelta(days=3),
+            self._now + timedelta(hours=2),
+            self._now + timedelta(days=1)
+        ])
+
+        forecast = renovation_scheduler.get_renovation_forecast(3, now=self._now)
+        self.assertEquals(forecast, [
+            (self._now.date(), 2),
+            (self._now.date() + timedelta(days=1), 1),
+            (self._now.date() + timedelta(days=2), 0)
+        ])
+
+    def test_update_next_renovations(self):
+        get_database_connection().charging_engine_contract.update(
+            {'_id': ObjectId(self._contracts[0])},
+            {'$set': {'pricing_model.subscription': [{
+                'unit': 'per month',
+                'renovation_date': '2015-04-01 10:00:00'
+            }, {
+                'unit': 'per week',
+                'renovation_date': datetime(2015, 3, 20, 10, 0, 0)
+            }]}}
+        )
+
+        self.assertEquals(renovation_scheduler.update_next_renovations(), 1)
+
+        contract = get_database_connection().charging_engine_contract.find_one({'_id': ObjectId(self._contracts[0])})
+        self.assertEquals(contract['next_renovation'], datetime(2015, 3, 20, 10, 0, 0))
+
+        # The contract is not updated twice
+        self.assertEquals(renovation_scheduler.update_next_renovations(), 0)
+
+
+class BalanceCacheTestCase(TestCase):
+
+    tags = ('balance-cache',)
+
+    def setUp(self):
+        self._now = datetime(2015, 3, 10, 12, 0, 0)
+        self._actor = MagicMock(pk='91000aba8e06ac2115f022f0')
+        self._actor.expenditure_limits = {
+            'currency': 'EUR',
+            'perTransaction': 100.0,
+            'daily': 200.0
+        }
+
+        self._factory = balance_cache.RSSManagerFactory
+        self._exp_manager = MagicMock()
+        balance_cache.RSSManagerFactory = MagicMock()
+        balance_cache.RSSManagerFactory.return_value.get_expenditure_manager.return_value = self._exp_manager
+
+    def tearDown(self):
+        balance_cache.RSSManagerFactory = self._factory
+        get_database_connection().charging_engine_balance.drop()
+        get_database_connection().charging_engine_balancebucket.drop()
+        super(BalanceCacheTestCase, self).tearDown()
+
+    def _create_account(self, since):
+        balance_cache._load_account(self._actor.pk, since)
+        balance_cache._load_account(balance_cache.PROVIDER_ACCOUNT, since)
+        balance_cache.mark_synced(self._actor, self._now)
+
+    @parameterized.expand([
+        ('far_from_limits', 10.0, timedelta(days=2), {}, True),
+        ('not_synced', 10.0, timedelta(days=2), {}, False, False),
+        ('transaction_limit', 95.0, timedelta(days=2), {}, False),
+        ('daily_limit', 10.0, timedelta(days=2), {'currency': 'EUR', 'daily': 1000.0}, False, True, 175.0),
+        ('short_history', 10.0, timedelta(hours=2), {}, False),
+        ('other_currency', 10.0, timedelta(days=2), {}, False, True, 0, 'USD'),
+        ('provider_limit', 10.0, timedelta(days=2), {'currency': 'EUR', 'daily': 20.0}, False, True, 10.0)
+    ])
+    def test_local_balance_check(self, name, amount, history, provider_limits, expected, synced=True, spent=0, currency='EUR'):
+        if synced:
+            self._create_account(self._now - history)
+        else:
+            balance_cache._load_account(self._actor.pk, self._now - history)
+
+        if spent:
+            balance_cache.record_charge(self._actor, {'currency': 'EUR', 'amount': spent}, self._now - timedelta(hours=1))
+
+        charge = {'currency': currency, 'amount': amount}
+        self.assertEquals(balance_cache.can_charge_locally(self._actor, charge, provider_limits, now=self._now), expected)
+
+    def test_charges_aggregated(self):
+        self._create_account(self._now - timedelta(days=40))
+
+        balance_cache.record_charge(self._actor, {'currency': 'EUR', 'amount': 10}, self._now - timedelta(days=35))
+        balance_cache.record_charge(self._actor, {'currency': 'EUR', 'amount': 10}, self._now - timedelta(hours=2))
+        balance_cache.record_charge(self._actor, {'currency': 'EUR', 'amount': 5.5}, self._now - timedelta(hours=1))
+
+        # The charges of a day are saved in a single bucket per account
+        buckets = get_database_connection().charging_engine_balancebucket
+        bucket = buckets.find_one({'account': self._actor.pk, 'day': datetime(2015, 3, 10)})
+        self.assertEquals(bucket['amount'], 15.5)
+        self.assertEquals(buckets.find({'account': balance_cache.PROVIDER_ACCOUNT}).count(), 2)
+
+        self.assertEquals(balance_cache._get_spent(self._actor.pk, 'EUR', self._now - timedelta(days=1)), 15.5)
+
+        # The buckets out of the limit periods are removed
+        balance_cache.mark_synced(self._actor, self._now)
+        self.assertEquals(buckets.find({'account': balance_cache.PROVIDER_ACCOUNT}).count(), 1)
+
+    def test_balance_sync(self):
+        self._create_account(self._now - timedelta(days=2))
+
+        balance_cache.record_charge(self._actor, {'currency': 'EUR', 'amount': 10}, self._now)
+        balance_cache.record_charge(self._actor, {'currency': 'EUR', 'amount': 5.5}, self._now)
+
+        # The pending charges are sent in a single request
+        balance_cache.sync_balance(MagicMock(), self._actor, self._now)
+        self._exp_manager.update_balance.assert_called_once_with({'currency': 'EUR', 'amount': 15.5}, self._actor)
+
+        self._exp_manager.update_balance.reset_mock()
+        balance_cache.sync_balance(MagicMock(), self._actor, self._now)
+        self.assertEquals(self._exp_manager.update_balance.call_count, 0)
+
+    def test_balance_sync_failed(self):
+        self._create_account(self._now - timedelta(days=2))
+        balance_cache.record_charge(self._actor, {'currency': 'EUR', 'amount': 10}, self._now)
+        self._exp_manager.update_balance.side_effect = Exception('RSS error')
+
+        try:
+            balance_cache.sync_balance(MagicMock(), self._actor, self._now)
+        except Exception:
+            pass
+
+        # The charges are sent again later
+        account = get_database_connection().charging_engine_balance.find_one({'_id': self._actor.pk})
+        self.assertEquals(account['pending'], {'EUR': 10.0})
+
+
 class CDRGeranationTestCase(TestCase):
 
     tags = ('fiware-ut-18',)
@@ -1358,7 +2194,7 @@ class CDRGeranationTestCase(TestCase):
 
     @classmethod
     def setUpClass(cls):
-        charging_engine.RSSAdaptorThread = AdaptorWrapperThread(cls)
+        charging_engine.enqueue_cdrs = FakeCDRQueue(cls)
         charging_engine.get_country_code = lambda x: '1'
         charging_engine.get_curency_code = lambda x: '1'
         super(CDRGeranationTestCase, cls).setUpClass()
@@ -1554,6 +2390,30 @@ class CDRGeranationTestCase(TestCase):
         self.assertEqual(cdr['country'], '1')
         self.assertEqual(cdr['customer'], 'test_user')
 
+    def test_correlation_block_allocation(self):
+        org = Organization.objects.get(name='test_user')
+        rss = RSS.objects.get(pk='90000ab08e06a02115098123')
+        rss.api_version = 2
+
+        self.assertEqual(correlation_allocator.allocate_correlation_numbers(rss, org, 3), [0, 1, 2])
+        self.assertEqual(correlation_allocator.allocate_correlation_numbers(rss, org, 2), [3, 4])
+        self.assertEqual(Organization.objects.get(name='test_user').correlation_number, 5)
+
+    @override_settings(CDR_CORRELATION_RESERVE=10)
+    def test_correlation_block_reserve(self):
+        correlation_allocator._rss_reserve = correlation_allocator.RSSCorrelationReserve()
+        rss = RSS.objects.get(pk='90000ab08e06a02115098123')
+        rss.api_version = 1
+
+        # The numbers are taken from the block reserved by the process
+        self.assertEqual(correlation_allocator.allocate_correlation_numbers(rss, None, 3), [0, 1, 2])
+        self.assertEqual(correlation_allocator.allocate_correlation_numbers(rss, None, 2), [3, 4])
+        self.assertEqual(RSS.objects.get(pk='90000ab08e06a02115098123').correlation_number, 10)
+
+        # A new block is reserved when the numbers are not enough
+        self.assertEqual(correlation_allocator.allocate_correlation_numbers(rss, None, 6), range(10, 16))
+        self.assertEqual(RSS.objects.get(pk='90000ab08e06a02115098123').correlation_number, 20)
+
 
 class PriceFunctionPaymentTestCase(TestCase):
 
@@ -1564,13 +2424,15 @@ class PriceFunctionPaymentTestCase(TestCase):
     def setUpClass(cls):
         cls._auth = settings.OILAUTH
         settings.PAYMENT_CLIENT = 'wstore.charging_engine.tests.FakeClient'
-        charging_engine.subprocess = FakeSubprocess()
+        invoice_renderer.subprocess = FakeSubprocess()
+        settings.ASYNC_INVOICE_GENERATION = False
         settings.OILAUTH = False
         super(PriceFunctionPaymentTestCase, cls).setUpClass()
 
     @classmethod
     def tearDownClass(cls):
         settings.OILAUTH = cls._auth
+        invoice_renderer.subprocess.remove_files()
         super(PriceFunctionPaymentTestCase, cls).tearDownClass()
 
     def test_basic_price_function_payment(self):
@@ -1617,8 +2479,8 @@ class PriceFunctionPaymentTestCase(TestCase):
         self.assertEqual(contract.charges[0]['cost'], 33.00)
         self.assertEqual(contract.charges[0]['concept'], 'pay per use')
 
-        self.assertEqual(len(contract.pending_sdrs), 0)
-        self.assertEqual(len(contract.applied_sdrs), 3)
+        self.assertEqual(len(get_sdrs(contract, 'pending')), 0)
+        self.assertEqual(len(get_sdrs(contract, 'applied')), 3)
 
     def test_price_function_payment_renovation(self):
 
@@ -1675,8 +2537,8 @@ class PriceFunctionPaymentTestCase(TestCase):
         self.assertEqual(contract.charges[0]['cost'], 38.00)
         self.assertEqual(contract.charges[0]['concept'], 'Renovation')
 
-        self.assertEqual(len(contract.pending_sdrs), 0)
-        self.assertEqual(len(contract.applied_sdrs), 3)
+        self.assertEqual(len(get_sdrs(contract, 'pending')), 0)
+        self.assertEqual(len(get_sdrs(contract, 'applied')), 3)
 
 
     def test_price_function_payment_deduction(self):
@@ -1734,14 +2596,12 @@ class PriceFunctionPaymentTestCase(TestCase):
         self.assertEqual(contract.charges[0]['cost'], 33.30)
         self.assertEqual(contract.charges[0]['concept'], 'Renovation')
 
-        self.assertEqual(len(contract.pending_sdrs), 0)
-        self.assertEqual(len(contract.applied_sdrs), 3)
+        self.assertEqual(len(get_sdrs(contract, 'pending')), 0)
+        self.assertEqual(len(get_sdrs(contract, 'applied')), 3)
 
     def test_price_function_payment_exception(self):
 
-        from wstore.charging_engine.price_resolver import PriceResolver
-
-        resolver = PriceResolver()
+        from wstore.charging_engine.price_resolver import get_compiled_function
 
         # Load testing info
         errors = {
@@ -1762,15 +2622,12 @@ class PriceFunctionPaymentTestCase(TestCase):
             }
         }
 
-        var = {
-            'arg': '3'
-        }
         # Check possible exceptions
         for err, info in errors.iteritems():
             error = False
             msg = None
             try:
-                resolver._price_function_calculation(info, var)
+                get_compiled_function({'variables': {}, 'function': info})
             except Exception, e:
                 error = True
                 msg = e.message
@@ -1778,6 +2635,94 @@ class PriceFunctionPaymentTestCase(TestCase):
             self.assertTrue(error)
             self.assertEquals(msg, err)
 
+    def test_compiled_price_function(self):
+
+        from wstore.charging_engine.price_resolver import get_compiled_function, AccountingAggregation
+
+        price_function = {
+            'variables': {
+                'call_var': {
+                    'type': 'usage',
+                    'label': 'calls'
+                },
+                'minute_var': {
+                    'type': 'usage',
+                    'label': 'Minutes'
+                },
+                'calls_constant': {
+                    'type': 'constant',
+                    'label': 'multi constant',
+                    'value': '2'
+                }
+            },
+            'function': {
+                'operation': '-',
+                'arg1': {
+                    'operation': '*',
+                    'arg1': 'call_var',
+                    'arg2': 'calls_constant'
+                },
+                'arg2': 'minute_var'
+            }
+        }
+
+        accounting = [{
+            'component_label': 'calls',
+            'value': '15'
+        }, {
+            'component_label': 'minutes',
+            'value': '7'
+        }, {
+            'component_label': 'Calls',
+            'value': '5'
+        }, {
+            'component_label': 'other',
+            'value': '100'
+        }]
+
+        compiled = get_compiled_function(price_function)
+        aggregation = AccountingAggregation([dict(sdr, unit='call') for sdr in accounting])
+
+        self.assertEquals(sorted(compiled.usage_labels), ['calls', 'minutes'])
+        self.assertEquals(compiled.evaluate_totals(aggregation.label_totals), 33.0)
+
+        # The compiled function is reused for equivalent price functions
+        self.assertTrue(get_compiled_function(deepcopy(price_function)) is compiled)
+
+    def test_accounting_aggregation(self):
+
+        from wstore.charging_engine.price_resolver import AccountingAggregation
+
+        accounting = [{
+            'unit': 'call',
+            'component_label': 'calls',
+            'value': '15'
+        }, {
+            'unit': 'Minute',
+            'component_label': 'minutes',
+            'value': '7'
+        }, {
+            'unit': 'Call',
+            'component_label': 'Calls',
+            'value': '5'
+        }, {
+            'unit': 'minute',
+            'component_label': 'other',
+            'value': '3'
+        }]
+
+        aggregation = AccountingAggregation(accounting)
+
+        self.assertEquals(aggregation.unit_totals, {'call': 20.0, 'minute': 10.0})
+        self.assertEquals(aggregation.label_totals, {'calls': 20.0, 'minutes': 7.0, 'other': 3.0})
+        self.assertEquals(aggregation.get_unit_total('hour'), 0)
+
+        self.assertEquals(aggregation.get_unit_sdrs('minute'), [accounting[1], accounting[3]])
+        self.assertEquals(aggregation.get_unit_sdrs('hour'), [])
+
+        # SDRs of several labels are returned in the received order
+        self.assertEquals(aggregation.get_label_sdrs(['other', 'calls']), [accounting[0], accounting[2], accounting[3]])
+
 
 SDR_INT1 = {
     u'component_label': u'usage',
@@ -1841,15 +2786,19 @@ SDR_INT4 = {
 
 SDR1 = deepcopy(SDR_INT1)
 SDR1['time_stamp'] = unicode(SDR1['time_stamp'])
+SDR1['correlation_number'] = unicode(SDR1['correlation_number'])
 
 SDR2 = deepcopy(SDR_INT2)
 SDR2['time_stamp'] = unicode(SDR2['time_stamp'])
+SDR2['correlation_number'] = unicode(SDR2['correlation_number'])
 
 SDR3 = deepcopy(SDR_INT3)
 SDR3['time_stamp'] = unicode(SDR3['time_stamp'])
+SDR3['correlation_number'] = unicode(SDR3['correlation_number'])
 
 SDR4 = deepcopy(SDR_INT4)
 SDR4['time_stamp'] = unicode(SDR4['time_stamp'])
+SDR4['correlation_number'] = unicode(SDR4['correlation_number'])
 
 
 class CDRRetrievingTestCase(TestCase):
@@ -1878,16 +2827,21 @@ class CDRRetrievingTestCase(TestCase):
         views.Purchase = MagicMock()
         views.Purchase.objects.get.return_value = self._purchase_mock
 
+        views.SDRManager = MagicMock()
+        self._sdr_manager = views.SDRManager.return_value
+        self._sdr_manager.get_sdrs.return_value = []
+
     def tearDown(self):
         reload(views)
 
     def _add_pending(self):
-        self._purchase_mock.contract.pending_sdrs = [deepcopy(SDR_INT1), deepcopy(SDR_INT2)]
-        self._purchase_mock.contract.applied_sdrs = []
+        self._sdr_manager.get_sdrs.return_value = [deepcopy(SDR_INT1), deepcopy(SDR_INT2)]
 
-    def _add_applied(self):
-        self._purchase_mock.contract.pending_sdrs = [deepcopy(SDR_INT3), deepcopy(SDR_INT4)]
-        self._purchase_mock.contract.applied_sdrs = [deepcopy(SDR_INT1), deepcopy(SDR_INT2)]
+    def _add_range(self):
+        self._sdr_manager.get_sdrs.return_value = [deepcopy(SDR_INT2), deepcopy(SDR_INT3)]
+
+    def _add_label(self):
+        self._sdr_manager.get_sdrs.return_value = [deepcopy(SDR_INT4)]
 
     def _not_staff(self):
         self._add_pending()
@@ -1909,9 +2863,28 @@ class CDRRetrievingTestCase(TestCase):
         views.Purchase.objects.get.side_effect = Exception('')
 
     @parameterized.expand([
-        ('basic', (200, [SDR1, SDR2]), _add_pending),
-        ('applied_from_to', (200, [SDR2, SDR3]), _add_applied, "?from=2015-09-14 10:00:01.0&to=2015-09-14 10:00:02.0"),
-        ('label', (200, [SDR4]), _add_applied, "?label=usage2"),
+        ('basic', (200, [SDR1, SDR2]), _add_pending, "", ((None, None), {
+            'label': None,
+            'after': None,
+            'limit': None
+        })),
+        ('applied_from_to', (200, [SDR2, SDR3]), _add_range, "?from=2015-09-14 10:00:01.0&to=2015-09-14 10:00:02.0", (
+            (datetime(2015, 9, 14, 10, 0, 1), datetime(2015, 9, 14, 10, 0, 2)), {
+                'label': None,
+                'after': None,
+                'limit': None
+            }
+        )),
+        ('label', (200, [SDR4]), _add_label, "?label=usage2", ((None, None), {
+            'label': 'usage2',
+            'after': None,
+            'limit': None
+        })),
+        ('paginated', (200, [SDR2, SDR3]), _add_range, "?after=1&limit=2", ((None, None), {
+            'label': None,
+            'after': 1,
+            'limit': 2
+        })),
         ('not_staff', (200, [SDR1, SDR2]), _not_staff),
         ('contract_error', (200, []), _contract_error),
         ('contract_none', (200, []), _contract_none),
@@ -1930,9 +2903,17 @@ class CDRRetrievingTestCase(TestCase):
         ('invalid_to', (400, {
             "result": "error",
             "message": 'Invalid "to" parameter, must be a datetime'
-        }), None, "?to=2015:09:14 10:00:01.0")
+        }), None, "?to=2015:09:14 10:00:01.0"),
+        ('invalid_after', (400, {
+            "result": "error",
+            "message": 'Invalid "after" parameter, must be a correlation number'
+        }), None, "?after=last"),
+        ('invalid_limit', (400, {
+            "result": "error",
+            "message": 'Invalid "limit" parameter, must be a positive integer'
+        }), None, "?limit=0")
     ])
-    def test_cdrs_retrieving(self, name, expected, side_effect=None, qstring=""):
+    def test_cdrs_retrieving(self, name, expected, side_effect=None, qstring="", sdrs_query=None):
 
         if side_effect is not None:
             side_effect(self)
@@ -1955,3 +2936,6 @@ class CDRRetrievingTestCase(TestCase):
 
         # Validate calls
         views.Purchase.objects.get.assert_called_once_with(ref='aaaaa')
+
+        if sdrs_query is not None:
+            self._sdr_manager.get_sdrs.assert_called_once_with(*sdrs_query[0], **sdrs_query[1])
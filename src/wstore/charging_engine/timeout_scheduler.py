@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import absolute_import
+
+import time
+import threading
+from bson import ObjectId
+from datetime import datetime, timedelta
+
+from wstore.models import Purchase
+from wstore.store_commons.database import get_database_connection
+
+
+# Time given to the customer to complete a redirection payment
+REDIRECTION_TIMEOUT = 300
+
+# Time that an expired timeout is reserved by a sweeper, after that
+# it is processed again in case the sweeper has failed
+SWEEP_LEASE = 60
+
+SWEEP_INTERVAL = 30
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+def _get_collection():
+    return get_database_connection().charging_engine_paymenttimeout
+
+
+def schedule_timeout(purchase, seconds=REDIRECTION_TIMEOUT):
+    """
+    Saves the time when the pending payment of a purchase expires and
+    ensures the local sweeper is running
+    """
+    _get_collection().update(
+        {'_id': ObjectId(purchase.pk)},
+        {'$set': {'due': datetime.now() + timedelta(seconds=seconds)}},
+        upsert=True
+    )
+    _start_sweeper()
+
+
+def cancel_timeout(purchase):
+    _get_collection().remove({'_id': ObjectId(purchase.pk)})
+
+
+def process_expired_timeouts(batch_size=100):
+    """
+    Handles a batch of expired timeouts, returning the number of
+    processed timeouts. Each timeout is reserved atomically so it
+    can be processed by several sweepers at the same time
+    """
+    from wstore.charging_engine.charging_engine import ChargingEngine
+
+    collection = _get_collection()
+    processed = 0
+
+    while processed < batch_size:
+        now = datetime.now()
+        timeout = collection.find_and_modify(
+            query={'due': {'$lte': now}},
+            update={'$set': {'due': now + timedelta(seconds=SWEEP_LEASE)}},
+            sort={'due': 1}
+        )
+
+        if timeout is None:
+            break
+
+        try:
+            purchase = Purchase.objects.get(pk=str(timeout['_id']))
+        except Purchase.DoesNotExist:
+            pass
+        else:
+            # The handler uses the _lock protocol so purchases whose
+            # payment is being confirmed are not rolled back
+            ChargingEngine(purchase)._timeout_handler()
+
+        collection.remove({'_id': timeout['_id']})
+        processed += 1
+
+    return processed
+
+
+class TimeoutSweeper(threading.Thread):
+    """
+    Single thread per process that handles the expired
+    timeouts of the pending payments
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def run(self):
+        while True:
+            time.sleep(SWEEP_INTERVAL)
+
+            try:
+                while process_expired_timeouts() > 0:
+                    pass
+            except:
+                pass
+
+
+def _start_sweeper():
+    global _sweeper
+
+    with _sweeper_lock:
+        if _sweeper is None or not _sweeper.is_alive():
+            _sweeper = TimeoutSweeper()
+            _sweeper.start()
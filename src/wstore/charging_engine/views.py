@@ -22,17 +22,20 @@ import json
 from bson import ObjectId
 from datetime import datetime
 
-from django.conf import settings
 from django.http import HttpResponse
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
 
 from wstore.store_commons.resource import Resource
-from wstore.store_commons.utils.http import build_response, supported_request_mime_types, authentication_required
+from wstore.store_commons.utils.http import build_response, supported_request_mime_types, \
+    authentication_required, get_content_type
 from wstore.models import Purchase
 from wstore.models import UserProfile
 from wstore.charging_engine.charging_engine import ChargingEngine
+from wstore.charging_engine.sdr_manager import SDRManager
+from wstore.charging_engine.payment_client.client_registry import get_payment_client
+from wstore.charging_engine.timeout_scheduler import cancel_timeout
 from wstore.contracting.purchase_rollback import rollback
 from wstore.contracting.notify_provider import notify_provider
 from wstore.store_commons.database import get_database_connection
@@ -48,14 +51,58 @@ class ServiceRecordCollection(Resource):
 
         return time_stamp
 
+    def _stream_sdrs(self, sdrs):
+        """
+        Serializes a list of SDRs as a JSON array one SDR at a time
+        """
+        yield '['
+
+        separator = ''
+        for sdr in sdrs:
+            sdr['time_stamp'] = unicode(sdr['time_stamp'])
+            # Correlation numbers are stored as integers to be sorted, but
+            # they are returned as strings as they are received
+            sdr['correlation_number'] = unicode(sdr['correlation_number'])
+            yield separator + json.dumps(sdr)
+            separator = ', '
+
+        yield ']'
+
+    def _load_sdrs(self, request):
+        """
+        Loads the SDR documents of a request, which can be a single JSON
+        object, a JSON array or a stream of JSON documents (one per line)
+        """
+        if get_content_type(request)[0] == 'application/x-ndjson':
+            data = [json.loads(line) for line in request.raw_post_data.splitlines() if line.strip()]
+        else:
+            data = json.loads(request.raw_post_data)
+
+        return data
+
+    def _create_batch(self, request, reference, sdrs):
+        try:
+            purchase = Purchase.objects.get(ref=reference)
+            charging_engine = ChargingEngine(purchase)
+            results = charging_engine.include_sdrs(sdrs)
+        except Exception, e:
+            return build_response(request, 400, unicode(e))
+
+        return HttpResponse(json.dumps(results), status=200, mimetype="application/json")
+
     # This method is used to load SDR documents and
     # start the charging process
-    @supported_request_mime_types(('application/json',))
+    @supported_request_mime_types(('application/json', 'application/x-ndjson'))
     @authentication_required
     def create(self, request, reference):
         try:
             # Extract SDR document from the HTTP request
-            data = json.loads(request.raw_post_data)
+            data = self._load_sdrs(request)
+
+            # A list of SDRs is included using the bulk mode, reporting
+            # the result of every SDR
+            if isinstance(data, list):
+                return self._create_batch(request, reference, data)
 
             # Validate SDR structure
             if 'offering' not in data or 'customer' not in data or 'time_stamp' not in data \
@@ -102,6 +149,8 @@ class ServiceRecordCollection(Resource):
         from_ = request.GET.get('from', None)
         to = request.GET.get('to', None)
         label = request.GET.get('label', None)
+        after = request.GET.get('after', None)
+        limit = request.GET.get('limit', None)
 
         # Check from and to formats
         if from_ is not None:
@@ -116,26 +165,26 @@ class ServiceRecordCollection(Resource):
             except:
                 return build_response(request, 400, 'Invalid "to" parameter, must be a datetime')
 
-        # Build response
-        response = []
-        sdrs = []
-        sdrs.extend(contract.applied_sdrs)
-        sdrs.extend(contract.pending_sdrs)
-
-        for sdr in sdrs:
-            if from_ is not None and from_ > sdr['time_stamp']:
-                continue
-
-            if to is not None and to < sdr['time_stamp']:
-                break
+        # Check pagination parameters
+        if after is not None:
+            try:
+                after = int(after)
+            except:
+                return build_response(request, 400, 'Invalid "after" parameter, must be a correlation number')
 
-            if label is not None and sdr['component_label'].lower() != label.lower():
-                continue
+        if limit is not None:
+            try:
+                limit = int(limit)
+                if limit <= 0:
+                    raise ValueError()
+            except:
+                return build_response(request, 400, 'Invalid "limit" parameter, must be a positive integer')
 
-            sdr['time_stamp'] = unicode(sdr['time_stamp'])
-            response.append(sdr)
+        # Filters are applied by the database, so SDRs are
+        # written to the response as they are read
+        sdrs = SDRManager(contract).get_sdrs(from_, to, label=label, after=after, limit=limit)
 
-        return HttpResponse(json.dumps(response), status=200, mimetype="application/json")
+        return HttpResponse(self._stream_sdrs(sdrs), status=200, mimetype="application/json")
 
 
 class PayPalConfirmation(Resource):
@@ -182,16 +231,8 @@ class PayPalConfirmation(Resource):
 
             pending_info = purchase.contract.pending_payment
 
-            # Get the payment client
-            # Load payment client
-            cln_str = settings.PAYMENT_CLIENT
-            client_class = cln_str.split('.')[-1]
-            client_package = cln_str.partition('.' + client_class)[0]
-
-            payment_client = getattr(__import__(client_package, globals(), locals(), [client_class], -1), client_class)
-
-            # build the payment client
-            client = payment_client(purchase)
+            # Build the payment client
+            client = get_payment_client(purchase)
             client.end_redirection_payment(token, payer_id)
 
             charging_engine = ChargingEngine(purchase)
@@ -200,6 +241,7 @@ class PayPalConfirmation(Resource):
                 accounting = pending_info['accounting']
 
             charging_engine.end_charging(pending_info['price'], pending_info['concept'], pending_info['related_model'], accounting)
+            cancel_timeout(purchase)
         except:
             # Rollback the purchase if existing
             if purchase is not None:
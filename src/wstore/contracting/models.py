@@ -37,6 +37,8 @@ class Purchase(models.Model):
     offering = models.ForeignKey(Offering)
     state = models.CharField(max_length=50)
     bill = ListField()
+    # Bills whose PDF is being generated
+    pending_bills = ListField()
     tax_address = DictField()
 
     class Meta:
@@ -33,6 +33,8 @@ def rollback(purchase):
     # If the purchase state is paid means that the purchase has been made
     # so the models must not be deleted
     offering = purchase.offering
+    organization = purchase.owner_organization
+    deleted = False
 
     if purchase.state != 'paid':
 
@@ -52,6 +54,11 @@ def rollback(purchase):
                 purchase.save()
                 to_del = False
 
+                # The renovation reserved by the customer can be
+                # charged again by the scheduled renovations
+                from wstore.charging_engine.renovation_scheduler import release_renovation
+                release_renovation(contr.pk)
+
         if to_del:
             # Check organization owned
             if purchase.organization_owned:
@@ -71,6 +78,7 @@ def rollback(purchase):
                 purchase.contract.delete()
             # Delete the Purchase
             purchase.delete()
+            deleted = True
 
     # If the purchase is paid the offering must be included in the customer
     # offerings purchased list
@@ -92,7 +100,10 @@ def rollback(purchase):
     index_path = os.path.join(index_path, 'indexes')
 
     se = SearchEngine(index_path)
-    se.update_index(offering)
+    if deleted:
+        se.remove_purchaser(offering, organization)
+    else:
+        se.add_purchaser(offering, organization)
 
 
 # This class is used as a decorator to avoid inconsistent states in
@@ -158,6 +158,6 @@ def create_purchase(user, offering, org_owned=False, payment_info=None):
     index_path = os.path.join(index_path, 'indexes')
 
     se = SearchEngine(index_path)
-    se.update_index(offering)
+    se.add_purchaser(offering, organization)
 
     return result
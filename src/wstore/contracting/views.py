@@ -38,6 +38,7 @@ from wstore.store_commons.utils.version import is_lower_version
 from wstore.offerings.offerings_management import get_offering_info
 from wstore.contracting.purchases_management import create_purchase
 from wstore.charging_engine.charging_engine import ChargingEngine
+from wstore.charging_engine.renovation_scheduler import claim_customer_renovation, release_renovation
 from wstore.models import Offering, Organization, Context
 from wstore.models import Purchase
 from wstore.models import Resource as store_resource
@@ -273,6 +274,7 @@ class PurchaseCollection(Resource):
 
             # Load bill URL
             response['bill'] = response_info.bill
+            response['pending_bills'] = response_info.pending_bills
             status = 201
 
         # Check if it is needed to redirect the user
@@ -304,6 +306,22 @@ class PurchaseEntry(Resource):
 
         data = json.loads(request.raw_post_data)
 
+        # The renovation is reserved so it is not charged at the
+        # same time by the scheduled renovations
+        try:
+            contract_id = purchase.contract.pk
+        except:
+            return build_response(request, 400, 'The purchase does not have a contract')
+
+        try:
+            claim_customer_renovation(contract_id)
+        except ValueError as e:
+            return build_response(request, 409, unicode(e))
+
+        # The purchase is loaded again so the charging engine saves
+        # the contract including the reserved renovation
+        purchase = Purchase.objects.get(ref=reference)
+
         try:
             if data['method'] == 'paypal':
                 charging_engine = ChargingEngine(purchase, payment_method='paypal')
@@ -324,6 +342,7 @@ class PurchaseEntry(Resource):
             # Refresh the purchase info
             purchase = Purchase.objects.get(ref=reference)
             rollback(purchase)
+            release_renovation(contract_id)
             return build_response(request, 400, 'Invalid JSON content')
 
         return build_response(request, 200, 'OK')
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from wstore.search.index_checker import check_index
+
+
+class Command(BaseCommand):
+
+    help = 'Checks that the search index is consistent with the database, indexing again the outdated offerings'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run',
+                action='store_true',
+                dest='dry_run',
+                default=False,
+                help='Report the outdated offerings without indexing them'),
+    )
+
+    def handle(self, *args, **options):
+        index_path = os.path.join(settings.BASEDIR, 'wstore')
+        index_path = os.path.join(index_path, 'search')
+        index_path = os.path.join(index_path, 'indexes')
+
+        dry_run = options.get('dry_run', False)
+        outdated, removed = check_index(index_path, repair=not dry_run)
+
+        if dry_run:
+            for pk in outdated:
+                self.stdout.write('Outdated offering: ' + pk + '\n')
+
+            for pk in removed:
+                self.stdout.write('Removed offering: ' + pk + '\n')
+        else:
+            self.stdout.write(str(len(outdated)) + ' offerings have been indexed again and ' +
+                              str(len(removed)) + ' removed from the index\n')
@@ -20,13 +20,12 @@
 
 import os
 from sys import stdin
-from shutil import rmtree
+from optparse import make_option
 
 from django.core.management.base import BaseCommand
 from django.conf import settings
 
-from wstore.models import Offering
-from wstore.search.search_engine import SearchEngine
+from wstore.search.index_builder import rebuild_index
 
 def read_from_cmd():
     return stdin.readline()[:-1]
@@ -34,8 +33,28 @@ def read_from_cmd():
 
 class Command(BaseCommand):
 
+    option_list = BaseCommand.option_list + (
+        make_option('--no-input',
+                action='store_false',
+                dest='interactive',
+                default=True,
+                help='Rebuild the indexes without asking for confirmation'),
+        make_option('--batch-size',
+                action='store',
+                type='int',
+                dest='batch_size',
+                default=500,
+                help='Number of offerings read from the database in every batch'),
+        make_option('--processes',
+                action='store',
+                type='int',
+                dest='processes',
+                default=None,
+                help='Number of processes used to extract the text of the offerings, by default it is extracted by the command'),
+    )
+
     def handle(self, *args, **options):
-        interactive = True
+        interactive = options.get('interactive', True)
 
         if len(args) and args[0] == '--no-input':
             interactive = False
@@ -43,7 +62,7 @@ class Command(BaseCommand):
         # Ask the user if interactive
         if interactive:
             correct = False
-            print "This process will delete the indexes directory. Continue: [y/n]"
+            print "This process will rebuild the search indexes. Continue: [y/n]"
             while not correct:
                 opt = read_from_cmd()
                 if opt != 'y' and opt != 'n':
@@ -54,14 +73,16 @@ class Command(BaseCommand):
             if opt == 'n':
                 return
 
-        # Remove the index directory
+        batch_size = options.get('batch_size', 500)
+        if batch_size < 1:
+            raise Exception('The batch size must be greater than 0')
+
         index_path = os.path.join(settings.BASEDIR, 'wstore')
         index_path = os.path.join(index_path, 'search')
         index_path = os.path.join(index_path, 'indexes')
 
-        rmtree(index_path, True)
+        # Generate new search indexes, the current ones are
+        # used by the searches until the new ones are built
+        indexed = rebuild_index(index_path, batch_size, options.get('processes', None))
 
-        # Generate new search indexes
-        se = SearchEngine(index_path)
-        for o in Offering.objects.all():
-            se.create_index(o)
+        self.stdout.write(str(indexed) + ' offerings have been indexed\n')
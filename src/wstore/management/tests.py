@@ -22,6 +22,7 @@
 from __future__ import unicode_literals
 
 import os
+from StringIO import StringIO
 
 from mock import MagicMock
 from nose_parameterized import parameterized
@@ -32,7 +33,7 @@ from django.core.management import call_command
 from django.core.management.base import CommandError
 
 from wstore.management.commands import configureproject, createindexes,\
-  createtags, loadplugin, removeplugin
+  createtags, loadplugin, removeplugin, checkindexes
 
 
 class ConfigureProjectTestCase(TestCase):
@@ -96,17 +97,17 @@ class IndexTestCase(TestCase):
             index_path = os.path.join(index_path, 'indexes')
 
             # Check calls
-            self.tested_mod.rmtree.assert_called_once_with(index_path, True)
+            self.index_assertion(index_path)
 
             self.manager_assertion()
         else:
-            called = True
-            try:
-                self.tested_mod.rmtree.assert_any_call()
-            except:
-                called = False
+            self.assertFalse(self.index_called())
 
-            self.assertFalse(called)
+    def index_assertion(self, index_path):
+        self.tested_mod.rmtree.assert_called_once_with(index_path, True)
+
+    def index_called(self):
+        return self.tested_mod.rmtree.called
 
 
 class CreateIndexesTestCase(IndexTestCase):
@@ -117,27 +118,21 @@ class CreateIndexesTestCase(IndexTestCase):
         IndexTestCase.__init__(self, methodName=methodName)
 
     def setUp(self):
-        # Mock search engine
-        self.se_inst = MagicMock()
-        createindexes.SearchEngine = MagicMock()
-        createindexes.SearchEngine.return_value = self.se_inst
-        # Mock offerings
-        self.tested_mod.Offering = MagicMock()
-        self.offerings = [
-            'offering1',
-            'offering2',
-            'offering3'
-        ]
-        self.tested_mod.Offering.objects.all.return_value = self.offerings
+        # Mock index builder
+        createindexes.rebuild_index = MagicMock()
+        createindexes.rebuild_index.return_value = 3
         IndexTestCase.setUp(self)
 
     def tearDown(self):
         reload(createindexes)
         IndexTestCase.tearDown(self)
 
-    def manager_assertion(self):
-        self.se_inst.create_index.assert_calls(self.offerings, True)
-        IndexTestCase.manager_assertion(self)
+    def index_assertion(self, index_path):
+        # The index is rebuilt without removing the current one
+        createindexes.rebuild_index.assert_called_once_with(index_path, 500, None)
+
+    def index_called(self):
+        return createindexes.rebuild_index.called
 
     @parameterized.expand([
         ('no_input', False),
@@ -199,6 +194,32 @@ class CreateTagIndexesTestCase(IndexTestCase):
         self._index_tst(info, input_=input_, side_effect=side_effect, completed=completed)
 
 
+class CheckIndexesTestCase(TestCase):
+
+    tags = ('management',)
+
+    def setUp(self):
+        checkindexes.check_index = MagicMock()
+        checkindexes.check_index.return_value = (['1111'], ['2222'])
+        TestCase.setUp(self)
+
+    def tearDown(self):
+        reload(checkindexes)
+        TestCase.tearDown(self)
+
+    @parameterized.expand([
+        ('repair', False, '1 offerings have been indexed again and 1 removed from the index\n'),
+        ('dry_run', True, 'Outdated offering: 1111\nRemoved offering: 2222\n')
+    ])
+    def test_check_indexes(self, name, dry_run, output):
+        out = StringIO()
+        call_command('checkindexes', dry_run=dry_run, stdout=out)
+
+        index_path = os.path.join(settings.BASEDIR, 'wstore', 'search', 'indexes')
+        checkindexes.check_index.assert_called_once_with(index_path, repair=not dry_run)
+        self.assertEquals(out.getvalue(), output)
+
+
 class FakeCommandError(Exception):
     pass
 
@@ -24,14 +24,17 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, post_syncdb
 from djangotoolbox.fields import ListField
 from djangotoolbox.fields import DictField
 
 from wstore.admin.markets.models import *
 from wstore.admin.repositories.models import *
 from wstore.admin.rss.models import *
+from wstore.admin.rss.models import RSS
 from wstore.admin.searchers import ResourceBrowser
+from wstore.store_commons.config_cache import invalidate_rss, invalidate_currencies, invalidate_configuration
+from wstore.offerings.info_cache import invalidate_offering, invalidate_resource
 
 
 class Context(models.Model):
@@ -219,6 +222,20 @@ post_save.connect(create_user_profile, sender=User)
 post_save.connect(create_context, sender=Site)
 
 
+# Keeps updated the configuration cached by the charging engine
+post_save.connect(invalidate_rss, sender=RSS)
+post_delete.connect(invalidate_rss, sender=RSS)
+post_save.connect(invalidate_currencies, sender=Context)
+post_syncdb.connect(invalidate_configuration)
+
+
+# Keeps updated the info of the offerings cached by the listings
+post_save.connect(invalidate_offering, sender=Offering)
+post_delete.connect(invalidate_offering, sender=Offering)
+post_save.connect(invalidate_resource, sender=Resource)
+post_delete.connect(invalidate_resource, sender=Resource)
+
+
 if settings.OILAUTH:
     def set_tokens(sender, instance, created, **kwargs):
         # Check if the user is staff
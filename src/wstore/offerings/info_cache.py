@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+
+from __future__ import unicode_literals
+
+import time
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+# Maximum number of offerings whose info is cached by every process
+INFO_CACHE_SIZE = 1000
+
+_entries = OrderedDict()
+_entries_lock = threading.Lock()
+
+
+def _get_stamp(offering):
+    """
+    Returns the values of the offering that change when it is modified,
+    so the info cached by other processes is not used after a change
+    """
+    return (
+        offering.offering_description.get('modified'),
+        offering.state,
+        offering.rating,
+        offering.open,
+        offering.publication_date,
+        len(offering.comments),
+        tuple(offering.tags),
+        tuple(offering.resources)
+    )
+
+
+def get_cached_infos(offerings, loader):
+    """
+    Returns the info of several offerings that does not depend on the
+    user. The info of the offerings that are not cached or have been
+    modified is built at once with the loader, which receives the list
+    of those offerings. The cached info is used for OFFERING_INFO_CACHE_TTL
+    seconds at most, since the bound resources can be modified by
+    other processes
+    """
+    now = time.time()
+    infos = {}
+    missing = []
+
+    with _entries_lock:
+        for offering in offerings:
+            entry = _entries.get(offering.pk)
+
+            if entry is not None and entry[0] == _get_stamp(offering) and entry[2] > now:
+                infos[offering.pk] = entry[1]
+            elif offering.pk not in [m.pk for m in missing]:
+                missing.append(offering)
+
+    if len(missing) > 0:
+        built = loader(missing)
+
+        with _entries_lock:
+            for offering, info in zip(missing, built):
+                infos[offering.pk] = info
+
+                _entries.pop(offering.pk, None)
+                _entries[offering.pk] = (_get_stamp(offering), info, now + settings.OFFERING_INFO_CACHE_TTL)
+
+            while len(_entries) > INFO_CACHE_SIZE:
+                _entries.popitem(last=False)
+
+    return [infos[offering.pk] for offering in offerings]
+
+
+def invalidate_offering_info(pk=None):
+    with _entries_lock:
+        if pk is None:
+            _entries.clear()
+        else:
+            _entries.pop(pk, None)
+
+
+# The invalidation functions are connected to the signals of the
+# related models, so they accept the arguments of the signals
+
+def invalidate_offering(instance, **kwargs):
+    invalidate_offering_info(instance.pk)
+
+
+def invalidate_resource(instance, **kwargs):
+    for pk in instance.offerings:
+        invalidate_offering_info(pk)
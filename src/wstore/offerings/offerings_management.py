@@ -30,12 +30,15 @@ from urllib2 import HTTPError
 
 from django.conf import settings
 from django.core.exceptions import PermissionDenied
+from django.contrib.auth.models import User
 
 from wstore.repository_adaptor.repositoryAdaptor import repository_adaptor_factory, unreg_repository_adaptor_factory
 from wstore.market_adaptor.marketadaptor import marketadaptor_factory
 from wstore.search.search_engine import SearchEngine
 from wstore.offerings.offering_rollback import OfferingRollback
+from wstore.offerings.info_cache import get_cached_infos
 from wstore.models import Offering, Resource, Repository
+from wstore.models import Organization
 from wstore.models import Marketplace, MarketOffering
 from wstore.models import Purchase
 from wstore.models import UserProfile, Context
@@ -47,59 +50,39 @@ from wstore.store_commons.errors import ConflictError
 from wstore.store_commons.database import get_database_connection
 from wstore.offerings.usdl.usdl_generator import USDLGenerator
 from wstore.models import RSS
-from wstore.charging_engine.models import Unit
+from wstore.charging_engine.models import Unit, Contract
 from wstore.rss_adaptor.rss_manager_factory import RSSManagerFactory
 
 
-def get_offering_info(offering, user):
-
-    user_profile = UserProfile.objects.get(user=user)
-
-    # Check if the user has purchased the offering
-    state = offering.state
-
-    # Check if the current organization is the user organization
-    if user_profile.is_user_org():
-
-        if offering.pk in user_profile.offerings_purchased:
-            state = 'purchased'
-            purchase = Purchase.objects.get(offering=offering, customer=user, organization_owned=False)
-
-        if offering.pk in user_profile.rated_offerings:
-            state = 'rated'
-
-    else:
-        if offering.pk in user_profile.current_organization.offerings_purchased:
-            state = 'purchased'
-            purchase = Purchase.objects.get(offering=offering, owner_organization=user_profile.current_organization)
-
-        if user_profile.current_organization.has_rated_offering(user, offering):
-            state = 'rated'
-
-    # Load offering data
+def _build_offering_info(offering, organization, admin_user, resources):
+    """
+    Builds the info of an offering that does not depend on the user,
+    together with the links of its resources
+    """
     result = {
         'name': offering.name,
-        'owner_organization': offering.owner_organization.name,
-        'owner_admin_user_id': offering.owner_admin_user.username,
+        'owner_organization': organization.name,
+        'owner_admin_user_id': admin_user.username,
         'version': offering.version,
-        'state': state,
+        'state': offering.state,
         'description_url': offering.description_url,
         'rating': "{:.2f}".format(offering.rating),
-        'comments': offering.comments,
-        'tags': offering.tags,
+        'comments': list(offering.comments),
+        'tags': list(offering.tags),
         'image_url': offering.image_url,
-        'related_images': offering.related_images,
+        'related_images': list(offering.related_images),
         'creation_date': str(offering.creation_date),
         'publication_date': str(offering.publication_date),
         'open': offering.open,
-        'offering_description': offering.offering_description,
+        'offering_description': deepcopy(offering.offering_description),
         'resources': []
     }
+    links = []
 
-    # Load resources
+    # The offering stores the ids of its resources as ObjectIds
     for res in offering.resources:
-        resource = Resource.objects.get(pk=res)
-        res_info = {
+        resource = resources[unicode(res)]
+        result['resources'].append({
             'name': resource.name,
             'version': resource.version,
             'description': resource.description,
@@ -107,57 +90,191 @@ def get_offering_info(offering, user):
             'open': resource.open,
             'resource_type': resource.resource_type,
             'metadata': resource.meta_info
-        }
+        })
 
-        if (state == 'purchased' or state == 'rated' or offering.open):
-            if resource.resource_path != '':
-                res_info['link'] = resource.resource_path
-            elif resource.download_link != '':
-                res_info['link'] = resource.download_link
+        link = None
+        if resource.resource_path != '':
+            link = resource.resource_path
+        elif resource.download_link != '':
+            link = resource.download_link
 
-        result['resources'].append(res_info)
+        links.append(link)
 
     # Load applications
     if settings.OILAUTH:
         result['applications'] = offering.applications
 
-    if not offering.open and (state == 'purchased' or state == 'rated'):
-        result['bill'] = purchase.bill
+    return result, links
+
+
+def _build_offerings_info(offerings):
+    """
+    Builds the user independent info of a list of offerings, the owners
+    and the resources of all of them are retrieved in a single query each
+    """
+    organizations = dict((org.pk, org) for org in Organization.objects.filter(
+        pk__in=list(set([offering.owner_organization_id for offering in offerings]))))
 
-        # If the offering has been purchased the parsed pricing model is replaced
-        # With the pricing model of the contract in order to included the extra info
-        # needed such as renovation dates etc.
+    users = dict((user.pk, user) for user in User.objects.filter(
+        pk__in=list(set([offering.owner_admin_user_id for offering in offerings]))))
 
-        if len(result['offering_description']['pricing']['price_plans']) > 0:
+    # The ids of the resources are stored as ObjectIds
+    resource_ids = set()
+    for offering in offerings:
+        resource_ids.update([unicode(res) for res in offering.resources])
 
-            pricing_model = purchase.contract.pricing_model
-            related_plan = None
+    resources = dict((unicode(r.pk), r) for r in Resource.objects.filter(pk__in=list(resource_ids)))
 
-            if len(result['offering_description']['pricing']['price_plans']) > 1:
-                # Search for the related plan
-                for plan in result['offering_description']['pricing']['price_plans']:
-                    if plan['label'].lower() == pricing_model['label']:
-                        related_plan = deepcopy(plan)
-            else:
-                related_plan = deepcopy(result['offering_description']['pricing']['price_plans'][0])
+    return [_build_offering_info(
+        offering,
+        organizations[offering.owner_organization_id],
+        users[offering.owner_admin_user_id],
+        resources
+    ) for offering in offerings]
 
-            related_plan['price_components'] = []
 
-            if 'subscription' in pricing_model:
+def _get_user_state(offering, user, user_profile):
+    """
+    Returns the state of an offering for the given user, which
+    is purchased or rated if the user has acquired it
+    """
+    state = offering.state
+
+    # Check if the current organization is the user organization
+    if user_profile.is_user_org():
+
+        if offering.pk in user_profile.offerings_purchased:
+            state = 'purchased'
 
-                for subs in pricing_model['subscription']:
-                    subs['renovation_date'] = str(subs['renovation_date'])
-                    related_plan['price_components'].append(subs)
+        if offering.pk in user_profile.rated_offerings:
+            state = 'rated'
 
-            if 'single_payment' in pricing_model:
-                related_plan['price_components'].extend(pricing_model['single_payment'])
+    else:
+        if offering.pk in user_profile.current_organization.offerings_purchased:
+            state = 'purchased'
 
-            if 'pay_per_use' in pricing_model:
-                related_plan['price_components'].extend(pricing_model['pay_per_use'])
+        if user_profile.current_organization.has_rated_offering(user, offering):
+            state = 'rated'
 
-            result['offering_description']['pricing']['price_plans'] = [related_plan]
+    return state
 
-    return result
+
+def _get_purchases(offerings, user, user_profile):
+    """
+    Returns the purchases of the given offerings made by the user or
+    the current organization, indexed by offering
+    """
+    if len(offerings) == 0:
+        return {}
+
+    offering_ids = [offering.pk for offering in offerings]
+
+    if user_profile.is_user_org():
+        purchases = Purchase.objects.filter(offering__in=offering_ids, customer=user, organization_owned=False)
+    else:
+        purchases = Purchase.objects.filter(offering__in=offering_ids, owner_organization=user_profile.current_organization)
+
+    return dict((purchase.offering_id, purchase) for purchase in purchases)
+
+
+def _get_pricing_model(purchase, contracts):
+    if purchase.pk in contracts:
+        return contracts[purchase.pk].pricing_model
+
+    return purchase.contract.pricing_model
+
+
+def get_offerings_info(offerings, user):
+    """
+    Returns the info of a list of offerings for the given user. The
+    user profile, the purchases, the contracts and the resources of
+    all the offerings are loaded using a single query each
+    """
+    user_profile = UserProfile.objects.get(user=user)
+
+    # Check if the user has purchased the offerings
+    states = [_get_user_state(offering, user, user_profile) for offering in offerings]
+
+    acquired = [offering for offering, state in zip(offerings, states) if state == 'purchased' or state == 'rated']
+    purchases = _get_purchases(acquired, user, user_profile)
+
+    # Contracts are only needed to replace the pricing of the offerings that are not open
+    billed = [purchases[offering.pk].pk for offering in acquired if not offering.open and offering.pk in purchases]
+    contracts = {}
+    if len(billed) > 0:
+        contracts = dict((contract.purchase_id, contract) for contract in Contract.objects.filter(purchase__in=billed))
+
+    # The info that does not depend on the user is cached, so the state
+    # of the user is included in a copy of it. The nested values are
+    # shared by all the copies and must not be modified
+    infos = get_cached_infos(offerings, _build_offerings_info)
+
+    results = []
+    for offering, state, (info, links) in zip(offerings, states, infos):
+        result = dict(info)
+        result['state'] = state
+
+        if (state == 'purchased' or state == 'rated' or offering.open):
+            result['resources'] = []
+
+            for res_info, link in zip(info['resources'], links):
+                res_info = dict(res_info)
+
+                if link is not None:
+                    res_info['link'] = link
+
+                result['resources'].append(res_info)
+
+        if not offering.open and (state == 'purchased' or state == 'rated'):
+            if offering.pk not in purchases:
+                raise Purchase.DoesNotExist('Purchase matching query does not exist.')
+
+            purchase = purchases[offering.pk]
+            result['bill'] = purchase.bill
+            result['pending_bills'] = purchase.pending_bills
+
+            # If the offering has been purchased the parsed pricing model is replaced
+            # With the pricing model of the contract in order to included the extra info
+            # needed such as renovation dates etc.
+
+            if len(result['offering_description']['pricing']['price_plans']) > 0:
+                # The cached description is not modified
+                result['offering_description'] = deepcopy(result['offering_description'])
+
+                pricing_model = _get_pricing_model(purchase, contracts)
+                related_plan = None
+
+                if len(result['offering_description']['pricing']['price_plans']) > 1:
+                    # Search for the related plan
+                    for plan in result['offering_description']['pricing']['price_plans']:
+                        if plan['label'].lower() == pricing_model['label']:
+                            related_plan = deepcopy(plan)
+                else:
+                    related_plan = deepcopy(result['offering_description']['pricing']['price_plans'][0])
+
+                related_plan['price_components'] = []
+
+                if 'subscription' in pricing_model:
+
+                    for subs in pricing_model['subscription']:
+                        subs['renovation_date'] = str(subs['renovation_date'])
+                        related_plan['price_components'].append(subs)
+
+                if 'single_payment' in pricing_model:
+                    related_plan['price_components'].extend(pricing_model['single_payment'])
+
+                if 'pay_per_use' in pricing_model:
+                    related_plan['price_components'].extend(pricing_model['pay_per_use'])
+
+                result['offering_description']['pricing']['price_plans'] = [related_plan]
+
+        results.append(result)
+
+    return results
+
+
+def get_offering_info(offering, user):
+    return get_offerings_info([offering], user)[0]
 
 
 def _get_purchased_offerings(user, db, pagination=None, sort=None):
@@ -260,19 +377,19 @@ def get_offerings(user, filter_='published', state=None, pagination=None, sort=N
     if pagination:
         prov_offerings = prov_offerings.skip(int(pagination['skip']) - 1).limit(int(pagination['limit']))
 
-    result = []
+    pks = []
 
     for offer in prov_offerings:
         if '_id' in offer:
-            pk = str(offer['_id'])
+            pks.append(str(offer['_id']))
         else:
-            pk = offer
+            pks.append(offer)
 
-        offering = Offering.objects.get(pk=pk)
-        # Use get_offering_info to create the JSON with the offering info
-        result.append(get_offering_info(offering, user))
+    # All the offerings of the page are loaded at once, keeping the order
+    loaded = dict((offering.pk, offering) for offering in Offering.objects.filter(pk__in=pks))
 
-    return result
+    # Use get_offerings_info to create the JSON with the offerings info
+    return get_offerings_info([loaded[pk] for pk in pks], user)
 
 
 def count_offerings(user, filter_='published', state=None):
@@ -866,6 +983,14 @@ def bind_resources(offering, data, provider):
     offering.offering_description['modified'] = unicode(datetime.now())
     offering.save()
 
+    # The content types of the resources are used as a facet of the search
+    index_path = os.path.join(settings.BASEDIR, 'wstore')
+    index_path = os.path.join(index_path, 'search')
+    index_path = os.path.join(index_path, 'indexes')
+
+    se = SearchEngine(index_path)
+    se.update_index(offering)
+
     # Update USDL document if needed
     if offering.open and offering.state == 'published' and len(offering.description_url):
         usdl_generator = USDLGenerator()
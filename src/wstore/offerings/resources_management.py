@@ -37,6 +37,7 @@ from wstore.store_commons.utils.url import is_valid_url
 from wstore.store_commons.utils.version import Version
 from wstore.store_commons.errors import ConflictError
 from wstore.offerings.offerings_management import delete_offering
+from wstore.search.search_engine import SearchEngine
 from wstore.offerings.resource_plugins.plugins.ckan_validation import validate_dataset
 from wstore.offerings.resource_plugins.decorators import register_resource_events, \
     upgrade_resource_events, update_resource_events, delete_resource_events, \
@@ -298,6 +299,24 @@ def upgrade_resource(resource, user, data, file_=None):
     decorated_save(resource, user)
 
 
+def _update_offerings_index(resource):
+    """
+    Updates the search documents of the offerings that include the
+    resource, whose content types are used as a facet of the search
+    """
+    offerings = Offering.objects.filter(pk__in=resource.offerings)
+
+    if len(offerings) > 0:
+        index_path = os.path.join(settings.BASEDIR, 'wstore')
+        index_path = os.path.join(index_path, 'search')
+        index_path = os.path.join(index_path, 'indexes')
+
+        se = SearchEngine(index_path)
+
+        for offering in offerings:
+            se.update_index(offering)
+
+
 def update_resource(resource, user, data):
 
     # Check that the resource can be updated
@@ -350,6 +369,8 @@ def update_resource(resource, user, data):
     decorated_save = _get_decorated_save('update')
     decorated_save(resource, user)
 
+    _update_offerings_index(resource)
+
 
 def get_resource_info(resource):
     state = resource.state
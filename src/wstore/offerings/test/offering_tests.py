@@ -36,6 +36,8 @@ from django.core.exceptions import PermissionDenied
 from django.test.utils import override_settings
 
 from wstore.offerings import offerings_management
+from wstore.offerings.usdl import text_extractor
+from wstore.offerings import info_cache
 from wstore.models import UserProfile
 from wstore.models import Offering
 from wstore.models import Marketplace, MarketOffering
@@ -664,6 +666,72 @@ class OfferingRetrievingTestCase(TestCase):
         self.assertEquals(validated, len(expected_offerings))
 
 
+class OfferingInfoCacheTestCase(TestCase):
+
+    tags = ('fiware-ut-2',)
+    fixtures = ['get_prov.json']
+
+    def setUp(self):
+        info_cache.invalidate_offering_info()
+        self._build = MagicMock(side_effect=offerings_management._build_offering_info)
+        offerings_management._build_offering_info = self._build
+
+    def tearDown(self):
+        reload(offerings_management)
+        info_cache.invalidate_offering_info()
+
+    def test_offering_info_cached(self):
+        user = User.objects.get(username='test_user')
+        offering = Offering.objects.get(pk='11000aba8e05ac2115f022f9')
+
+        info = offerings_management.get_offering_info(offering, user)
+        info['state'] = 'changed'
+
+        # The info is built once and the state is included in a copy
+        cached = offerings_management.get_offering_info(Offering.objects.get(pk=offering.pk), user)
+        self.assertEquals(self._build.call_count, 1)
+        self.assertEquals(cached['state'], offering.state)
+
+        # Saving the offering invalidates its info
+        offering.description_url = 'http://example.com/usdl'
+        offering.save()
+
+        info = offerings_management.get_offering_info(offering, user)
+        self.assertEquals(self._build.call_count, 2)
+        self.assertEquals(info['description_url'], 'http://example.com/usdl')
+
+    def test_offerings_info_batch(self):
+        user = User.objects.get(username='test_user')
+        pks = ['31000aba8e05ac2115f022f0', '11000aba8e05ac2115f022f9', '21000aba8e05ac2115f022ff']
+        offerings = [Offering.objects.get(pk=pk) for pk in pks]
+
+        infos = offerings_management.get_offerings_info(offerings, user)
+        self.assertEquals(self._build.call_count, 3)
+
+        # The batch returns the same info as the single variant in the given order
+        self.assertEquals([info['name'] for info in infos], [offering.name for offering in offerings])
+
+        for offering, info in zip(offerings, infos):
+            self.assertEquals(info, offerings_management.get_offering_info(offering, user))
+
+        self.assertEquals(self._build.call_count, 3)
+
+    def test_offerings_info_batch_object_ids(self):
+        user = User.objects.get(username='test_user')
+        resource = Resource.objects.get(pk='61000bba8e05ac2116f022f9')
+
+        # Bound resources are stored as ObjectIds
+        offering = Offering.objects.get(pk='31000aba8e05ac2115f022f0')
+        offering.resources = [ObjectId(resource.pk)]
+        offering.save()
+
+        pks = ['11000aba8e05ac2115f022f9', '31000aba8e05ac2115f022f0']
+        infos = offerings_management.get_offerings_info([Offering.objects.get(pk=pk) for pk in pks], user)
+
+        self.assertEquals(len(infos[0]['resources']), 0)
+        self.assertEquals([res['name'] for res in infos[1]['resources']], [resource.name])
+
+
 class PurchasedOfferingRetrievingTestCase(TestCase):
 
     tags = ('fiware-ut-2',)
@@ -959,7 +1027,12 @@ class OfferingBindingTestCase(TestCase):
     fixtures = ['bind.json']
 
     def setUp(self):
-        pass
+        self.se_object = MagicMock()
+        offerings_management.SearchEngine = MagicMock()
+        offerings_management.SearchEngine.return_value = self.se_object
+
+    def tearDown(self):
+        reload(offerings_management)
 
     def _fill_resources_org(self, data, org):
         try:
@@ -1063,10 +1136,36 @@ class OfferingBindingTestCase(TestCase):
             # Check repository calls
             if offering.open:
                 pass
+
+            # The offering is indexed with its new resources
+            self.assertEquals(self.se_object.update_index.call_count, 1)
         else:
             self.assertTrue(isinstance(error, err_type))
             self.assertEquals(unicode(e), err_msg)
 
+    def test_bound_resources_info(self):
+        offering = Offering.objects.get(name='test_offering2')
+        provider = User.objects.get(username='test_user')
+        org = Organization.objects.get(name=provider.username)
+
+        data = [{
+            'name': 'test_resource1',
+            'version': '1.0'
+        }, {
+            'name': 'test_resource3',
+            'version': '1.0'
+        }]
+        self._fill_resources_org(data, org)
+
+        offerings_management.bind_resources(offering, data, provider)
+
+        # The bound resources are stored as ObjectIds
+        offering = Offering.objects.get(name='test_offering2')
+        self.assertTrue(all([isinstance(res, ObjectId) for res in offering.resources]))
+
+        info = offerings_management.get_offering_info(offering, provider)
+        self.assertEquals([res['name'] for res in info['resources']], ['test_resource1', 'test_resource3'])
+
 
 @override_settings(OILAUTH=True)
 class OfferingDeletionTestCase(TestCase):
@@ -1203,3 +1302,67 @@ class OfferingDeletionTestCase(TestCase):
         else:
             self.assertTrue(isinstance(error, err_type))
             self.assertEquals(unicode(error), err_msg)
+
+
+class OfferingTextExtractionTestCase(TestCase):
+
+    tags = ('offering-text',)
+
+    def _get_offering(self):
+        offering = MagicMock(pk='61000aba8e05ac2115f022f0', version='1.0', creation_date='2013-02-05 17:06:46')
+        offering.name = 'test_offering'
+        offering.offering_description = {
+            'description': 'An offering description',
+            'abstract': 'An abstract',
+            'modified': '2013-02-06 10:00:00',
+            'legal': {
+                'title': 'Terms and conditions',
+                'text': 'Legal text'
+            },
+            'pricing': {
+                'price_plans': [{
+                    'title': 'Price plan',
+                    'description': 'Plan description',
+                    'currency': 'EUR',
+                    'price_components': [{
+                        'label': 'Component',
+                        'description': 'Component description',
+                        'value': '1.0',
+                        'unit': 'invocation'
+                    }],
+                    'deductions': [{
+                        'label': 'Deduction',
+                        'description': 'Deduction description',
+                        'text_function': 'Text function',
+                        'price_function': {
+                            'label': 'Function',
+                            'variables': {
+                                'x': {'type': 'usage', 'label': 'calls'},
+                                'y': {'type': 'constant', 'label': 'fee', 'value': '2'}
+                            }
+                        }
+                    }]
+                }]
+            }
+        }
+        return offering
+
+    def test_text_extraction(self):
+        text = text_extractor.extract_offering_text(self._get_offering())
+
+        for value in ('test_offering', 'An offering description', 'An abstract', '1.0', '2013-02-05 17:06:46',
+                '2013-02-06 10:00:00', 'Terms and conditions', 'Legal text', 'Price plan', 'Plan description',
+                'Component', 'Component description', 'EUR', 'invocation', 'Deduction description',
+                'Text function', 'Function', 'calls', 'fee', '2'):
+            self.assertTrue(value in text)
+
+    def test_text_cached_per_version(self):
+        offering = self._get_offering()
+        text = text_extractor.get_offering_text(offering)
+
+        offering.offering_description['description'] = 'Changed description'
+        self.assertEquals(text_extractor.get_offering_text(offering), text)
+
+        # A new modification of the offering is extracted again
+        offering.offering_description['modified'] = '2013-02-07 10:00:00'
+        self.assertTrue('Changed description' in text_extractor.get_offering_text(offering))
@@ -621,6 +621,15 @@ class ResourceUpdateTestCase(TestCase):
         resources_management.unreg_repository_adaptor_factory = MagicMock()
         resources_management.unreg_repository_adaptor_factory.return_value = self._rep_obj
 
+        # Mock the search engine
+        self._offerings = [MagicMock(), MagicMock()]
+        resources_management.Offering = MagicMock()
+        resources_management.Offering.objects.filter.return_value = self._offerings
+
+        self._se = MagicMock()
+        resources_management.SearchEngine = MagicMock()
+        resources_management.SearchEngine.return_value = self._se
+
     @classmethod
     def tearDownClass(cls):
         reload(wstore.offerings.resource_plugins.decorators)
@@ -666,6 +675,10 @@ class ResourceUpdateTestCase(TestCase):
         self._check_rep_calls()
         self.assertEquals(self.resource.description, 'Test resource 4')
 
+        # The offerings that include the resource are indexed again
+        resources_management.Offering.objects.filter.assert_called_once_with(pk__in=['111', '222'])
+        self.assertEquals([c[0][0] for c in self._se.update_index.call_args_list], self._offerings)
+
     def _check_complete(self):
         self._check_rep_calls()
         self.assertEquals(self.resource.description, 'Test resource 1')
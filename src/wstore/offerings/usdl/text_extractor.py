@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import unicode_literals
+
+import threading
+from collections import OrderedDict
+
+
+# Maximum number of offering texts cached by every process
+TEXT_CACHE_SIZE = 1000
+
+_texts = OrderedDict()
+_texts_lock = threading.Lock()
+
+
+def _get_component_text(component, currency):
+    values = [component.get('label'), component.get('description')]
+
+    if 'price_function' in component:
+        function = component['price_function']
+        values.extend([component.get('text_function'), function.get('label')])
+
+        for variable in function.get('variables', {}).itervalues():
+            values.append(variable.get('label'))
+
+            if variable.get('type') == 'constant':
+                values.append(variable.get('value'))
+    else:
+        values.extend([currency, component.get('value'), component.get('unit')])
+
+    return values
+
+
+def extract_offering_text(offering):
+    """
+    Builds the text of an offering used for searching and tagging, which
+    includes the literals of its USDL document, directly from the
+    offering description instead of generating the document
+    """
+    description = offering.offering_description
+    values = [
+        offering.name,
+        offering.name,
+        description.get('description'),
+        description.get('abstract'),
+        offering.version,
+        offering.creation_date,
+        description.get('modified')
+    ]
+
+    if 'legal' in description:
+        values.extend([description['legal'].get('title'), description['legal'].get('text')])
+
+    for plan in description.get('pricing', {}).get('price_plans', []):
+        values.extend([plan.get('title'), plan.get('description'), plan.get('label')])
+
+        for component in plan.get('price_components', []) + plan.get('deductions', []):
+            values.extend(_get_component_text(component, plan.get('currency')))
+
+    return ' '.join([unicode(value) for value in values if value is not None and value != ''])
+
+
+def get_offering_text(offering):
+    """
+    Returns the text of an offering, which is extracted only once
+    for every version and modification of the offering
+    """
+    key = (offering.pk, offering.version, offering.offering_description.get('modified'))
+
+    with _texts_lock:
+        if key in _texts:
+            return _texts[key]
+
+    text = extract_offering_text(offering)
+
+    with _texts_lock:
+        _texts[key] = text
+
+        if len(_texts) > TEXT_CACHE_SIZE:
+            _texts.popitem(last=False)
+
+    return text
@@ -32,8 +32,8 @@ from wstore.store_commons.utils.http import build_response, get_content_type, su
 authentication_required, identity_manager_required
 from wstore.models import Offering, Organization, Resource as OfferingResource
 from wstore.models import Context
-from wstore.offerings.offerings_management import create_offering, get_offerings, get_offering_info, delete_offering,\
-publish_offering, bind_resources, count_offerings, update_offering
+from wstore.offerings.offerings_management import create_offering, get_offerings, get_offering_info, get_offerings_info,\
+delete_offering, publish_offering, bind_resources, count_offerings, update_offering
 from wstore.offerings.resources_management import register_resource, get_provider_resources, delete_resource,\
 update_resource, upgrade_resource
 from wstore.social.reviews.review_manager import ReviewManager
@@ -264,10 +264,8 @@ class NewestCollection(Resource):
         site = get_current_site(request)
         context = Context.objects.get(site=site)
 
-        response = []
-        for off in context.newest:
-            offering = Offering.objects.get(pk=off)
-            response.append(get_offering_info(offering, request.user))
+        offerings = dict((o.pk, o) for o in Offering.objects.filter(pk__in=context.newest))
+        response = get_offerings_info([offerings[off] for off in context.newest if off in offerings], request.user)
 
         return HttpResponse(json.dumps(response), status=200, mimetype='application/json')
 
@@ -280,10 +278,8 @@ class TopRatedCollection(Resource):
         site = get_current_site(request)
         context = Context.objects.get(site=site)
 
-        response = []
-        for off in context.top_rated:
-            offering = Offering.objects.get(pk=off)
-            response.append(get_offering_info(offering, request.user))
+        offerings = dict((o.pk, o) for o in Offering.objects.filter(pk__in=context.top_rated))
+        response = get_offerings_info([offerings[off] for off in context.top_rated if off in offerings], request.user)
 
         return HttpResponse(json.dumps(response), status=200, mimetype='application/json;charset=UTF-8')
 
@@ -0,0 +1,13 @@
+from pymongo import ASCENDING
+
+from wstore.store_commons.database import get_database_connection
+
+db = get_database_connection()
+
+# Create indexes for the queue of CDRs to be sent if not created
+db.rss_adaptor_cdr.ensure_index([
+    ('state', ASCENDING),
+    ('next_attempt', ASCENDING)
+])
+
+db.rss_adaptor_cdr.ensure_index([('batch', ASCENDING)])
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import absolute_import
+
+import threading
+from bson import ObjectId
+from datetime import datetime, timedelta
+from urllib2 import HTTPError
+
+from django.conf import settings
+from pymongo import ASCENDING
+
+from wstore.models import RSS
+from wstore.rss_adaptor.rss_manager_factory import RSSManagerFactory
+from wstore.store_commons.database import get_database_connection
+
+
+# Seconds to wait before retrying a failed request, which is doubled
+# in every attempt up to the maximum
+RETRY_DELAY = 10
+MAX_RETRY_DELAY = 3600
+
+# Attempts made to send a CDR before moving it to the failed
+# state, where it is kept to be reviewed
+MAX_ATTEMPTS = 10
+
+# Time that a batch is reserved by a sender, after that it is
+# sent again in case the sender has failed
+SEND_LEASE = 300
+
+# Seconds that an idle sender waits before checking the queue
+POLL_INTERVAL = 30
+
+_senders = []
+_senders_lock = threading.Lock()
+_new_cdrs = threading.Event()
+
+
+def _get_collection():
+    return get_database_connection().rss_adaptor_cdr
+
+
+def _get_retry_delay(attempts):
+    return min(RETRY_DELAY * (2 ** (attempts - 1)), MAX_RETRY_DELAY)
+
+
+def enqueue_cdrs(rss, cdrs):
+    """
+    Stores the CDRs of a charge to be sent to the given RSS. The
+    correlation numbers of the CDRs are not released if the sending
+    fails, since the CDRs are retried until the RSS accepts them
+    """
+    now = datetime.now()
+
+    if len(cdrs) > 0:
+        _get_collection().insert([{
+            'rss_id': ObjectId(rss.pk),
+            'cdr': cdr,
+            'state': 'pending',
+            'attempts': 0,
+            'next_attempt': now
+        } for cdr in cdrs])
+
+        _start_senders()
+        _new_cdrs.set()
+
+
+def _claim_batch():
+    """
+    Reserves a batch of pending CDRs, returning the id of
+    the batch or None if there are no CDRs to be sent
+    """
+    collection = _get_collection()
+    now = datetime.now()
+
+    query = {'$or': [
+        {'state': 'pending', 'next_attempt': {'$lte': now}},
+        {'state': 'sending', 'lease': {'$lte': now}}
+    ]}
+
+    while True:
+        # All the CDRs of a batch are sent to the same RSS
+        first = collection.find_one(query, {'rss_id': True}, sort=[('_id', ASCENDING)])
+        if first is None:
+            return None
+
+        batch_query = dict(query)
+        batch_query['rss_id'] = first['rss_id']
+        ids = [cdr['_id'] for cdr in collection.find(batch_query, {'_id': True}).sort('_id', ASCENDING).limit(settings.CDR_BATCH_SIZE)]
+
+        # Only the CDRs not reserved by other senders in the meantime are included
+        batch_id = ObjectId()
+        batch_query['_id'] = {'$in': ids}
+        result = collection.update(batch_query, {'$set': {
+            'state': 'sending',
+            'batch': batch_id,
+            'lease': now + timedelta(seconds=SEND_LEASE)
+        }}, multi=True)
+
+        if result['n'] > 0:
+            return batch_id
+
+
+def _is_rejected(error):
+    # The RSS has rejected the content of the request
+    return isinstance(error, HTTPError) and 400 <= error.code < 500
+
+
+def _retry_later(documents):
+    """
+    Schedules the CDRs to be sent again, the backoff is calculated using
+    the CDR with more failed attempts. The CDRs that have reached the
+    maximum number of attempts are moved to the failed state
+    """
+    collection = _get_collection()
+    ids = [document['_id'] for document in documents]
+    attempts = max([document['attempts'] for document in documents]) + 1
+
+    collection.update({'_id': {'$in': ids}, 'attempts': {'$gte': MAX_ATTEMPTS - 1}}, {
+        '$set': {'state': 'failed'},
+        '$inc': {'attempts': 1},
+        '$unset': {'batch': True, 'lease': True}
+    }, multi=True)
+
+    collection.update({'_id': {'$in': ids}, 'state': 'sending'}, {
+        '$set': {
+            'state': 'pending',
+            'next_attempt': datetime.now() + timedelta(seconds=_get_retry_delay(attempts))
+        },
+        '$inc': {'attempts': 1},
+        '$unset': {'batch': True, 'lease': True}
+    }, multi=True)
+
+
+def _send_documents(adaptor, documents):
+    """
+    Sends the CDRs of the given documents in a single request. If
+    the RSS rejects a batch, its CDRs are sent one at a time so the
+    invalid ones do not prevent the others from being sent
+    """
+    try:
+        adaptor.send_cdr([document['cdr'] for document in documents])
+    except Exception as e:
+        if _is_rejected(e) and len(documents) > 1:
+            for document in documents:
+                _send_documents(adaptor, [document])
+        else:
+            _retry_later(documents)
+    else:
+        _get_collection().remove({'_id': {'$in': [document['_id'] for document in documents]}})
+
+
+def send_batch():
+    """
+    Sends a batch of pending CDRs in a single request to the RSS,
+    returning the number of CDRs of the batch
+    """
+    batch_id = _claim_batch()
+    if batch_id is None:
+        return 0
+
+    collection = _get_collection()
+    documents = list(collection.find({'batch': batch_id}).sort('_id', ASCENDING))
+
+    if len(documents) == 0:
+        return 0
+
+    try:
+        rss = RSS.objects.get(pk=str(documents[0]['rss_id']))
+        adaptor = RSSManagerFactory(rss).get_rss_adaptor()
+    except:
+        # Retry the whole batch later
+        _retry_later(documents)
+    else:
+        _send_documents(adaptor, documents)
+
+    return len(documents)
+
+
+def send_pending_cdrs():
+    """
+    Sends all the CDRs that can be sent at this moment, returning
+    the number of CDRs processed
+    """
+    processed = 0
+    sent = send_batch()
+
+    while sent > 0:
+        processed += sent
+        sent = send_batch()
+
+    return processed
+
+
+class CDRSender(threading.Thread):
+    """
+    Sender of the pool that delivers the queued CDRs
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def run(self):
+        while True:
+            _new_cdrs.wait(POLL_INTERVAL)
+            _new_cdrs.clear()
+
+            try:
+                send_pending_cdrs()
+            except:
+                pass
+
+
+def _start_senders():
+    with _senders_lock:
+        # Keep a fixed number of senders alive
+        _senders[:] = [sender for sender in _senders if sender.is_alive()]
+
+        while len(_senders) < settings.CDR_SENDERS:
+            sender = CDRSender()
+            sender.start()
+            _senders.append(sender)
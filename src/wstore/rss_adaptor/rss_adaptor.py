@@ -20,29 +20,11 @@
 
 import json
 import urllib2
-import threading
-from bson import ObjectId
 from lxml import etree
 from urllib2 import HTTPError
 from urlparse import urljoin
 
 from wstore.store_commons.utils.method_request import MethodRequest
-from wstore.store_commons.database import get_database_connection
-from wstore.models import Organization
-
-
-class RSSAdaptorThread(threading.Thread):
-
-    def __init__(self, rss, cdr_info):
-        threading.Thread.__init__(self)
-        self.rss = rss
-        self.cdr = cdr_info
-
-    def run(self):
-        from wstore.rss_adaptor.rss_manager_factory import RSSManagerFactory
-        rss_factory = RSSManagerFactory(self.rss)
-        r = rss_factory.get_rss_adaptor()
-        r.send_cdr(self.cdr)
 
 
 class RSSAdaptor():
@@ -191,23 +173,12 @@ class RSSAdaptorV2(RSSAdaptor):
 
         opener = urllib2.build_opener()
         try:
-            try:
+            opener.open(request)
+        except HTTPError as e:
+            if e.code == 401:
+                self._rss.refresh_token()
+                headers['Authorization'] = 'Bearer ' + self._rss.access_token
+                request = MethodRequest('POST', url, json.dumps(data), headers)
                 opener.open(request)
-            except HTTPError as e:
-                if e.code == 401:
-                    self._rss.refresh_token()
-                    headers['Authorization'] = 'Bearer ' + self._rss.access_token
-                    request = MethodRequest('POST', url, json.dumps(data), headers)
-                    opener.open(request)
-                else:
-                    raise e
-        except:
-
-            db = get_database_connection()
-            # Restore correlation numbers
-            for cdr in cdr_info:
-                org = Organization.objects.get(actor_id=cdr['provider'])
-                db.wstore_organization.find_and_modify(
-                    query={'_id': ObjectId(org.pk)},
-                    update={'$inc': {'correlation_number': -1}}
-                )['correlation_number']
+            else:
+                raise e
@@ -26,7 +26,8 @@ from nose_parameterized import parameterized
 from django.test import TestCase
 from django.conf import settings
 
-from wstore.rss_adaptor import rss_adaptor, expenditure_manager, rss_manager, model_manager
+from wstore.rss_adaptor import rss_adaptor, expenditure_manager, rss_manager, model_manager, cdr_queue
+from wstore.store_commons.database import get_database_connection
 from wstore.store_commons.utils.testing import mock_request
 
 
@@ -175,6 +176,88 @@ class RSSAdaptorTestCase(TestCase):
         self.assertEqual(expected_xml, body)
 
 
+class CDRQueueTestCase(TestCase):
+
+    tags = ('rss-adaptor',)
+
+    def setUp(self):
+        self._senders = settings.CDR_SENDERS
+        settings.CDR_SENDERS = 0
+
+        self._adaptor = MagicMock()
+        cdr_queue.RSS = MagicMock()
+        cdr_queue.RSSManagerFactory = MagicMock()
+        cdr_queue.RSSManagerFactory.return_value.get_rss_adaptor.return_value = self._adaptor
+
+        self._rss = MagicMock()
+        self._rss.pk = '61004aba5e05acc115f022f0'
+
+    def tearDown(self):
+        settings.CDR_SENDERS = self._senders
+        get_database_connection().rss_adaptor_cdr.drop()
+        reload(cdr_queue)
+
+    def test_cdrs_coalesced(self):
+        cdr_queue.enqueue_cdrs(self._rss, [{'correlation': '1'}, {'correlation': '2'}])
+        cdr_queue.enqueue_cdrs(self._rss, [{'correlation': '3'}])
+
+        self.assertEquals(cdr_queue.send_pending_cdrs(), 3)
+
+        # The CDRs of both charges are sent in a single request
+        self._adaptor.send_cdr.assert_called_once_with([
+            {'correlation': '1'}, {'correlation': '2'}, {'correlation': '3'}
+        ])
+        self.assertEquals(get_database_connection().rss_adaptor_cdr.count(), 0)
+
+    def test_failed_cdrs_retried(self):
+        self._adaptor.send_cdr.side_effect = HTTPError('http://examplerss/', 500, 'Error', None, None)
+
+        cdr_queue.enqueue_cdrs(self._rss, [{'correlation': '1'}])
+        self.assertEquals(cdr_queue.send_pending_cdrs(), 1)
+
+        # The CDR is kept with the same correlation number and
+        # is not sent again until the retry delay has passed
+        documents = list(get_database_connection().rss_adaptor_cdr.find())
+        self.assertEquals(len(documents), 1)
+        self.assertEquals(documents[0]['cdr'], {'correlation': '1'})
+        self.assertEquals(documents[0]['state'], 'pending')
+        self.assertEquals(documents[0]['attempts'], 1)
+
+        self.assertEquals(cdr_queue.send_pending_cdrs(), 0)
+        self.assertEquals(self._adaptor.send_cdr.call_count, 1)
+
+    def test_failed_cdrs_limit(self):
+        self._adaptor.send_cdr.side_effect = HTTPError('http://examplerss/', 500, 'Error', None, None)
+
+        cdr_queue.enqueue_cdrs(self._rss, [{'correlation': '1'}])
+        get_database_connection().rss_adaptor_cdr.update({}, {'$set': {'attempts': cdr_queue.MAX_ATTEMPTS - 1}})
+
+        self.assertEquals(cdr_queue.send_pending_cdrs(), 1)
+
+        # The CDR is kept in the failed state and is not sent again
+        documents = list(get_database_connection().rss_adaptor_cdr.find())
+        self.assertEquals(documents[0]['state'], 'failed')
+        self.assertEquals(documents[0]['attempts'], cdr_queue.MAX_ATTEMPTS)
+
+    def test_rejected_cdr_isolated(self):
+        def send_cdr(cdrs):
+            if {'correlation': '2'} in cdrs:
+                raise HTTPError('http://examplerss/', 400, 'Bad Request', None, None)
+
+        self._adaptor.send_cdr.side_effect = send_cdr
+
+        cdr_queue.enqueue_cdrs(self._rss, [{'correlation': '1'}, {'correlation': '2'}, {'correlation': '3'}])
+        self.assertEquals(cdr_queue.send_pending_cdrs(), 3)
+
+        # The CDRs of the rejected batch are sent one at a time
+        self.assertEquals(self._adaptor.send_cdr.call_count, 4)
+
+        documents = list(get_database_connection().rss_adaptor_cdr.find())
+        self.assertEquals(len(documents), 1)
+        self.assertEquals(documents[0]['cdr'], {'correlation': '2'})
+        self.assertEquals(documents[0]['state'], 'pending')
+
+
 class ExpenditureManagerTestCase(TestCase):
 
     tags = ('exp-manager', 'fiware-ut-31')
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+
+from __future__ import unicode_literals
+
+import os
+from glob import glob
+from shutil import rmtree
+from datetime import datetime
+from collections import namedtuple
+from multiprocessing import Pool
+
+from whoosh.index import create_in
+
+from wstore.models import Offering
+from wstore.offerings.usdl.text_extractor import extract_offering_text
+from wstore.search.index_checker import check_index
+from wstore.search.search_engine import SearchEngine, get_schema
+from wstore.store_commons.database import get_database_connection
+
+
+# Memory in MB used by the writer before flushing the
+# postings to disk, which are merged when committing
+WRITER_MEMORY = 256
+
+# Fields of an offering used to extract its text, which are sent to the
+# processes of the pool instead of the model instances
+OfferingFields = namedtuple('OfferingFields', ['name', 'version', 'creation_date', 'offering_description'])
+
+
+def _get_offering_fields(offering):
+    return OfferingFields(offering.name, offering.version, offering.creation_date, offering.offering_description)
+
+
+def _get_offering_batches(batch_size):
+    """
+    Reads the offerings from the database in batches, so they
+    are not loaded in memory at the same time
+    """
+    batch = []
+    cursor = get_database_connection().wstore_offering.find({}, {'_id': True}).batch_size(batch_size)
+
+    for document in cursor:
+        batch.append(unicode(document['_id']))
+
+        if len(batch) == batch_size:
+            yield list(Offering.objects.filter(pk__in=batch))
+            batch = []
+
+    if len(batch) > 0:
+        yield list(Offering.objects.filter(pk__in=batch))
+
+
+def _get_build_path(index_path):
+    return '%s.%s' % (index_path, datetime.now().strftime('%Y%m%d%H%M%S%f'))
+
+
+def _swap_index(index_path, build_path):
+    """
+    Replaces the index with the built one. The index path is a symbolic
+    link to the current build, which is replaced atomically so searches
+    never find the index missing
+    """
+    link_path = build_path + '.link'
+    os.symlink(os.path.basename(build_path), link_path)
+
+    previous_path = os.path.realpath(index_path)
+
+    # Indexes created before the rebuilds were swapped are directories,
+    # which are moved so they can be replaced by the link
+    if os.path.isdir(index_path) and not os.path.islink(index_path):
+        previous_path = _get_build_path(index_path)
+        os.rename(index_path, previous_path)
+
+    os.rename(link_path, index_path)
+
+    # The previous build is kept since other processes can
+    # be reading it until they find the new one
+    for path in glob(index_path + '.*'):
+        if not os.path.islink(path) and path not in (build_path, previous_path):
+            rmtree(path, True)
+
+
+def rebuild_index(index_path, batch_size=500, processes=None):
+    """
+    Builds the search index of all the offerings in a new directory that
+    replaces the current index when completed. The text of the offerings
+    is extracted in this process unless a number of processes is given,
+    and the documents are written with a single writer. The offerings
+    modified while the index was built are indexed again after replacing
+    it. Returns the number of indexed offerings
+    """
+    build_path = _get_build_path(index_path)
+    os.makedirs(build_path)
+
+    index = create_in(build_path, get_schema())
+    se = SearchEngine(index_path)
+
+    pool = None
+    if processes is not None and processes > 1:
+        pool = Pool(processes)
+
+    writer = index.writer(limitmb=WRITER_MEMORY)
+    indexed = 0
+
+    try:
+        for offerings in _get_offering_batches(batch_size):
+            if pool is not None:
+                texts = pool.map(extract_offering_text, [_get_offering_fields(offering) for offering in offerings])
+            else:
+                texts = [extract_offering_text(offering) for offering in offerings]
+
+            for document in se.build_documents(offerings, texts, index.schema):
+                writer.add_document(**document)
+
+            indexed += len(offerings)
+
+        writer.commit(optimize=True)
+    except:
+        if not writer.is_closed:
+            writer.cancel()
+
+        rmtree(build_path, True)
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    _swap_index(index_path, build_path)
+
+    # The changes indexed in the previous index during the
+    # rebuild are lost, so the outdated documents are repaired
+    check_index(index_path)
+
+    return indexed
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+
+from __future__ import unicode_literals
+
+import os
+import time
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+
+from wstore.models import Offering
+from wstore.search.index_manager import get_index_manager
+from wstore.search.search_engine import SearchEngine, clear_purchasers, get_fingerprint
+from wstore.store_commons.database import get_database_connection
+
+
+# Number of offerings loaded together when repairing the index
+REPAIR_BATCH_SIZE = 100
+
+_checkers = {}
+_checkers_lock = threading.Lock()
+
+
+def _get_index_fingerprints(manager):
+    """
+    Returns the fingerprints of the documents of the index, which are
+    read from the columns of the index without loading the documents
+    """
+    # The changes buffered by the process are included
+    manager.commit()
+    searcher = manager.searcher()
+
+    for field in ('id', 'fingerprint'):
+        if field not in searcher.schema or not searcher.schema[field].sortable:
+            raise Exception('The index does not include fingerprints, it must be rebuilt')
+
+    reader = searcher.reader()
+    ids = reader.column_reader('id')
+    fingerprints = reader.column_reader('fingerprint')
+
+    return dict((ids[docnum], fingerprints[docnum]) for docnum in reader.all_doc_ids())
+
+
+def _get_database_fingerprints():
+    """
+    Returns the fingerprints of the offerings calculated from the
+    database, reading only the fields included in them
+    """
+    db = get_database_connection()
+
+    purchasers = defaultdict(int)
+    for purchase in db.wstore_purchase.find({}, {'offering_id': True}):
+        purchasers[unicode(purchase['offering_id'])] += 1
+
+    content_types = dict(
+        (unicode(resource['_id']), resource.get('content_type', ''))
+        for resource in db.wstore_resource.find({}, {'content_type': True})
+    )
+
+    fingerprints = {}
+    fields = {'state': True, 'rating': True, 'offering_description.modified': True, 'tags': True, 'resources': True}
+
+    for offering in db.wstore_offering.find({}, fields):
+        pk = unicode(offering['_id'])
+        modified = offering.get('offering_description', {}).get('modified')
+        resources = [(unicode(res), content_types.get(unicode(res), '')) for res in offering.get('resources', [])]
+
+        fingerprints[pk] = get_fingerprint(offering.get('state'), modified, offering.get('rating', 0), purchasers[pk],
+                                           offering.get('tags', []), resources)
+
+    return fingerprints
+
+
+def _repair_index(index_path, outdated, removed):
+    se = SearchEngine(index_path)
+
+    for i in range(0, len(outdated), REPAIR_BATCH_SIZE):
+        batch = outdated[i:i + REPAIR_BATCH_SIZE]
+
+        # The purchasers of the offerings are loaded again from
+        # their purchases, since they can be outdated as well
+        clear_purchasers(batch)
+
+        for offering in Offering.objects.filter(pk__in=batch):
+            se.update_index(offering)
+
+    manager = get_index_manager(index_path)
+    for pk in removed:
+        manager.delete_by_term('id', pk)
+
+    se.commit()
+
+
+def check_index(index_path, repair=True):
+    """
+    Compares the fingerprints of the offerings stored in the database
+    with the ones of the search index, returning the ids of the offerings
+    whose document is outdated and the ids of the documents of offerings
+    that no longer exist. If repair is set, only those documents are
+    indexed again
+    """
+    manager = get_index_manager(index_path)
+
+    if not manager.exists():
+        raise Exception('The index does not exist')
+
+    indexed = _get_index_fingerprints(manager)
+    stored = _get_database_fingerprints()
+
+    outdated = [pk for pk, fingerprint in stored.iteritems() if indexed.get(pk) != fingerprint]
+    removed = [pk for pk in indexed if pk not in stored]
+
+    if repair and (len(outdated) > 0 or len(removed) > 0):
+        _repair_index(index_path, outdated, removed)
+
+    return outdated, removed
+
+
+class IndexChecker(threading.Thread):
+    """
+    Thread that checks and repairs periodically the
+    search index of a directory
+    """
+
+    def __init__(self, index_path):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._index_path = index_path
+
+    def run(self):
+        while True:
+            time.sleep(settings.SEARCH_CHECK_PERIOD)
+
+            try:
+                check_index(self._index_path)
+            except:
+                pass
+
+
+def start_checker(index_path):
+    index_path = os.path.abspath(index_path)
+
+    with _checkers_lock:
+        checker = _checkers.get(index_path)
+
+        if checker is None or not checker.is_alive():
+            checker = IndexChecker(index_path)
+            checker.start()
+            _checkers[index_path] = checker
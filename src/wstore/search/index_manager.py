@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+from __future__ import unicode_literals
+
+import os
+import atexit
+import threading
+
+from django.conf import settings
+from whoosh.index import create_in, open_dir, exists_in
+
+
+# Seconds that a commit waits for the index lock, which
+# can be held by the writers of other processes
+WRITER_TIMEOUT = 10
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+class IndexManager():
+    """
+    Keeps open the search index of a directory for the whole process.
+    Searchers are reused until the index changes and writes are buffered
+    and committed together, when the buffer is full or periodically
+    """
+
+    _index_path = None
+    _real_path = None
+    _index = None
+
+    def __init__(self, index_path):
+        self._index_path = index_path
+        self._lock = threading.RLock()
+        self._searchers = threading.local()
+        self._pending = []
+        self._timer = None
+
+    def _open(self):
+        with self._lock:
+            # The index directory can be removed or replaced with a
+            # rebuilt one by other processes
+            real_path = os.path.realpath(self._index_path)
+
+            if not os.path.isdir(real_path) or real_path != self._real_path:
+                self._index = None
+
+            if self._index is None and os.path.isdir(real_path) and exists_in(real_path):
+                self._index = open_dir(real_path)
+                self._real_path = real_path
+
+            return self._index
+
+    def exists(self):
+        return self._open() is not None
+
+    def get_index(self):
+        index = self._open()
+        if index is None:
+            raise Exception('The index does not exist')
+
+        return index
+
+    def create(self, schema):
+        """
+        Creates the index with the given schema if it does not exist
+        """
+        with self._lock:
+            if not self.exists():
+                if not os.path.exists(self._index_path):
+                    os.makedirs(self._index_path)
+
+                self._real_path = os.path.realpath(self._index_path)
+                self._index = create_in(self._real_path, schema)
+
+            return self._index
+
+    @property
+    def schema(self):
+        return self.get_index().schema
+
+    def searcher(self):
+        """
+        Returns a searcher of the current thread, which is refreshed
+        only when the index has been modified
+        """
+        index = self.get_index()
+        searcher = getattr(self._searchers, 'searcher', None)
+
+        if searcher is None or searcher._ix is not index:
+            # The index has been replaced, so the files of the
+            # previous one are released
+            if searcher is not None:
+                searcher.close()
+
+            searcher = index.searcher()
+        elif not searcher.up_to_date():
+            searcher = searcher.refresh()
+
+        self._searchers.searcher = searcher
+        return searcher
+
+    def _buffer(self, operation, *args, **kwargs):
+        # Check that the index exists before accepting the operation
+        self.get_index()
+
+        with self._lock:
+            self._pending.append((operation, args, kwargs))
+
+            if len(self._pending) >= settings.SEARCH_COMMIT_LIMIT:
+                self.commit()
+            elif self._timer is None:
+                self._timer = threading.Timer(settings.SEARCH_COMMIT_PERIOD, self._commit_pending)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def add_document(self, **fields):
+        self._buffer('add_document', **fields)
+
+    def update_document(self, **fields):
+        self._buffer('update_document', **fields)
+
+    def delete_by_term(self, fieldname, text):
+        self._buffer('delete_by_term', fieldname, text)
+
+    def get_document(self, id_):
+        """
+        Returns the stored fields of the document with the given id,
+        including the changes that have not been committed yet
+        """
+        with self._lock:
+            for operation, args, kwargs in reversed(self._pending):
+                if operation == 'delete_by_term' and args == ('id', id_):
+                    return None
+
+                if operation in ('add_document', 'update_document') and kwargs.get('id') == id_:
+                    return dict(kwargs)
+
+        return self.searcher().document(id=id_)
+
+    def _commit_pending(self):
+        try:
+            self.commit()
+        except:
+            # The operations are kept to be committed later
+            with self._lock:
+                if self._timer is None and len(self._pending) > 0:
+                    self._timer = threading.Timer(settings.SEARCH_COMMIT_PERIOD, self._commit_pending)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+    def commit(self):
+        """
+        Writes the buffered operations in the index using a single writer
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            if len(self._pending) == 0:
+                return
+
+            writer = self.get_index().writer(timeout=WRITER_TIMEOUT)
+            try:
+                for operation, args, kwargs in self._pending:
+                    getattr(writer, operation)(*args, **kwargs)
+            except:
+                writer.cancel()
+                raise
+
+            writer.commit()
+            self._pending = []
+
+    def close(self):
+        """
+        Commits the buffered operations and closes the index
+        """
+        with self._lock:
+            try:
+                if self.exists():
+                    self.commit()
+            finally:
+                searcher = getattr(self._searchers, 'searcher', None)
+                if searcher is not None:
+                    searcher.close()
+
+                self._pending = []
+                self._index = None
+                self._searchers = threading.local()
+
+
+def get_index_manager(index_path):
+    """
+    Returns the manager of the search index of the given directory,
+    which is shared by all the threads of the process
+    """
+    index_path = os.path.abspath(index_path)
+
+    with _managers_lock:
+        if index_path not in _managers:
+            _managers[index_path] = IndexManager(index_path)
+
+        return _managers[index_path]
+
+
+def close_index_managers():
+    with _managers_lock:
+        for manager in _managers.values():
+            manager.close()
+
+        _managers.clear()
+
+
+# Buffered operations are committed before the process ends
+atexit.register(close_index_managers)
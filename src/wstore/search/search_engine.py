@@ -20,54 +20,280 @@
 
 from __future__ import unicode_literals
 
-import os
-import rdflib
+import hashlib
+from bson import ObjectId
 from decimal import Decimal
+
+from django.conf import settings
 from whoosh.fields import Schema, TEXT, NUMERIC, DATETIME, KEYWORD
-from whoosh.index import create_in, open_dir
 from whoosh.qparser import QueryParser
-from whoosh import query
-
-from wstore.models import Offering, Purchase
-from wstore.offerings.usdl.usdl_generator import USDLGenerator
+from whoosh import query, sorting
+
+from wstore.models import Offering, Organization, Purchase, Resource
+from wstore.offerings.usdl.text_extractor import get_offering_text
+from wstore.search.index_manager import get_index_manager
+from wstore.store_commons.config_cache import get_unit
+from wstore.store_commons.database import get_database_connection
+
+
+# Facets that can be computed in a search, the field of the index
+# used for each of them and whether the field includes several values
+FACETS = {
+    'tags': ('tag', True),
+    'owner_organization': ('owner', False),
+    'price_model': ('price_model', True),
+    'content_type': ('content_type', True),
+    'access': ('access', False)
+}
+
+
+def _get_purchasers_collection():
+    return get_database_connection().search_purchasers
+
+
+def clear_purchasers(offering_ids):
+    """
+    Removes the stored purchasers of the given offerings, which
+    are loaded again from their purchases when needed
+    """
+    _get_purchasers_collection().remove({'_id': {'$in': [ObjectId(pk) for pk in offering_ids]}})
+
+
+def get_fingerprint(state, modified, rating, purchasers, tags, resources):
+    """
+    Returns the fingerprint of an offering used for checking that its
+    document is consistent with the database. It includes the state,
+    the modification date, the rating, the number of purchasers and a
+    digest of the tags and the (id, content type) pairs of the resources
+    """
+    content = ','.join(sorted(tags)) + '|' + ','.join(sorted(['%s:%s' % (id_, content_type or '') for id_, content_type in resources]))
+    digest = hashlib.md5(content.encode('utf-8')).hexdigest()
+
+    return '%s|%s|%.2f|%d|%s' % (state, modified, float(rating), purchasers, digest)
+
+
+def get_schema():
+    """
+    Returns the schema of the offerings search index
+    """
+    return Schema(
+        id=KEYWORD(stored=True, unique=True, sortable=True),
+        owner=KEYWORD(stored=True, sortable=True),
+        content=TEXT(stored=True),
+        name=KEYWORD(stored=True, sortable=True),
+        popularity=NUMERIC(int, decimal_places=2, stored=True, sortable=True, signed=False),
+        date=DATETIME(stored=True, sortable=True),
+        state=KEYWORD(stored=True),
+        purchaser=KEYWORD(stored=True, commas=True),
+        tag=KEYWORD(stored=True, commas=True, vector=True),
+        price_model=KEYWORD(stored=True, commas=True, vector=True),
+        content_type=KEYWORD(stored=True, commas=True, vector=True),
+        access=KEYWORD(stored=True, sortable=True),
+        fingerprint=KEYWORD(stored=True, sortable=True)
+    )
 
 
 class SearchEngine():
 
     _index_path = None
+    _index_manager = None
 
     def __init__(self, index_path):
         self._index_path = index_path
+        self._index_manager = get_index_manager(index_path)
+
+        # The consistency of the index is checked periodically if configured
+        if settings.SEARCH_CHECK_PERIOD:
+            from wstore.search.index_checker import start_checker
+            start_checker(index_path)
 
     def _aggregate_text(self, offering):
         """
         Create a single string for creating the index by extracting text fields
-        from the USDL document of the offering
+        from the USDL info of the offering
         """
-        graph = rdflib.ConjunctiveGraph()
+        return get_offering_text(offering)
 
-        generator = USDLGenerator()
-        graph.parse(
-            data=generator.generate_offering_usdl(offering)[0],
-            format='application/rdf+xml'
-        )
+    def _aggregate_price_models(self, offering):
+        """
+        Returns the kinds of price components defined in the
+        price plans of the offering
+        """
+        price_models = set()
+        free = True
+
+        for plan in offering.offering_description.get('pricing', {}).get('price_plans', []):
+            for comp in plan.get('price_components', []):
+                free = False
+
+                # Price functions always define pay-per-use models
+                if 'price_function' in comp:
+                    price_models.add('pay_per_use')
+                    continue
+
+                try:
+                    unit = get_unit(comp['unit'])
+                except:
+                    continue
+
+                price_models.add(unit.defined_model.replace(' ', '_'))
+
+        if free:
+            price_models.add('free')
+
+        return ','.join(sorted(price_models))
+
+    def _aggregate_facets(self, offering, resources=None):
+        """
+        Returns the fields of the document used for computing facets
+        """
+        if resources is None:
+            resources = self._load_resources(offering)
+
+        content_types = set([r.content_type for r in resources])
+
+        return {
+            'tag': ','.join(offering.tags),
+            'price_model': self._aggregate_price_models(offering),
+            'content_type': ','.join(sorted(content_types)),
+            'access': 'open' if offering.open else 'paid'
+        }
+
+    def _get_date(self, offering):
+        if offering.state == 'uploaded':
+            return offering.creation_date
+
+        return offering.publication_date
+
+    def _load_resources(self, offering):
+        # The ids of the resources are stored as ObjectIds
+        return Resource.objects.filter(pk__in=[unicode(res) for res in offering.resources])
+
+    def _get_fingerprint(self, offering, purchasers, resources):
+        modified = offering.offering_description.get('modified')
+        content_types = dict((unicode(r.pk), r.content_type) for r in resources)
 
-        text = offering.name
+        return get_fingerprint(offering.state, modified, offering.rating, len(purchasers), offering.tags, [
+            (unicode(res), content_types.get(unicode(res), '')) for res in offering.resources
+        ])
 
-        for s, p, o in graph:
-            if isinstance(o, rdflib.Literal):
-                text += ' ' + unicode(o)
+    def _build_document(self, offering, date, schema=None, text=None, purchasers=None, resources=None):
+        """
+        Returns the fields of the document of an offering. The information
+        already loaded for several offerings can be provided
+        """
+        if text is None:
+            text = self._aggregate_text(offering)
+
+        if purchasers is None:
+            purchasers = self._load_purchasers(offering)
+
+        if resources is None:
+            resources = list(self._load_resources(offering))
+
+        document = {
+            'id': unicode(offering.pk),
+            'owner': unicode(offering.owner_organization_id),
+            'content': unicode(text),
+            'name': unicode(offering.name),
+            'popularity': Decimal(offering.rating),
+            'date': date,
+            'state': unicode(offering.state),
+            'purchaser': ','.join(purchasers),
+            'fingerprint': self._get_fingerprint(offering, purchasers, resources)
+        }
+        document.update(self._aggregate_facets(offering, resources))
+
+        # Indexes created before including a field are not updated with it
+        if schema is None:
+            schema = self._index_manager.schema
+
+        return dict((name, value) for name, value in document.items() if name in schema)
+
+    def build_documents(self, offerings, texts, schema):
+        """
+        Returns the documents of several offerings whose texts have been
+        already extracted, loading their purchasers and resources together
+        """
+        entries = _get_purchasers_collection().find({'_id': {'$in': [ObjectId(o.pk) for o in offerings]}})
+        purchasers = dict((unicode(entry['_id']), entry['purchasers']) for entry in entries)
+
+        # The ids of the resources are stored as ObjectIds
+        resource_ids = set([unicode(res) for o in offerings for res in o.resources])
+        resources = dict((unicode(r.pk), r) for r in Resource.objects.filter(pk__in=list(resource_ids)))
+
+        documents = []
+        for offering, text in zip(offerings, texts):
+            documents.append(self._build_document(
+                offering,
+                self._get_date(offering),
+                schema=schema,
+                text=text,
+                purchasers=purchasers.get(offering.pk),
+                resources=[resources[unicode(res)] for res in offering.resources if unicode(res) in resources]
+            ))
+
+        return documents
+
+    def _load_purchasers(self, offering):
+        """
+        Returns the organizations that have purchased the offering, which
+        are stored in a set updated with every purchase. The set of the
+        offerings purchased before it existed is built the first time
+        """
+        collection = _get_purchasers_collection()
+        entry = collection.find_one({'_id': ObjectId(offering.pk)})
+
+        if entry is None:
+            purchasers = [unicode(p.owner_organization_id) for p in Purchase.objects.filter(offering=offering)]
+            entry = collection.find_and_modify(
+                query={'_id': ObjectId(offering.pk)},
+                update={'$addToSet': {'purchasers': {'$each': purchasers}}},
+                upsert=True,
+                new=True
+            )
+
+        return entry['purchasers']
+
+    def _update_purchasers(self, offering, update):
+        if not self._index_manager.exists():
+            raise Exception('The index does not exist')
+
+        # Ensure that the set of purchasers exists before modifying it
+        self._load_purchasers(offering)
 
-        return text
+        entry = _get_purchasers_collection().find_and_modify(
+            query={'_id': ObjectId(offering.pk)},
+            update=update,
+            new=True
+        )
+
+        document = self._index_manager.get_document(unicode(offering.pk))
 
-    def _aggregate_purchasers(self, offering):
-        purchases = Purchase.objects.filter(offering=offering)
+        # Documents of indexes that do not store every
+        # field are aggregated again
+        if document is None or any(name not in document for name in self._index_manager.schema.names()):
+            self.update_index(offering)
+        else:
+            document['purchaser'] = ','.join(entry['purchasers'])
 
-        result = ''
-        for p in purchases:
-            result += p.owner_organization.pk + ','
+            if 'fingerprint' in document:
+                document['fingerprint'] = self._get_fingerprint(offering, entry['purchasers'], self._load_resources(offering))
+            self._index_manager.update_document(**document)
 
-        return result[:-1]
+    def add_purchaser(self, offering, organization):
+        """
+        Includes an organization in the purchasers of the offering,
+        rewriting only the purchaser field of its document
+        """
+        self._update_purchasers(offering, {'$addToSet': {'purchasers': unicode(organization.pk)}})
+
+    def remove_purchaser(self, offering, organization):
+        """
+        Removes an organization from the purchasers of the offering,
+        rewriting only the purchaser field of its document
+        """
+        self._update_purchasers(offering, {'$pull': {'purchasers': unicode(organization.pk)}})
 
     def create_index(self, offering):
         """
@@ -76,201 +302,198 @@ class SearchEngine():
         """
 
         # Check if the index already exists to avoid overwrite it
-        if not os.path.exists(self._index_path) or os.listdir(self._index_path) == []:
-            # Create dir if needed
-            if not os.path.exists(self._index_path):
-                os.makedirs(self._index_path)
-
-            # Create schema
-            schema = Schema(
-                id=KEYWORD(stored=True, unique=True),
-                owner=KEYWORD,
-                content=TEXT,
-                name=KEYWORD(sortable=True),
-                popularity=NUMERIC(int, decimal_places=2, sortable=True, signed=False),
-                date=DATETIME(sortable=True),
-                state=KEYWORD,
-                purchaser=KEYWORD(stored=True, commas=True)
-            )
+        if not self._index_manager.exists():
             # Create index
-            index = create_in(self._index_path, schema)
-        else:
-            index = open_dir(self._index_path)
-
-        # Open the index
-        index_writer = index.writer()
+            self._index_manager.create(get_schema())
 
         # Aggregate all the information included in the USDL document in
         # a single string in order to add a new document to the index
-        text = self._aggregate_text(offering)
-        purchasers_text = self._aggregate_purchasers(offering)
-
-        # Add the new document
-        index_writer.add_document(
-            id=unicode(offering.pk),
-            owner=unicode(offering.owner_organization.pk),
-            content=unicode(text),
-            name=unicode(offering.name),
-            popularity=Decimal(offering.rating),
-            date=offering.creation_date,
-            state=unicode(offering.state),
-            purchaser=purchasers_text
-        )
-        index_writer.commit()
+        self._index_manager.add_document(**self._build_document(offering, offering.creation_date))
 
     def update_index(self, offering):
         """
         Update the document of a concrete offering in the search index
         """
 
-        if not os.path.exists(self._index_path) or os.listdir(self._index_path) == []:
+        if not self._index_manager.exists():
             raise Exception('The index does not exist')
 
-        index = open_dir(self._index_path)
-
-        index_writer = index.writer()
-        text = self._aggregate_text(offering)
-        purchasers_text = self._aggregate_purchasers(offering)
-
-        in_date = None
-        if offering.state == 'uploaded':
-            in_date = offering.creation_date
-        else:
-            in_date = offering.publication_date
-
         # Get the document
-        index_writer.update_document(
-            id=unicode(offering.pk),
-            owner=unicode(offering.owner_organization.pk),
-            content=unicode(text),
-            name=unicode(offering.name),
-            popularity=Decimal(offering.rating),
-            date=in_date,
-            state=unicode(offering.state),
-            purchaser=purchasers_text
-        )
-
-        index_writer.commit()
+        self._index_manager.update_document(**self._build_document(offering, self._get_date(offering)))
 
     def remove_index(self, offering):
         """
         Remove the document associated with an offering
         """
-        if not os.path.exists(self._index_path) or os.listdir(self._index_path) == []:
+        if not self._index_manager.exists():
             raise Exception('The index does not exist')
 
-        index = open_dir(self._index_path)
-        index_writer = index.writer()
+        self._index_manager.delete_by_term('id', unicode(offering.pk))
+
+    def commit(self):
+        """
+        Writes in the index the changes buffered by the process
+        """
+        self._index_manager.commit()
+
+    def _get_offerings_info(self, user, offering_ids):
+        """
+        Loads the info of the offerings of a search result, which are
+        retrieved in a single query and returned in the order of the result
+        """
+        # The get_offerings_info method is imported inside this method in order to avoid a cross-reference import error
+        from wstore.offerings.offerings_management import get_offerings_info
+
+        offerings = dict((o.pk, o) for o in Offering.objects.filter(pk__in=offering_ids))
 
-        index_writer.delete_by_term('id', unicode(offering.pk))
-        index_writer.commit()
+        return get_offerings_info([offerings[pk] for pk in offering_ids if pk in offerings], user)
 
-    def full_text_search(self, user, text, state=None, count=False, pagination=None, sort=None):
+    def _get_facets(self, searcher, facets):
+        """
+        Builds the facets to be computed in a search
+        """
+        groupedby = {}
+        for facet in facets:
+            if facet not in FACETS:
+                raise ValueError('Invalid facet')
+
+            field, multiple = FACETS[facet]
+
+            # Indexes created before including a field cannot compute its facet
+            if field in searcher.schema:
+                groupedby[facet] = sorting.FieldFacet(field, allow_overlap=multiple)
+
+        return groupedby
+
+    def _count_facets(self, results, facets):
+        """
+        Returns the number of results for every value of the facets
+        """
+        counts = {}
+        for facet in facets:
+            counts[facet] = {}
+
+            if facet in results.facet_names():
+                for value, number in results.groups(facet).iteritems():
+                    if value is not None and value != '':
+                        counts[facet][value] = number
+
+        # Owners are identified in the index by the organization pk
+        if 'owner_organization' in counts:
+            owners = counts['owner_organization']
+            counts['owner_organization'] = dict(
+                (org.name, owners[org.pk]) for org in Organization.objects.filter(pk__in=owners.keys())
+            )
+
+        return counts
+
+    def full_text_search(self, user, text, state=None, count=False, pagination=None, sort=None, total=False, facets=None):
         """
         Performs a full text search over the search index allowing for counting, filtering
-        by state, paginating and sorting.
+        by state, paginating and sorting. If total is set the number of results is
+        returned together with the offerings, as well as the counts of the given facets,
+        which are computed over all the results of the search
         """
 
-        if not os.path.exists(self._index_path) or os.listdir(self._index_path) == []:
+        if not self._index_manager.exists():
             raise Exception('The index does not exist')
 
-        # Get the index reader
-        index = open_dir(self._index_path)
+        # The searcher is shared by the searches of the thread
+        searcher = self._index_manager.searcher()
 
-        with index.searcher() as searcher:
+        # Create the query
+        query_ = QueryParser('content', searcher.schema).parse(unicode(text))
 
-            # Create the query
-            query_ = QueryParser('content', index.schema).parse(unicode(text))
+        # If an state has been defined filter the result
+        if state:
+            # Validate state
+            for st in state:
+                if not st in ['purchased', 'uploaded', 'deleted', 'published']:
+                    raise ValueError('Invalid state')
 
-            # If an state has been defined filter the result
-            if state:
-                # Validate state
-                for st in state:
-                    if not st in ['purchased', 'uploaded', 'deleted', 'published']:
-                        raise ValueError('Invalid state')
-
-                if 'purchased' in state:
-                    filter_ = query.Term('purchaser', user.userprofile.current_organization.pk)
-                else:
-                    filter_ = query.Term('owner', unicode(user.userprofile.current_organization.pk))
-
-                    state_filter = None
-                    for st in state:
-                        if not state_filter:
-                            state_filter = query.Term('state', st)
-                        else:
-                            state_filter = state_filter | query.Term('state', st)
-
-                    filter_ = filter_ & state_filter
+            if 'purchased' in state:
+                filter_ = query.Term('purchaser', user.userprofile.current_organization.pk)
             else:
-                # If state is not included the default behaviour is returning
-                # published offerings
-                filter_ = query.Term('state', 'published')
-
-            # Create sorting params if needed
-            if sort:
-                if sort == 'popularity' or sort == 'date':
-                    reverse = True
-                elif sort == 'name':
-                    reverse = False
-                else:
-                    raise ValueError('Undefined sorting')
-
-            # If pagination has been defined, limit the results
-            if pagination:
-                # Validate pagination fields
-                if not isinstance(pagination, dict):
-                    raise TypeError('Invalid pagination type')
-
-                if not 'start' in pagination or not 'limit' in pagination:
-                    raise ValueError('Missing required field in pagination')
-
-                if not isinstance(pagination['start'], int) or not isinstance(pagination['limit'], int):
-                    raise TypeError('Invalid pagination params type')
-
-                if pagination['start'] < 1:
-                    raise ValueError('Start param must be higher than 0')
-
-                if pagination['limit'] < 0:
-                    raise ValueError('Limit param must be positive')
-
-                search_params = (query_, )
-                search_kwparams = {
-                    'filter': filter_,
-                }
-
-                if sort:
-                    search_kwparams['sortedby'] = sort
-                    search_kwparams['reverse'] = reverse
-
-                # Check limits
-                search_len = len(searcher.search(*search_params, **search_kwparams))
-
-                if pagination['start'] > search_len:
-                    search_result = []
-                else:
-                    search_params = (query_, pagination['start'])
-                    search_kwparams['pagelen'] = pagination['limit']
-                    search_result = searcher.search_page(*search_params, **search_kwparams)
+                filter_ = query.Term('owner', unicode(user.userprofile.current_organization.pk))
+
+                state_filter = None
+                for st in state:
+                    if not state_filter:
+                        state_filter = query.Term('state', st)
+                    else:
+                        state_filter = state_filter | query.Term('state', st)
+
+                filter_ = filter_ & state_filter
+        else:
+            # If state is not included the default behaviour is returning
+            # published offerings
+            filter_ = query.Term('state', 'published')
+
+        # Create sorting params if needed
+        if sort:
+            if sort == 'popularity' or sort == 'date':
+                reverse = True
+            elif sort == 'name':
+                reverse = False
             else:
-                if sort:
-                    search_result = searcher.search(query_, filter=filter_, limit=None, sortedby=sort, reverse=reverse)
-                else:
-                    search_result = searcher.search(query_, filter=filter_, limit=None)
-                
+                raise ValueError('Undefined sorting')
 
-            result = []
-            # The get_offering_info method is imported inside this method in order to avoid a cross-reference import error
-            from wstore.offerings.offerings_management import get_offering_info
+        search_kwparams = {
+            'filter': filter_
+        }
 
+        if sort:
+            search_kwparams['sortedby'] = sort
+            search_kwparams['reverse'] = reverse
 
-            if not count:
-                for hit in search_result:
+        # Facets are computed by the same search that retrieves the results
+        if facets:
+            search_kwparams['groupedby'] = self._get_facets(searcher, facets)
+            search_kwparams['maptype'] = sorting.Count
 
-                    # Get the offerings
-                    offering = Offering.objects.get(pk=hit['id'])
-                    result.append(get_offering_info(offering, user))
-            else:
-                result = {'number': len(search_result)}
+        # If pagination has been defined, limit the results
+        if pagination:
+            # Validate pagination fields
+            if not isinstance(pagination, dict):
+                raise TypeError('Invalid pagination type')
+
+            if not 'start' in pagination or not 'limit' in pagination:
+                raise ValueError('Missing required field in pagination')
+
+            if not isinstance(pagination['start'], int) or not isinstance(pagination['limit'], int):
+                raise TypeError('Invalid pagination params type')
+
+            if pagination['start'] < 1:
+                raise ValueError('Start param must be higher than 0')
+
+            if pagination['limit'] < 0:
+                raise ValueError('Limit param must be positive')
+
+            # The page and the total number of results are
+            # obtained from the same search
+            search_result = searcher.search_page(query_, pagination['start'], pagelen=pagination['limit'], **search_kwparams)
+            results = search_result.results
+            search_len = search_result.total
+
+            if pagination['start'] > search_len:
+                search_result = []
+        else:
+            search_result = searcher.search(query_, limit=None, **search_kwparams)
+            results = search_result
+            search_len = len(search_result)
+
+        if count:
+            return {'number': search_len}
+
+        result = self._get_offerings_info(user, [hit['id'] for hit in search_result])
+
+        if total or facets:
+            result = {
+                'number': search_len,
+                'offerings': result
+            }
+
+        if facets:
+            result['facets'] = self._count_facets(results, facets)
 
         return result
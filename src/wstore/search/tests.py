@@ -21,6 +21,8 @@
 from __future__ import unicode_literals
 
 import os
+import pickle
+from bson import ObjectId
 from decimal import Decimal
 from datetime import datetime
 from mock import MagicMock
@@ -30,14 +32,21 @@ from whoosh.qparser import QueryParser
 from nose_parameterized import parameterized
 from whoosh import query
 from shutil import rmtree
+from glob import glob
 
 from django.test import TestCase
 from django.contrib.auth.models import User
 from django.conf import settings
 
 from wstore.search import search_engine
-from wstore.models import Offering
+from wstore.search import index_manager
+from wstore.search import index_builder
+from wstore.search import index_checker
+from wstore.models import Offering, Organization, Resource
+from wstore.offerings.usdl.text_extractor import extract_offering_text
 from wstore.contracting.models import Purchase
+from wstore.charging_engine.models import Unit
+from wstore.store_commons.database import get_database_connection
 
 
 __test__ = False
@@ -131,23 +140,14 @@ def _remove_index(ins, off=None, sa=None):
     rmtree(path)
 
 
-def _mock_generator(self):
-    search_engine.USDLGenerator = MagicMock()
-    self._gen_inst = MagicMock()
-    f = open(os.path.join(settings.BASEDIR, 'wstore/test/test_usdl.rdf'), 'rb')
-    self._gen_inst.generate_offering_usdl.return_value = (f.read(), 'http://usdluri.com/')
-    search_engine.USDLGenerator.return_value = self._gen_inst
-
-
 class IndexCreationTestCase(TestCase):
 
     tags = ('fiware-ut-6',)
     fixtures = ['create_index.json']
 
-    def setUp(self):
-        _mock_generator(self)
-
     def tearDown(self):
+        index_manager.close_index_managers()
+        get_database_connection().search_purchasers.drop()
         reload(search_engine)
 
     @classmethod
@@ -158,8 +158,17 @@ class IndexCreationTestCase(TestCase):
     def test_basic_index_creaton(self):
 
         offering = Offering.objects.get(name='test_offering')
+        offering.offering_description = {
+            'description': 'A widget offering',
+            'abstract': 'An offering',
+            'modified': '2013-02-05 17:06:46',
+            'pricing': {
+                'price_plans': []
+            }
+        }
         se = search_engine.SearchEngine(settings.BASEDIR + '/wstore/test/test_index')
         se.create_index(offering)
+        se.commit()
 
         # Get the index reader
         index = open_dir(settings.BASEDIR + '/wstore/test/test_index')
@@ -186,6 +195,7 @@ class FullTextSearchTestCase(TestCase):
         super(FullTextSearchTestCase, cls).setUpClass()
 
     def tearDown(self):
+        index_manager.close_index_managers()
         try:
             _remove_index(self)
         except:
@@ -264,6 +274,73 @@ class FullTextSearchTestCase(TestCase):
             self.assertEquals(unicode(e), err_msg)
 
 
+    def test_search_total(self):
+        user = User.objects.get(username='test_user')
+        se = search_engine.SearchEngine(settings.BASEDIR + '/wstore/test/test_index')
+
+        result = se.full_text_search(user, 'offering', pagination={'start': 2, 'limit': 2}, sort='name', total=True)
+
+        self.assertEquals(result['number'], 4)
+        self.assertEquals([res['name'] for res in result['offerings']], RESULT_PUBLISHED[2:])
+
+
+class FacetSearchTestCase(TestCase):
+
+    tags = ('fiware-ut-6',)
+    fixtures = ['full_text.json']
+
+    def setUp(self):
+        self._path = settings.BASEDIR + '/wstore/test/test_index'
+        Unit.objects.create(name='per month', defined_model='subscription', renovation_period=30)
+
+        for name, tags, open_ in (('test_offering1', ['widget'], False), ('test_offering2', ['widget', 'mashup'], False),
+                                  ('test_offering3', [], True)):
+            offering = Offering.objects.get(name=name)
+            offering.tags = tags
+            offering.open = open_
+            offering.save()
+
+        self._se = search_engine.SearchEngine(self._path)
+        self._se._aggregate_text = MagicMock()
+        self._se._aggregate_text.return_value = 'an offering'
+
+        for offering in Offering.objects.all():
+            self._se.create_index(offering)
+
+        self._se.commit()
+
+    def tearDown(self):
+        index_manager.close_index_managers()
+        get_database_connection().search_purchasers.drop()
+        rmtree(self._path, True)
+
+    def test_search_facets(self):
+        user = User.objects.get(username='test_user')
+
+        result = self._se.full_text_search(user, 'offering', pagination={'start': 1, 'limit': 2},
+                                           facets=['tags', 'owner_organization', 'access', 'price_model'])
+
+        # Facets are computed over all the results, not only the page
+        self.assertEquals(result['number'], 4)
+        self.assertEquals(len(result['offerings']), 2)
+        self.assertEquals(result['facets'], {
+            'tags': {'widget': 2, 'mashup': 1},
+            'owner_organization': {'test_organization': 4},
+            'access': {'open': 1, 'paid': 3},
+            'price_model': {'subscription': 2, 'free': 2}
+        })
+
+    def test_invalid_facet(self):
+        user = User.objects.get(username='test_user')
+
+        try:
+            self._se.full_text_search(user, 'offering', facets=['invalid'])
+        except ValueError as e:
+            self.assertEquals(unicode(e), 'Invalid facet')
+        else:
+            self.fail('The facet should have been rejected')
+
+
 class UpdateIndexTestCase(TestCase):
 
     tags = ('fiware-ut-6',)
@@ -278,6 +355,8 @@ class UpdateIndexTestCase(TestCase):
         super(UpdateIndexTestCase, cls).setUpClass()
 
     def tearDown(self):
+        index_manager.close_index_managers()
+        get_database_connection().search_purchasers.drop()
         try:
             _remove_index(self)
         except:
@@ -286,7 +365,6 @@ class UpdateIndexTestCase(TestCase):
 
     def setUp(self):
         # Fill user info
-        _mock_generator(self)
         user = User.objects.get(username='test_user')
         for p in Purchase.objects.all():
             user.userprofile.offerings_purchased.append(p.offering.pk)
@@ -358,6 +436,7 @@ class UpdateIndexTestCase(TestCase):
         error = None
         try:
             se.update_index(off)
+            se.commit()
         except Exception as e:
             error = e
 
@@ -377,3 +456,295 @@ class UpdateIndexTestCase(TestCase):
         else:
             self.assertTrue(isinstance(error, err_type))
             self.assertEquals(unicode(error), err_msg)
+
+
+class PurchaserIndexTestCase(TestCase):
+
+    tags = ('fiware-ut-6',)
+    fixtures = ['update_index.json']
+
+    def setUp(self):
+        self._path = settings.BASEDIR + '/wstore/test/test_index'
+        self._offering = Offering.objects.get(pk='61000aba8e05ac2115111111')
+        self._organization = Organization.objects.get(pk='91000aba8e06ac2115f022f0')
+
+        self._se = search_engine.SearchEngine(self._path)
+        self._se._aggregate_text = MagicMock()
+        self._se._aggregate_text.return_value = 'an offering'
+
+        self._se.create_index(self._offering)
+        self._se.commit()
+
+    def tearDown(self):
+        index_manager.close_index_managers()
+        get_database_connection().search_purchasers.drop()
+        rmtree(self._path, True)
+
+    def _search_purchaser(self):
+        index = open_dir(self._path)
+        with index.searcher() as searcher:
+            query_ = query.Term('purchaser', self._organization.pk) & query.Term('content', 'offering')
+            return len(searcher.search(query_))
+
+    def test_add_remove_purchaser(self):
+        self._se.add_purchaser(self._offering, self._organization)
+        self._se.commit()
+
+        self.assertEquals(self._search_purchaser(), 1)
+        self.assertEquals(self._se._load_purchasers(self._offering), [self._organization.pk])
+
+        # The content of the document is not aggregated again
+        self._se.remove_purchaser(self._offering, self._organization)
+        self._se.commit()
+
+        self.assertEquals(self._search_purchaser(), 0)
+        self.assertEquals(self._se._load_purchasers(self._offering), [])
+        self.assertEquals(self._se._aggregate_text.call_count, 1)
+
+
+class IndexBuilderTestCase(TestCase):
+
+    tags = ('fiware-ut-6',)
+    fixtures = ['full_text.json']
+
+    def setUp(self):
+        self._path = settings.BASEDIR + '/wstore/test/test_index'
+
+        for offering in Offering.objects.all():
+            offering.offering_description['description'] = 'an offering'
+            offering.save()
+
+        # Index created before the rebuilds were swapped
+        manager = index_manager.get_index_manager(self._path)
+        manager.create(search_engine.get_schema())
+
+    def tearDown(self):
+        index_manager.close_index_managers()
+        get_database_connection().search_purchasers.drop()
+
+        if os.path.islink(self._path):
+            os.remove(self._path)
+
+        for path in glob(self._path + '*'):
+            rmtree(path, True)
+
+    def _search(self):
+        user = User.objects.get(username='test_user')
+        se = search_engine.SearchEngine(self._path)
+        return se.full_text_search(user, 'offering', count=True)
+
+    def test_rebuild_index(self):
+        self.assertEquals(self._search(), {'number': 0})
+
+        self.assertEquals(index_builder.rebuild_index(self._path, batch_size=3, processes=1), 8)
+
+        # The index is replaced by a link to the built one, which is
+        # found by the managers that had opened the previous one
+        self.assertTrue(os.path.islink(self._path))
+        self.assertEquals(self._search(), {'number': 4})
+        self.assertEquals(len(glob(self._path + '.*')), 2)
+
+        # Only the previous build is kept
+        first_build = os.path.realpath(self._path)
+        index_builder.rebuild_index(self._path, batch_size=3, processes=1)
+
+        self.assertEquals(self._search(), {'number': 4})
+        self.assertEquals(sorted(glob(self._path + '.*')), sorted([first_build, os.path.realpath(self._path)]))
+
+    def test_rebuild_concurrent_changes(self):
+        get_offering_batches = index_builder._get_offering_batches
+
+        def get_batches(batch_size):
+            for batch in get_offering_batches(batch_size):
+                yield batch
+
+            # The offering is modified after being read by the rebuild
+            offering = Offering.objects.get(name='test_offering5')
+            offering.state = 'published'
+            offering.save()
+
+        index_builder._get_offering_batches = get_batches
+        try:
+            index_builder.rebuild_index(self._path, batch_size=3, processes=1)
+        finally:
+            index_builder._get_offering_batches = get_offering_batches
+
+        # The document of the offering is updated after the swap
+        self.assertEquals(index_checker.check_index(self._path, repair=False), ([], []))
+
+    def test_offering_fields(self):
+        offering = Offering.objects.get(name='test_offering1')
+        fields = index_builder._get_offering_fields(offering)
+
+        # The text extracted from the fields is the one of the offering
+        self.assertEquals(extract_offering_text(fields), extract_offering_text(offering))
+        self.assertEquals(pickle.loads(pickle.dumps(fields)), fields)
+
+    def test_rebuild_resources(self):
+        offering = Offering.objects.get(name='test_offering1')
+        resource = Resource.objects.create(
+            name='test_resource',
+            version='1.0',
+            provider=offering.owner_organization,
+            content_type='application/x-widget',
+            description='',
+            state='uploaded',
+            download_link='http://example.com/widget.wgt'
+        )
+
+        # Bound resources are stored as ObjectIds
+        offering.resources = [ObjectId(resource.pk)]
+        offering.save()
+
+        index_builder.rebuild_index(self._path, batch_size=3, processes=1)
+
+        user = User.objects.get(username='test_user')
+        result = search_engine.SearchEngine(self._path).full_text_search(user, 'offering', facets=['content_type'])
+        self.assertEquals(result['facets'], {'content_type': {'application/x-widget': 1}})
+
+
+class IndexCheckerTestCase(TestCase):
+
+    tags = ('fiware-ut-6',)
+    fixtures = ['full_text.json']
+
+    def setUp(self):
+        self._path = settings.BASEDIR + '/wstore/test/test_index'
+        index_builder.rebuild_index(self._path, processes=1)
+
+    def tearDown(self):
+        index_manager.close_index_managers()
+        get_database_connection().search_purchasers.drop()
+
+        if os.path.islink(self._path):
+            os.remove(self._path)
+
+        for path in glob(self._path + '*'):
+            rmtree(path, True)
+
+    def test_check_index(self):
+        self.assertEquals(index_checker.check_index(self._path), ([], []))
+
+        # Changes saved in the database without updating the index
+        offering = Offering.objects.get(name='test_offering5')
+        offering.state = 'published'
+        offering.save()
+
+        removed = Offering.objects.get(name='test_offering8')
+        removed_pk = removed.pk
+        removed.delete()
+
+        self.assertEquals(index_checker.check_index(self._path, repair=False), ([offering.pk], [removed_pk]))
+
+        # Only the inconsistent documents are indexed again
+        self.assertEquals(index_checker.check_index(self._path), ([offering.pk], [removed_pk]))
+        self.assertEquals(index_checker.check_index(self._path), ([], []))
+
+        index = open_dir(self._path)
+        with index.searcher() as searcher:
+            self.assertEquals(len(searcher.search(query.Term('state', 'published'))), 5)
+            self.assertEquals(len(searcher.search(query.Term('id', removed_pk))), 0)
+
+    def test_check_tags_resources(self):
+        # Tags and resources are included in the fingerprints
+        tagged = Offering.objects.get(name='test_offering1')
+        tagged.tags = ['widget']
+        tagged.save()
+
+        resource = Resource.objects.create(
+            name='test_resource',
+            version='1.0',
+            provider=tagged.owner_organization,
+            content_type='application/x-widget',
+            description='',
+            state='uploaded'
+        )
+
+        bound = Offering.objects.get(name='test_offering2')
+        bound.resources = [ObjectId(resource.pk)]
+        bound.save()
+
+        self.assertEquals(sorted(index_checker.check_index(self._path)[0]), sorted([tagged.pk, bound.pk]))
+
+        # Changing the content type of a resource outdates its offerings
+        resource.content_type = 'text/plain'
+        resource.save()
+
+        self.assertEquals(index_checker.check_index(self._path), ([bound.pk], []))
+        self.assertEquals(index_checker.check_index(self._path), ([], []))
+
+
+class IndexManagerTestCase(TestCase):
+
+    tags = ('index-manager',)
+
+    def setUp(self):
+        self._path = settings.BASEDIR + '/wstore/test/test_index'
+        self._manager = index_manager.IndexManager(self._path)
+        self._manager.create(Schema(id=KEYWORD(stored=True, unique=True), content=TEXT))
+
+    def tearDown(self):
+        self._manager.close()
+        rmtree(self._path, True)
+
+    def _search(self, text):
+        searcher = self._manager.searcher()
+        query_ = QueryParser('content', searcher.schema).parse(text)
+        return [hit['id'] for hit in searcher.search(query_)]
+
+    def test_buffered_writes(self):
+        settings.SEARCH_COMMIT_LIMIT = 3
+
+        self._manager.add_document(id='1', content='an offering')
+        self._manager.add_document(id='2', content='an offering')
+
+        # The changes are buffered until the limit is reached
+        self.assertEquals(self._search('offering'), [])
+        searcher = self._manager.searcher()
+
+        self._manager.update_document(id='1', content='an updated offering')
+        self.assertEquals(sorted(self._search('offering')), ['1', '2'])
+        self.assertEquals(self._search('updated'), ['1'])
+
+        # The searcher is refreshed only when the index changes
+        searcher = self._manager.searcher()
+        self.assertTrue(self._manager.searcher() is searcher)
+
+        self._manager.delete_by_term('id', '2')
+        self._manager.commit()
+        self.assertEquals(self._search('offering'), ['1'])
+        self.assertFalse(self._manager.searcher() is searcher)
+
+        settings.SEARCH_COMMIT_LIMIT = 100
+
+    def test_swapped_index(self):
+        self._manager.add_document(id='1', content='an offering')
+        self._manager.commit()
+        searcher = self._manager.searcher()
+
+        # The index is replaced by a rebuilt one
+        os.rename(self._path, self._path + '.old')
+        new_path = self._path + '.new'
+        os.makedirs(new_path)
+        create_in(new_path, Schema(id=KEYWORD(stored=True, unique=True), content=TEXT))
+        os.symlink(os.path.basename(new_path), self._path)
+
+        try:
+            self.assertEquals(self._search('offering'), [])
+            self.assertTrue(searcher.is_closed)
+        finally:
+            self._manager.close()
+            os.remove(self._path)
+            rmtree(self._path + '.old', True)
+            rmtree(new_path, True)
+
+    def test_removed_index(self):
+        rmtree(self._path)
+
+        self.assertFalse(self._manager.exists())
+        try:
+            self._manager.add_document(id='1', content='an offering')
+        except Exception as e:
+            self.assertEquals(unicode(e), 'The index does not exist')
+        else:
+            self.fail('The operation should have been rejected')
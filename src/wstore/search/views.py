@@ -28,7 +28,7 @@ from django.conf import settings
 
 from wstore.store_commons.utils.http import build_response, authentication_required
 from wstore.store_commons.resource import Resource
-from wstore.search.search_engine import SearchEngine
+from wstore.search.search_engine import SearchEngine, FACETS
 from wstore.models import Resource as WStore_resource
 from wstore.models import Organization, Offering
 from wstore.offerings.offerings_management import get_offering_info
@@ -50,6 +50,7 @@ class SearchEntry(Resource):
         start = request.GET.get('start', None)
         limit = request.GET.get('limit', None)
         sort = request.GET.get('sort', None)
+        facets = request.GET.get('facets', None)
 
         state = request.GET.get('state', None)
         if state:
@@ -69,15 +70,20 @@ class SearchEntry(Resource):
             return build_response(request, 400, 'Invalid filters')
 
         count = False
+        total = False
         pagination = None
-        # Check if the action is count
-        if action != None:
+        # Check if the action is count or page, in the later the
+        # number of results is returned together with the offerings
+        if action != None and action != 'page':
             if action == 'count':
                 count = True
+                facets = None
             else:
                 return build_response(request, 400, 'Invalid action')
         else:
-            # Check pagination params (Only when action is none)
+            total = action == 'page'
+
+            # Check pagination params (Only when action is none or page)
             if start != None and limit != None:
                 pagination = {
                     'start': int(start),
@@ -91,14 +97,21 @@ class SearchEntry(Resource):
                 if sort != 'date' and sort != 'popularity' and sort != 'name':
                     return build_response(request, 400, 'Invalid sorting')
 
+            # Check facets, which are returned together with the offerings
+            if facets != None:
+                facets = facets.split(',')
+                for facet in facets:
+                    if facet not in FACETS:
+                        return build_response(request, 400, 'Invalid facet')
+
         if not filter_ or filter_ == 'published':
-            response = search_engine.full_text_search(request.user, text, count=count, pagination=pagination, sort=sort)
+            response = search_engine.full_text_search(request.user, text, count=count, pagination=pagination, sort=sort, total=total, facets=facets)
 
         elif filter_ == 'provided':
-            response = search_engine.full_text_search(request.user, text, state=state, count=count, pagination=pagination, sort=sort)
+            response = search_engine.full_text_search(request.user, text, state=state, count=count, pagination=pagination, sort=sort, total=total, facets=facets)
 
         elif filter_ == 'purchased':
-            response = search_engine.full_text_search(request.user, text, state=['purchased'], count=count, pagination=pagination, sort=sort)
+            response = search_engine.full_text_search(request.user, text, state=['purchased'], count=count, pagination=pagination, sort=sort, total=total, facets=facets)
 
         return HttpResponse(json.dumps(response), status=200, mimetype='application/json')
 
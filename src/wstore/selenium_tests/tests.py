@@ -91,6 +91,8 @@ def _create_indexes():
     for off in Offering.objects.all():
         search_engine.create_index(off)
 
+    search_engine.commit()
+
 
 def _create_tags():
     tm = TagManager()
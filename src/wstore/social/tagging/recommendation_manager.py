@@ -26,7 +26,7 @@ from stemming.porter2 import stem
 from whoosh.analysis import StemmingAnalyzer
 
 from wstore.social.tagging.tag_manager import TagManager
-from wstore.search.search_engine import SearchEngine
+from wstore.offerings.usdl.text_extractor import get_offering_text
 
 
 class RecommendationManager():
@@ -203,11 +203,8 @@ class USDLEntitiesRetrieving(Thread):
         Thread.__init__(self)
        
     def get_named_entities(self):
-        # Get USDL text aggregator
-        se = SearchEngine('')
-
         # Get usdl text
-        text = se._aggregate_text(self._offering)
+        text = get_offering_text(self._offering)
 
         # Get stemmed tokens
         analyzer = StemmingAnalyzer()
@@ -25,7 +25,10 @@ from whoosh.index import create_in, open_dir
 from whoosh.qparser import QueryParser
 from stemming.porter2 import stem
 
+from django.conf import settings
+
 from wstore.models import Offering
+from wstore.search.search_engine import SearchEngine
 
 
 class TagManager():
@@ -36,7 +39,6 @@ class TagManager():
         # Check tag indexes path
         if not index_path:
 
-            from django.conf import settings
             base = settings.BASEDIR
             self._index_path = path.join(base, 'wstore')
             self._index_path = path.join(self._index_path, 'social')
@@ -49,6 +51,14 @@ class TagManager():
         offering.tags = tags
         offering.save()
 
+        # The tags are used as a facet of the offerings search
+        index_path = os.path.join(settings.BASEDIR, 'wstore')
+        index_path = os.path.join(index_path, 'search')
+        index_path = os.path.join(index_path, 'indexes')
+
+        se = SearchEngine(index_path)
+        se.update_index(offering)
+
         # Check if the index exists
         if not os.path.exists(self._index_path) or os.listdir(self._index_path) == []:
             # Create dir if needed
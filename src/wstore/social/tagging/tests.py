@@ -120,8 +120,7 @@ class USDLTagsTestCase(TestCase):
 
     def test_usdl_tagging_recommendation(self):
         # Create mocks
-        recommendation_manager.SearchEngine = MagicMock
-        recommendation_manager.SearchEngine._aggregate_text = self._aggregate_mock
+        recommendation_manager.get_offering_text = self._aggregate_mock
 
         # Call class
         co_class = recommendation_manager.USDLEntitiesRetrieving(None)
@@ -186,11 +185,18 @@ class TagManagementTestCase(TestCase):
         offering.pk = pk
         offering.save = MagicMock()
 
+        se = MagicMock()
+        tag_manager.SearchEngine = MagicMock()
+        tag_manager.SearchEngine.return_value = se
+
         tag_man = tag_manager.TagManager(index_path=self._path)
         tag_man.update_tags(offering, tags)
 
         self.assertEquals(offering.tags, tags)
 
+        # The document of the offering is updated in the search index
+        se.update_index.assert_called_once_with(offering)
+
         # Query the index
         index = open_dir(self._path)
         with index.searcher() as searcher:
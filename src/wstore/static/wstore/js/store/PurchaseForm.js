@@ -253,8 +253,10 @@
      * @param data, Offering data
      */
     var downloadResources = function downloadResources(data) {
-        // Open a window with the invoice
-        window.open(data.bill[0]);
+        // Open a window with the invoice if it has been already generated
+        if (data.bill.length > 0) {
+            window.open(data.bill[0]);
+        }
 
         // Open the download resources modal
         $('#main-action').click();
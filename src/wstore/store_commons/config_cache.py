@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of WStore.
+
+# WStore is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL)
+# as published by the European Commission, either version 1.1
+# of the License, or (at your option) any later version.
+
+# WStore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# European Union Public Licence for more details.
+
+# You should have received a copy of the European Union Public Licence
+# along with WStore.
+# If not, see <https://joinup.ec.europa.eu/software/page/eupl/licence-eupl>.
+
+
+from __future__ import absolute_import
+
+import time
+import threading
+
+from django.conf import settings
+
+
+class ConfigurationCache():
+    """
+    Process-local cache of configuration objects that rarely change.
+    The values are grouped in categories that are invalidated when the
+    related objects are modified. Since the invalidation only affects the
+    current process, the values also expire after CONFIG_CACHE_TTL seconds
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._categories = {}
+
+    def get(self, category, key, loader):
+        now = time.time()
+
+        with self._lock:
+            entry = self._categories.get(category, {}).get(key)
+
+        if entry is not None and entry[1] > now:
+            return entry[0]
+
+        value = loader()
+
+        with self._lock:
+            self._categories.setdefault(category, {})[key] = (value, now + settings.CONFIG_CACHE_TTL)
+
+        return value
+
+    def invalidate(self, category=None):
+        with self._lock:
+            if category is None:
+                self._categories = {}
+            else:
+                self._categories.pop(category, None)
+
+
+_cache = ConfigurationCache()
+
+
+def _load_rss():
+    from wstore.models import RSS
+
+    rss_collection = RSS.objects.all()
+
+    if len(rss_collection) > 0:
+        return rss_collection[0]
+
+
+def get_rss():
+    """
+    Returns the RSS used by the store or None if
+    there is not any RSS registered
+    """
+    return _cache.get('rss', None, _load_rss)
+
+
+def get_unit(name):
+    """
+    Returns the unit with the given name, raising
+    DoesNotExist if it is not registered
+    """
+    from wstore.charging_engine.models import Unit
+    return _cache.get('units', name, lambda: Unit.objects.get(name=name))
+
+
+def get_default_currency():
+    from wstore.models import Context
+    return _cache.get('currencies', None, lambda: Context.objects.all()[0].allowed_currencies['default'])
+
+
+# The invalidation functions are connected to the signals of the
+# related models, so they accept the arguments of the signals
+
+def invalidate_rss(**kwargs):
+    _cache.invalidate('rss')
+
+
+def invalidate_units(**kwargs):
+    _cache.invalidate('units')
+
+
+def invalidate_currencies(**kwargs):
+    _cache.invalidate('currencies')
+
+
+def invalidate_configuration(**kwargs):
+    _cache.invalidate()
@@ -276,7 +276,9 @@ class ConditionalGetMiddleware(object):
     """
     def process_response(self, request, response):
         response['Date'] = http_date()
-        if not response.has_header('Content-Length'):
+
+        # Streamed responses are not consumed to calculate its length
+        if not response.has_header('Content-Length') and not response._base_content_is_iter:
             response['Content-Length'] = str(len(response.content))
 
         if response.has_header('ETag'):
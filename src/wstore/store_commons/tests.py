@@ -26,10 +26,12 @@ from nose_parameterized import parameterized
 
 from django.test import TestCase
 from django.contrib.sites.models import Site
+from django.test.utils import override_settings
 
 from wstore.store_commons.utils.usdlParser import USDLParser, validate_usdl
 from wstore.store_commons.utils import usdlParser
-from wstore.models import Organization, Context
+from wstore.models import Organization, Context, RSS
+from wstore.store_commons import config_cache
 
 __test__ = False
 
@@ -626,3 +628,44 @@ class PriceFunctionParsingTestCase(TestCase):
 
             self.assertTrue(error)
             self.assertEquals(msg, 'Invalid price function: ' + error_messages[i])
+
+
+class ConfigurationCacheTestCase(TestCase):
+
+    tags = ('config-cache',)
+
+    def setUp(self):
+        self._cache = config_cache.ConfigurationCache()
+        self._loader = MagicMock(return_value='value')
+
+    def test_value_loaded_once(self):
+        self.assertEquals(self._cache.get('units', 'call', self._loader), 'value')
+        self.assertEquals(self._cache.get('units', 'call', self._loader), 'value')
+        self.assertEquals(self._loader.call_count, 1)
+
+    def test_value_invalidated(self):
+        self._cache.get('units', 'call', self._loader)
+        self._cache.get('rss', None, self._loader)
+
+        self._cache.invalidate('units')
+        self._cache.get('units', 'call', self._loader)
+        self._cache.get('rss', None, self._loader)
+
+        # Only the invalidated category is loaded again
+        self.assertEquals(self._loader.call_count, 3)
+
+    @override_settings(CONFIG_CACHE_TTL=-1)
+    def test_value_expired(self):
+        self._cache.get('units', 'call', self._loader)
+        self._cache.get('units', 'call', self._loader)
+        self.assertEquals(self._loader.call_count, 2)
+
+    def test_rss_invalidated_on_save(self):
+        config_cache.invalidate_configuration()
+        self.assertEquals(config_cache.get_rss(), None)
+
+        rss = RSS.objects.create(name='test_rss', host='http://example.com/')
+        self.assertEquals(config_cache.get_rss().pk, rss.pk)
+
+        rss.delete()
+        self.assertEquals(config_cache.get_rss(), None)